@@ -1,8 +1,14 @@
-from collections import defaultdict
+from collections import OrderedDict
+import hashlib
+import random
 import statistics # for mean
+import time
 
+import numpy
 import skbio
 
+import config
+
 # https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2562909/
 BOUNDARIES = {
     'v1': (69,99),
@@ -19,7 +25,7 @@ BOUNDARIES = {
 # https://www.ncbi.nlm.nih.gov/nuccore/J01859
 whole16s = 'aaattgaagagtttgatcatggctcagattgaacgctggcggcaggcctaacacatgcaagtcgaacggtaacaggaagaagcttgctctttgctgacgagtggcggacgggtgagtaatgtctgggaaactgcctgatggagggggataactactggaaacggtagctaataccgcataacgtcgcaagaccaaagagggggaccttcgggcctcttgccatcggatgtgcccagatgggattagctagtaggtggggtaacggctcacctaggcgacgatccctagctggtctgagaggatgaccagccacactggaactgagacacggtccagactcctacgggaggcagcagtggggaatattgcacaatgggcgcaagcctgatgcagccatgccgcgtgtatgaagaaggccttcgggttgtaaagtactttcagcggggaggaagggagtaaagttaatacctttgctcattgacgttacccgcagaagaagcaccggctaactccgtgccagcagccgcggtaatacggagggtgcaagcgttaatcggaattactgggcgtaaagcgcacgcaggcggtttgttaagtcagatgtgaaatccccgggctcaacctgggaactgcatctgatactggcaagcttgagtctcgtagaggggggtagaattccaggtgtagcggtgaaatgcgtagagatctggaggaataccggtggcgaaggcggccccctggacgaagactgacgctcaggtgcgaaagcgtggggagcaaacaggattagataccctggtagtccacgccgtaaacgatgtcgacttggaggttgtgcccttgaggcgtggcttccggagctaacgcgttaagtcgaccgcctggggagtacggccgcaaggttaaaactcaaatgaattgacgggggcccgcacaagcggtggagcatgtggtttaattcgatgcaacgcgaagaaccttacctggtcttgacatccacggaagttttcagagatgagaatgtgccttcgggaaccgtgagacaggtgctgcatggctgtcgtcagctcgtgttgtgaaatgttgggttaagtcccgcaacgagcgcaacccttatcctttgttgccagcggtccggccgggaactcaaaggagactgccagtgataaactggaggaaggtggggatgacgtcaagtcatcatggcccttacgaccagggctacacacgtgctacaatggcgcatacaaagagaagcgacctcgcgagagcaagcggacctcataaagtgcgtcgtagtccggattggagtctgcaactcgactccatgaagtcggaatcgctagtaatcgtggatcagaatgccacggtgaatacgttcccgggccttgtacacaccgcccgtcacaccatgggagtgggttgcaaaagaagtaggtagcttaaccttcgggagggcgcttaccactttgtgattcatgactggggtgaagtcgtaacaaggtaaccgtaggggaacctgcggttggatcacctcctta'
 
-def find_region(location, direction='f'):
+def _scan_region(location, direction='f'):
     if direction == 'f': # forward
         for v, coords in BOUNDARIES.items():
             if location < coords[0]:
@@ -48,43 +54,350 @@ def find_region(location, direction='f'):
     else:
         raise ValueError('direction parameter must be "f" or "r".')
 
+# Every region, in order. Regions are stored as their position in this list
+# (with len(REGIONS) meaning "no region") in the lookup tables below.
+REGIONS = list(BOUNDARIES.keys())
+
+def _build_lookup(direction):
+    """
+    Runs _scan_region for every position in whole16s, so the region for
+    a position can be looked up rather than found by a scan.
+    """
+    table = numpy.empty(len(whole16s) + 1, dtype=numpy.int8)
+    for position in range(len(table)):
+        region = _scan_region(position, direction)
+        table[position] = len(REGIONS) if region is None else REGIONS.index(region)
+    return table
+
+# The region each position in whole16s falls in, for where alignments start
+# ('f') and where they end ('r')
+LOOKUP = {
+    'f': _build_lookup('f'),
+    'r': _build_lookup('r')
+}
+
+def find_region(location, direction='f'):
+    """
+    Determines which hypervariable region a position in whole16s counts
+    toward: for an alignment that starts there (direction "f"), the first
+    region that it covers at least half of; for one that ends there
+    (direction "r"), the last one.
+
+    Inputs:
+        - location: number. The position in whole16s.
+        - direction: string. "f" or "r".
+    Returns:
+        - The name of the region (e.g. "v4"), or None.
+    """
+    if direction not in LOOKUP:
+        raise ValueError('direction parameter must be "f" or "r".')
+    table = LOOKUP[direction]
+    # Whole positions inside the gene are looked up; anything else (such as
+    # an estimated endpoint that isn't a whole number) is found the slow way
+    if location == int(location) and 0 <= location < len(table):
+        code = table[int(location)]
+        return REGIONS[code] if code < len(REGIONS) else None
+    return _scan_region(location, direction)
+
+def classify_positions(positions, direction='f'):
+    """
+    The same as find_region, but for an array of whole-number positions
+    at once.
+
+    Returns:
+        - A numpy array of region codes: positions in REGIONS, with
+            len(REGIONS) for positions that aren't in a region.
+    """
+    return LOOKUP[direction][numpy.asarray(positions, dtype=numpy.intp)]
+
+def tally_regions(positions, direction='f'):
+    """
+    Counts how many positions fall in each region.
+
+    Returns:
+        - A dict: the number of positions in each region (and None, for
+            positions not in any region), for regions with at least one.
+    """
+    counts = numpy.bincount(classify_positions(positions, direction), minlength=len(REGIONS) + 1)
+    return _named(counts)
+
+def _named(counts):
+    """Turns an array of counts indexed by region code into a dict."""
+    return {(REGIONS + [None])[code]: int(count) for code, count in enumerate(counts) if count > 0}
+
+# The aligner for whole16s is only built once per process, the first time
+# it's needed, and re-used for every project after that.
+_reference = None
+
+def _aligner():
+    global _reference
+    if _reference is None:
+        _reference = skbio.alignment.StripedSmithWaterman(whole16s)
+    return _reference
+
+# Where each ASV we've seen aligns to whole16s, keyed by the SHA-1 digest
+# of its sequence, so ASVs found in more than one project are only aligned
+# once. See align(). (An OrderedDict, so the oldest entry can be dropped
+# cheaply; popping from the front of a plain dict gets slower and slower.)
+_alignments = OrderedDict()
+
+def align(asv):
+    """
+    Finds where an ASV lines up with the 16S reference sequence.
+
+    Inputs:
+        - asv: string. The ASV's sequence.
+    Returns:
+        - A tuple: the positions in whole16s where the alignment begins and
+            ends, and whether more than 70% of the ASV's bases count toward
+            the alignment.
+    """
+    key = hashlib.sha1(asv.encode('ascii')).digest()
+    if key in _alignments:
+        return _alignments[key]
+
+    offsets = None
+    if getattr(config, 'kmer_prefilter', True):
+        offsets = _kmer_offsets(asv)
+    if offsets is None:
+        offsets = _ssw_offsets(asv)
+
+    # Don't let the memo grow forever; once it's full, drop the oldest entry
+    if len(_alignments) >= getattr(config, 'alignment_memo_size', 1000000):
+        _alignments.popitem(last=False)
+    _alignments[key] = offsets
+    return offsets
+
+def _ssw_offsets(asv):
+    """Aligns an ASV to whole16s with Smith-Waterman. Returns the same as align()."""
+    result = _aligner()(asv)
+    align_length = result.query_end - result.query_begin
+    return (result.query_begin, result.query_end, align_length > len(asv) * 0.7)
+
+# Most ASVs match the reference exactly for long stretches, so they can be
+# placed by finding short sequences ("k-mers") they share with it, without
+# a full alignment. See _kmer_offsets().
+KMER_SIZE = 12
+KMER_MIN_SEEDS = 10 # shared k-mers required to place an ASV
+KMER_TOLERANCE = 5 # how far off (in bases) a placement is allowed to be
+
+def _build_kmer_index():
+    """
+    Returns a dict of every k-mer that appears exactly once in whole16s
+    (in upper case), and its position.
+    """
+    reference = whole16s.upper()
+    index = {}
+    repeated = set()
+    for position in range(len(reference) - KMER_SIZE + 1):
+        kmer = reference[position:position+KMER_SIZE]
+        if kmer in index:
+            repeated.add(kmer)
+        index[kmer] = position
+    for kmer in repeated:
+        del index[kmer]
+    return index
+
+KMER_INDEX = _build_kmer_index()
+
+def _kmer_offsets(asv):
+    """
+    Tries to place an ASV on whole16s using the k-mers they share. This
+    works when the shared k-mers all agree on where the ASV lines up
+    (allowing for a few insertions or deletions), cover nearly all of it,
+    and put both ends far enough from the edge of a region that being off
+    by KMER_TOLERANCE bases wouldn't change which region they count toward.
+
+    Inputs:
+        - asv: string. The ASV's sequence.
+    Returns:
+        - The same as align(), or None if the ASV couldn't be placed
+            confidently and needs a full alignment.
+    """
+    seq = asv.upper()
+    hits = [] # (position in ASV, position in whole16s)
+    for i in range(len(seq) - KMER_SIZE + 1):
+        position = KMER_INDEX.get(seq[i:i+KMER_SIZE])
+        if position is not None:
+            hits.append((i, position))
+    if len(hits) < KMER_MIN_SEEDS:
+        return None
+
+    # Matches far from where most of them put the ASV are noise; if there
+    # are too many of them, the placement isn't clear
+    center = statistics.median_low([position - i for i, position in hits])
+    kept = [(i, position) for i, position in hits if abs(position - i - center) <= KMER_TOLERANCE]
+    if len(kept) < len(hits) * 0.8:
+        return None
+    # The ends are extended out from the first and last matches, which is
+    # only safe if there isn't room for many insertions or deletions there
+    first, last = kept[0], kept[-1]
+    if first[0] > 2 * KMER_SIZE or len(seq) - (last[0] + KMER_SIZE) > 2 * KMER_SIZE:
+        return None
+
+    begin = first[1] - first[0]
+    end = last[1] + len(seq) - last[0] - 1
+    if begin - KMER_TOLERANCE < 0 or end + KMER_TOLERANCE >= len(whole16s):
+        return None
+    for position, direction in [(begin, 'f'), (end, 'r')]:
+        nearby = LOOKUP[direction][position-KMER_TOLERANCE:position+KMER_TOLERANCE+1]
+        if (nearby != nearby[0]).any():
+            return None
+    return (begin, end, True)
+
+def benchmark(asvs):
+    """
+    Compares placing ASVs with the k-mer prefilter (falling back to
+    Smith-Waterman when needed) against aligning all of them with
+    Smith-Waterman. Nothing is memoized.
+
+    Inputs:
+        - asvs: list of strings. The sequences to place.
+    Returns:
+        - A dict:
+            - placed: the proportion of ASVs placed by the prefilter alone
+            - agreement: the proportion of ASVs that start and end in the
+                same regions (and pass or fail the 70% rule the same way)
+                either way
+            - ssw_seconds, prefilter_seconds: how long each way took
+            - speedup: ssw_seconds / prefilter_seconds
+    """
+    def regions(offsets):
+        begin, end, good = offsets
+        return (find_region(begin, 'f'), find_region(end, 'r'), bool(good))
+
+    _aligner() # (so building it isn't part of the timing)
+    timer = time.perf_counter()
+    full = [_ssw_offsets(asv) for asv in asvs]
+    ssw_seconds = time.perf_counter() - timer
+
+    timer = time.perf_counter()
+    placed = 0
+    fast = []
+    for asv in asvs:
+        offsets = _kmer_offsets(asv)
+        if offsets is None:
+            offsets = _ssw_offsets(asv)
+        else:
+            placed += 1
+        fast.append(offsets)
+    prefilter_seconds = time.perf_counter() - timer
+
+    agree = len([1 for a, b in zip(full, fast) if regions(a) == regions(b)])
+    return {
+        'placed': placed / len(asvs),
+        'agreement': agree / len(asvs),
+        'ssw_seconds': ssw_seconds,
+        'prefilter_seconds': prefilter_seconds,
+        'speedup': ssw_seconds / prefilter_seconds if prefilter_seconds > 0 else None
+    }
+
+def _wilson_lower(hits, total, z):
+    """
+    Returns the lower end of the Wilson score interval for a proportion:
+    how low the true rate could be, given hits out of total. Works on
+    single numbers or arrays.
+    """
+    hits = numpy.asarray(hits, dtype=float)
+    total = numpy.asarray(total, dtype=float)
+    n = numpy.maximum(total, 1) # (results where total is 0 are thrown out below)
+    p = hits / n
+    center = p + z*z / (2*n)
+    spread = z * numpy.sqrt(p * (1 - p) / n + z*z / (4*n*n))
+    return numpy.where(total > 0, (center - spread) / (1 + z*z / n), 0)
+
+def _first_settled(codes, counts, evaluated, total, z, min_sample):
+    """
+    Adds one batch of ASVs' regions to a running tally, one ASV at a time,
+    and stops at the first ASV after which a region has been found in more
+    than half of a project's ASVs: either it already has been, or the ASVs
+    evaluated so far make it very likely (the lower end of the confidence
+    interval is above 50%).
+
+    Inputs:
+        - codes: numpy array. The region code of each ASV in the batch that
+            aligned well enough to count.
+        - counts: numpy array. How many ASVs have been found in each region
+            so far. Updated in place, up to the ASV that settled the question.
+        - evaluated: numpy array. For each ASV in codes, how many ASVs had
+            been evaluated (counting that one) when it was.
+        - total: int. How many ASVs are in the project.
+    Returns:
+        - The settled region, or None if it isn't settled yet.
+    """
+    if len(codes) == 0:
+        return None
+    rows = numpy.arange(len(codes))
+    running = numpy.zeros((len(codes), len(counts)), dtype=numpy.int64)
+    running[rows, codes] = 1
+    running = counts + numpy.cumsum(running, axis=0)
+    own = running[rows, codes] # the count of the region each ASV was found in
+
+    settled = (own > total / 2) | ((evaluated >= min_sample) & (_wilson_lower(own, evaluated, z) > 0.5))
+    # being settled on "no region" doesn't count; the tally just continues
+    settled &= codes != len(REGIONS)
+    if settled.any():
+        found = numpy.argmax(settled)
+        counts[:] = running[found]
+        return REGIONS[codes[found]]
+    counts[:] = running[-1]
+    return None
+
 def process_project(asvs, verbose=False):
-    results = {}
+    """
+    Infers which hypervariable regions of the 16S gene were sequenced in a
+    project, by aligning its ASVs to the gene and finding which regions
+    most of them start and end in. ASVs are evaluated in random order, and
+    evaluation stops once the start and end regions are statistically
+    settled (see config.region_confidence_z), rather than once more than
+    half of all ASVs have been aligned.
+
+    Inputs:
+        - asvs: list of strings. The sequence of each ASV.
+    Returns:
+        - A tuple: the inferred region (e.g. "v4" or "v3-v4") and the
+            average length of the ASVs.
+    """
     lengths = []
     for asv in asvs:
         lengths.append(len(asv))
     avglength = statistics.mean(lengths)
 
-    asv_align = skbio.alignment.StripedSmithWaterman(whole16s)
-    forwards = defaultdict(int)
-    reverses = defaultdict(int)
+    z = getattr(config, 'region_confidence_z', 3.29)
+    min_sample = getattr(config, 'region_min_sample', 30)
+    # The same order each time, so results are reproducible
+    order = list(asvs)
+    random.Random(0).shuffle(order)
+
+    # How many ASVs start and end in each region, by region code
+    forwards = numpy.zeros(len(REGIONS) + 1, dtype=numpy.int64)
+    reverses = numpy.zeros(len(REGIONS) + 1, dtype=numpy.int64)
     start = None
     end = None
     evaluated = 0
-    for asv in asvs:
-        evaluated += 1
-        results[asv] = asv_align(asv)
+    # ASVs are aligned in batches, and their regions are looked up and
+    # tallied a whole batch at a time
+    batch_size = getattr(config, 'region_batch_size', 32)
+    for i in range(0, len(order), batch_size):
+        offsets = numpy.array([align(asv) for asv in order[i:i+batch_size]], dtype=numpy.int64)
         if verbose:
-            print(f'{results[asv].query_begin} / {results[asv].query_end} / {results[asv].optimal_alignment_score}')
-        align_length = results[asv].query_end - results[asv].query_begin
+            for begin, finish, _ in offsets:
+                print(f'{begin} / {finish}')
 
         # Only keep matches where more than 70% of bases count toward the score:
-        if align_length <= len(asv) * 0.7:
-            continue
+        good = offsets[:, 2] == 1
+        counted = evaluated + 1 + numpy.arange(len(offsets))[good]
+        evaluated += len(offsets)
         if start is None:
-            region = find_region(results[asv].query_begin, direction='f')
-            forwards[region] += 1
-            if forwards[region] > len(asvs) / 2:
-                start = region
-                if verbose:
-                    print(f'\n\n !!!!\nDetermined start region! {start}')
+            codes = classify_positions(offsets[good, 0], direction='f')
+            start = _first_settled(codes, forwards, counted, len(asvs), z, min_sample)
+            if verbose and start is not None:
+                print(f'\n\n !!!!\nDetermined start region! {start}')
         if end is None:
-            region = find_region(results[asv].query_end, direction='r')
-            reverses[region] += 1
-            if reverses[region] > len(asvs) / 2:
-                end = region
-                if verbose:
-                    print(f'\n\n !!!!\nDetermined end region! {end}')
+            codes = classify_positions(offsets[good, 1], direction='r')
+            end = _first_settled(codes, reverses, counted, len(asvs), z, min_sample)
+            if verbose and end is not None:
+                print(f'\n\n !!!!\nDetermined end region! {end}')
         if start is not None and end is not None:
             break
 
@@ -116,13 +429,13 @@ def process_project(asvs, verbose=False):
     assignment = f'{start}{f"-{end}" if end != start else ""}'
     if verbose:
         print('FORWARD:')
-        for v, count in forwards.items():
+        for v, count in _named(forwards).items():
             print(f'{v}: {count}')
         print('REVERSE:')
-        for v, count in reverses.items():
+        for v, count in _named(reverses).items():
             print(f'{v}: {count}')
 
-        print(f'Evaluated {evaluated} of {len(asvs)} ASVs in {proj}')
+        print(f'Evaluated {evaluated} of {len(asvs)} ASVs')
         print(f'Our guess: {assignment}')
         print(f'Average length is {avglength} +/- {statistics.stdev(lengths)}')
     return((assignment, avglength))
@@ -12,10 +12,59 @@ archive_path = '/path/to_your/archive/'
 
 # Where is the SQLite database file?
 db_path = '/path_to_your/compendium.db'
+#
+# Overrides for the SQLite performance settings applied to every connection
+# (see PERFORMANCE_PROFILE in db.py for the defaults). The defaults are
+# safe when the database is on a shared network filesystem and opened from
+# several machines, as it is when "forward" runs as a batch job on the
+# cluster's compute nodes. If the database is on a local disk and only ever
+# opened from one machine, WAL mode and memory-mapped I/O are much faster:
+#   {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 1073741824}
+# (WAL is NOT safe over a network filesystem: it relies on shared memory
+# that other machines can't see, which can corrupt the database.)
+db_pragmas = {}
 
 # How many projects should we try to have running at one time?
 max_projects = 8
 
+# New projects are started until the ones in progress add up to this many
+# gigabases of sequencing data (or there are max_projects of them).
+launch_budget_gbases = 100
+# In what order should new projects be started? Options are 'shortest'
+# (least data first), 'fair' (taxa take turns), 'age' (earliest
+# published first) or 'random'.
+launch_policy = 'shortest'
+# How many samples can a project have and still be started automatically?
+launch_min_samples = 50
+launch_max_samples = 1000
+# To estimate when all the projects will be done, how many days back
+# should we look at how quickly projects have been finishing?
+launch_throughput_days = 7
+# ...and how many gigabases per hour should we assume if not enough
+# projects have finished in that time?
+launch_throughput_gbases = 10
+
+# How many project directories should be checked at the same time when
+# figuring out which projects are done? (Helps most on network filesystems.)
+scan_workers = 16
+
+# Which job scheduler runs the pipelines? It's asked which projects are
+# still running, since a project's "running.txt" file is left behind if
+# its job is killed. Options are 'slurm' or None (trust running.txt).
+scheduler = 'slurm'
+# How many days back should SLURM's accounting (sacct) be searched for
+# jobs that have finished?
+slurm_lookback_days = 14
+
+# How should the "watch" command notice that projects have finished?
+# 'inotify' gets notified by the operating system (Linux only, and only
+# for changes made on the same machine); 'poll' checks every
+# watch_poll_interval seconds; 'auto' uses inotify if it can.
+watch_method = 'auto'
+watch_poll_interval = 30
+# How often (in seconds) should "watch" re-check every project anyway?
+watch_full_interval = 600
+
 # Should a user's input be required to reprocess and discard projects?
 confirm_destruct = True
 
@@ -29,9 +78,66 @@ snakemake_git = 'git@github.com:blekhmanlab/snakemake-compendium.git'
 # How long should we wait to get a response from a web request before bailing?
 timeout = 25
 #
-# What base URLs should be used when building up queries?
-esearch_url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?tool={Tool}&email={Email}&api_key={Key}&db=sra&usehistory=y&term=' # pylint: disable=line-too-long
-efetch_url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?tool={Tool}&email={Email}&db=sra&query_key=1'
+# How many batches of samples should be requested at the same time? Requests
+# are still spaced out to stay under NCBI's limit (10 per second with an API
+# key, 3 per second without one).
+eutils_workers = 4
+#
+# How many times should a request be retried (with exponentially increasing
+# waits) after a timeout or an error from NCBI?
+eutils_retries = 5
+# If a batch still fails, how many times should it be sent to the back of
+# the line and attempted again before giving up on it?
+eutils_requeues = 2
+#
+# Where is the eUtils API? (The Tool, Email and Key values above are added to
+# every request.)
+eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+#
+# How many samples should be looked up in a single search? IDs are sent in the
+# body of a POST request, so this isn't limited by the length of a URL.
+eutils_batch_size = 1000
+#
+# How many records should be retrieved in each request for the search results?
+efetch_page_size = 500
+#
+# Where should raw eFetch responses be cached, so samples don't have to be
+# looked up again after a crash (or when running the "replay" command)?
+# Set to None to disable the cache.
+eutils_cache_path = '/path_to_your/eutils_cache/'
+# How many days until a cached response is considered stale?
+eutils_cache_ttl_days = 30
+# How large (in megabytes) can the cache grow before the oldest
+# responses are deleted?
+eutils_cache_max_mb = 5000
+#
+# When running the "export" command, how many rows of the sample
+# and taxonomy tables should go in each Parquet file?
+export_chunk_size = 500000
+#
+##############################################################
+
+
+############### ASV region inference ("asvs" command) ###############
+# ASVs are aligned to the 16S gene in random order until the regions
+# they start and end in are settled. How many standard deviations of
+# confidence are required before stopping early? (3.29 is about 99.9%)
+region_confidence_z = 3.29
+# ...and how many ASVs must be evaluated, at minimum, before stopping early?
+region_min_sample = 30
+# Should ASVs be placed on the 16S gene by matching short sequences
+# ("k-mers") first? ASVs that can't be placed confidently this way
+# still get a full Smith-Waterman alignment.
+kmer_prefilter = True
+# How many ASVs should be aligned between checks of whether the
+# regions are settled?
+region_batch_size = 32
+# How many ASV alignments should be kept in memory, so ASVs that show
+# up in multiple projects are only aligned once?
+alignment_memo_size = 1000000
+# How many projects should be evaluated at once, each in its own process?
+# (Can be overridden on the command line.)
+asv_workers = 1
 #
 ##############################################################
 
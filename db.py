@@ -2,15 +2,63 @@
 This module provides helper functions for interacting with a SQLite database
 and loading external data into it.
 """
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
+import hashlib
+import os
 import sqlite3
-import time
 import xml.etree.ElementTree as ET
 
 import requests
 
 import config
 import amplicon
+import ncbi
+
+# SQLite settings applied whenever a connection is opened. Any of these
+# can be overridden with a "db_pragmas" dict in config.py. The defaults are
+# safe for a database file on a network filesystem that's opened from more
+# than one machine (e.g. by jobs on different nodes of a cluster): WAL
+# mode and memory-mapped I/O both rely on memory shared between everyone
+# using the database, so they're only turned on by request.
+PERFORMANCE_PROFILE = {
+    'journal_mode': 'DELETE', # 'WAL' lets readers and the writer work at once, on one machine
+    'synchronous': 'FULL', # 'NORMAL' is safe, and much faster, with WAL
+    'cache_size': -262144, # negative values are in KiB, so this is 256 MB
+    'mmap_size': 0, # bytes of memory-mapped I/O; e.g. 1073741824 (1 GB) on a local disk
+    'temp_store': 'MEMORY' # keep temp tables and sort buffers off disk
+}
+
+# Secondary indexes maintained by the application, keyed by name. Any of
+# these that are missing from the database are created when a connection is
+# opened, so existing databases pick up new ones without a rebuild. An
+# index whose definition has changed here is rebuilt.
+INDEXES = {
+    # find_todo, the launcher module and Project._generate_accession_file
+    'idx_samples_project': 'samples(project, library_strategy, library_source)',
+    # find_runs
+    'idx_samples_no_run': 'samples(srs) WHERE srr IS NULL',
+    # load_xml, when recording tags
+    'idx_tags_srs': 'tags(srs)',
+    # finding every project that includes a given sequence
+    'idx_project_asvs_asv': 'project_asvs(asv_id)',
+    # joining counts to sequences and asv_assignments
+    'idx_sample_asv_counts_asv': 'sample_asv_counts(asv_id)',
+    'idx_result_samples_project': 'result_samples(project)',
+    # finding every sample that has a given taxon
+    'idx_taxon_rollups_taxon': 'taxon_rollups(rank, taxon)'
+}
+# Indexes that used to be in INDEXES, which are dropped if they're found.
+# (Other indexes, like any added by hand, are left alone.)
+RETIRED_INDEXES = [
+    'idx_asv_sequences_project' # asv_sequences is a view now
+]
+
+# Taxonomic ranks in asv_assignments, by column name. The taxon_rollups
+# table uses these names for its "rank" column.
+RANKS = ['kingdom', 'phylum', 'tclass', 'torder', 'family', 'genus']
 
 class Connection(object):
     """Data type holding the data required to maintain a database
@@ -26,12 +74,46 @@ class Connection(object):
             print(f'FATAL: {ex.sqlite_errorname}')
             exit(1)
         #print('Connected!')
+        self.db.create_function('sequence_hash', 1, sequence_hash, deterministic=True)
+        self.apply_profile()
+        self.batch_size = 5000 # how many queued rows trigger a flush
+        self._transaction_depth = 0 # >0 while inside a transaction() block
+        self._queued = {} # statement -> list of parameter tuples
+        self._queued_count = 0
         self.setup_tables()
+        self.migrate()
+        self.setup_indexes()
+
+    def apply_profile(self):
+        """
+        Applies the SQLite performance settings in PERFORMANCE_PROFILE,
+        overridden by anything in config.db_pragmas.
+        """
+        profile = {**PERFORMANCE_PROFILE, **getattr(config, 'db_pragmas', {})}
+        for pragma, value in profile.items():
+            if pragma not in PERFORMANCE_PROFILE:
+                raise Exception(f'Unrecognized database setting in db_pragmas: "{pragma}"')
+            # PRAGMA statements can't take bound parameters, so make sure
+            # nothing but a plain number or keyword makes it into the query
+            if not isinstance(value, int) and not str(value).isalnum():
+                raise Exception(f'Value for database setting "{pragma}" is not valid: "{value}"')
+            self.read(f'PRAGMA {pragma}={value}')
 
     def write(self, query, params=None):
         """
-        Executes a query against the database that
+        Executes a query against the database that modifies its contents.
+        Outside of a transaction() block, the change is committed
+        immediately.
+
+        Arguments:
+            - query: The SQL query to be executed.
+            - params: A tuple of parameters (execute) or a list of tuples
+                (executemany) to be substituted into the query.
+        Returns:
+            - A list of tuples, one for each row returned by the query.
         """
+        # anything queued earlier has to land before this statement does
+        self.flush()
         cursor = self.db.cursor()
         if params is not None:
             if isinstance(params, tuple):
@@ -43,13 +125,99 @@ class Connection(object):
 
         else:
             cursor.execute(query)
-        self.db.commit()
+        if self._transaction_depth == 0:
+            self.db.commit()
         results = []
         for result in cursor:
             results.append(result)
         cursor.close()
         return results
 
+    def queue(self, query, params):
+        """
+        Adds a single row of parameters to a batch of pending writes rather
+        than executing it right away. Rows are grouped by statement and sent
+        to the database with one executemany call per statement whenever
+        batch_size rows have accumulated, when flush() is called, when a
+        transaction() block ends, or before the next call to write().
+
+        Within a single statement, rows are written in the order they were
+        queued. Different statements are flushed in the order in which each
+        was first queued, so callers should not queue statements that depend
+        on each other's effects in the same batch.
+
+        Arguments:
+            - query: The SQL query to be executed.
+            - params: A tuple of parameters to be substituted into the query.
+        """
+        if not isinstance(params, tuple):
+            raise Exception('Queued parameters must be in a tuple')
+        self._queued.setdefault(query, []).append(params)
+        self._queued_count += 1
+        if self._queued_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all queued writes to the database, one executemany call per
+        distinct statement. Outside of a transaction() block, the
+        changes are then committed.
+        """
+        if self._queued_count == 0:
+            return
+        # reset the queue first, so a failed statement isn't retried
+        # on every subsequent flush
+        queued = self._queued
+        self._queued = {}
+        self._queued_count = 0
+
+        cursor = self.db.cursor()
+        for query, params in queued.items():
+            cursor.executemany(query, params)
+        cursor.close()
+        if self._transaction_depth == 0:
+            self.db.commit()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Context manager that groups all writes made inside the block into a
+        single transaction. Nothing is committed until the block ends; if
+        an exception is raised inside it, queued writes are dropped and
+        everything is rolled back. Blocks can be nested, in which case
+        only the outermost one commits or rolls back.
+
+        Arguments:
+            - immediate: bool. If True, take the database's write lock as
+                soon as the block starts (BEGIN IMMEDIATE), rather than at
+                the first write, so values read inside the block can't be
+                changed by another process before we write.
+
+        Example:
+            with connection.transaction():
+                connection.queue('INSERT INTO tags (srs, tag, value) VALUES (?,?,?)', row)
+        """
+        self._transaction_depth += 1
+        try:
+            if immediate and self._transaction_depth == 1:
+                if self.db.in_transaction:
+                    self.db.commit()
+                self.db.execute('BEGIN IMMEDIATE')
+            yield self
+            if self._transaction_depth == 1:
+                self.flush()
+        except BaseException:
+            if self._transaction_depth == 1:
+                self._queued = {}
+                self._queued_count = 0
+                self.db.rollback()
+            raise
+        else:
+            if self._transaction_depth == 1:
+                self.db.commit()
+        finally:
+            self._transaction_depth -= 1
+
     def read(self, query, params=None):
         """Helper function that converts results returned stored in a
         sqlite3 cursor into a less temperamental list format.
@@ -82,6 +250,33 @@ class Connection(object):
             print(f'ERROR with db query execution: {ex}')
             raise
 
+    # How many values read_in() puts in each query. (Older versions of
+    # SQLite allow at most 999 parameters in one query.)
+    IN_CHUNK_SIZE = 500
+
+    def read_in(self, query, values, params=()):
+        """
+        Runs a query that matches against a list of values, which may be
+        too long to fit in one query, and combines the results. The query is
+        run once for each chunk of IN_CHUNK_SIZE values.
+
+        Arguments:
+            - query: The SQL query to be executed. "{values}" in it is
+                replaced by a placeholder for each value in the chunk, e.g.
+                "WHERE project IN ({values})". It has to come after any other
+                placeholders in the query.
+            - values: list. The values to match against.
+            - params: Any other parameters to be substituted into the query.
+        Returns:
+            - A list of tuples, one for each row of results.
+        """
+        results = []
+        for i in range(0, len(values), self.IN_CHUNK_SIZE):
+            chunk = list(values[i:i+self.IN_CHUNK_SIZE])
+            chunk_query = query.replace('{values}', ','.join('?' * len(chunk)))
+            results.extend(self.read(chunk_query, tuple(params) + tuple(chunk)))
+        return results
+
     def setup_tables(self):
         """
         Makes sure all required tables are created in the specified database.
@@ -145,25 +340,67 @@ class Connection(object):
             )
         """)
 
+        # How far along each project's pipeline was the last time its
+        # directory was checked (see management.scan_projects). "checks" is
+        # a bitmask of which projects.PROGRESS_CHECKS passed; "stage" is the
+        # last of those in a row, and stage_changed_at is when it was first seen.
+        self.write("""
+            CREATE TABLE IF NOT EXISTS project_state (
+                project TEXT PRIMARY KEY,
+                mtimes TEXT,
+                scanned_at REAL,
+                checks INTEGER NOT NULL,
+                running INTEGER NOT NULL,
+                stage TEXT,
+                stage_changed_at REAL,
+                done_at REAL
+            )
+        """)
+
         # Results:
+        # Every sample that has results gets a numeric ID, so the counts
+        # table doesn't repeat the sample name on every row
         self.write("""
-            CREATE TABLE IF NOT EXISTS asv_counts (
-                entryid INTEGER PRIMARY KEY,
-                sample TEXT NOT NULL,
-                asv TEXT NOT NULL,
-                count INTEGER NOT NULL
+            CREATE TABLE IF NOT EXISTS result_samples (
+                sample_id INTEGER PRIMARY KEY,
+                sample TEXT NOT NULL UNIQUE,
+                project TEXT NOT NULL
             )
         """)
 
+        # Read counts, keyed by sample_id and sequences.asv_id.
+        # (The "asv_counts" view presents these with names instead of IDs.)
+        self.write("""
+            CREATE TABLE IF NOT EXISTS sample_asv_counts (
+                sample_id INTEGER NOT NULL,
+                asv_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (sample_id, asv_id)
+            ) WITHOUT ROWID
+        """)
+
+        # Each distinct ASV sequence is stored once, no matter how many
+        # projects found it. Sequences are looked up by their hash; see
+        # sequence_hash().
         self.write("""
-            CREATE TABLE IF NOT EXISTS asv_sequences (
+            CREATE TABLE IF NOT EXISTS sequences (
                 asv_id INTEGER PRIMARY KEY,
-                project TEXT NOT NULL,
-                asv TEXT NOT NULL,
+                seq_hash TEXT UNIQUE,
                 seq TEXT
             )
         """)
 
+        # The name each project gave to each sequence (ASV_1, ASV_2, etc.)
+        # (The "asv_sequences" view combines this with the sequences.)
+        self.write("""
+            CREATE TABLE IF NOT EXISTS project_asvs (
+                project TEXT NOT NULL,
+                asv TEXT NOT NULL,
+                asv_id INTEGER NOT NULL,
+                PRIMARY KEY (project, asv)
+            ) WITHOUT ROWID
+        """)
+
         self.write("""
             CREATE TABLE IF NOT EXISTS asv_assignments (
                 asv_id INTEGER PRIMARY KEY,
@@ -177,6 +414,18 @@ class Connection(object):
             )
         """)
 
+        # Read counts summed by taxon at each rank (see RANKS) for each sample,
+        # kept up to date by update_rollups()
+        self.write("""
+            CREATE TABLE IF NOT EXISTS taxon_rollups (
+                sample_id INTEGER NOT NULL,
+                rank TEXT NOT NULL,
+                taxon TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (sample_id, rank, taxon)
+            ) WITHOUT ROWID
+        """)
+
         self.write("""
             CREATE TABLE IF NOT EXISTS asv_inference (
                 project TEXT PRIMARY KEY,
@@ -185,94 +434,423 @@ class Connection(object):
             )
         """)
 
+    def setup_indexes(self):
+        """
+        Creates any of the indexes listed in INDEXES that aren't already in
+        the database, and drops any in RETIRED_INDEXES. The first connection
+        after an index is added may take a while on a large database; after
+        that, this is a no-op.
+        """
+        existing = self.read("SELECT name, sql FROM sqlite_master WHERE type='index'")
+        existing = {x[0]: x[1] for x in existing}
+        for name, sql in list(existing.items()):
+            # drop indexes we don't use anymore, or whose definition changed
+            if name in RETIRED_INDEXES or (name in INDEXES and not sql.endswith(f' ON {INDEXES[name]}')):
+                self.write(f'DROP INDEX {name}')
+                del existing[name]
+        for name, definition in INDEXES.items():
+            if name in existing:
+                continue
+            print(f'Creating database index {name}. This may take a while.')
+            self.write(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+
+    def migrate(self):
+        """
+        Brings the database up to date by applying, in order, every function
+        in MIGRATIONS that hasn't been applied yet. The number of migrations
+        applied so far is stored in the database's user_version. Each
+        migration runs in its own transaction, so a migration that fails
+        partway through leaves the database as it was.
+        """
+        version = self.read('PRAGMA user_version')[0][0]
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            print(f'Updating database to schema version {number}: {migration.__doc__.strip().splitlines()[0]}')
+            with self.transaction(immediate=True):
+                migration(self)
+                self.write(f'PRAGMA user_version={number}')
+
     def __del__(self):
         """Closes the database connection when the Connection object
         is destroyed."""
         if self.db is not None:
             self.db.close()
 
-def load_xml(taxon, filename, save_samples=True, save_tags=False):
+def _migrate_compact_counts(connection):
+    """
+    Move read counts into the integer-keyed sample_asv_counts table.
+
+    Read counts used to be stored in an "asv_counts" table with the sample
+    name and project-level ASV name (ASV_1, etc.) on every row. These are
+    converted to a sample_id from result_samples and the asv_id of the
+    ASV in asv_sequences. The project for each sample comes from the
+    samples table. Any rows that can't be matched to a sample and ASV are
+    left in a table called asv_counts_legacy. A view called asv_counts
+    takes the place of the old table.
+    """
+    old = connection.read("SELECT name FROM sqlite_master WHERE type='table' AND name='asv_counts'")
+    if len(old) > 0:
+        connection.write('ALTER TABLE asv_counts RENAME TO asv_counts_legacy')
+        # these make the joins below lookups instead of scans
+        connection.write('CREATE INDEX IF NOT EXISTS idx_asv_sequences_project ON asv_sequences(project, asv)')
+        connection.write('CREATE INDEX temp_idx_samples_srr ON samples(srr)')
+
+        print('   Assigning sample IDs...')
+        connection.write("""
+            INSERT OR IGNORE INTO result_samples (sample, project)
+            SELECT c.sample, MIN(s.project)
+            FROM (SELECT DISTINCT sample FROM asv_counts_legacy) c
+            INNER JOIN samples s ON s.srr=c.sample
+            WHERE s.project IS NOT NULL
+            GROUP BY 1
+        """)
+        print('   Converting counts. This may take a while...')
+        connection.write("""
+            INSERT OR IGNORE INTO sample_asv_counts (sample_id, asv_id, count)
+            SELECT rs.sample_id, seq.asv_id, SUM(c.count)
+            FROM asv_counts_legacy c
+            INNER JOIN result_samples rs ON c.sample=rs.sample
+            INNER JOIN asv_sequences seq
+                ON rs.project=seq.project AND c.asv=seq.asv
+            GROUP BY 1, 2
+        """)
+        connection.write("""
+            DELETE FROM asv_counts_legacy
+            WHERE EXISTS (
+                SELECT 1
+                FROM result_samples rs
+                INNER JOIN asv_sequences seq ON rs.project=seq.project
+                WHERE rs.sample=asv_counts_legacy.sample
+                    AND seq.asv=asv_counts_legacy.asv
+            )
+        """)
+        connection.write('DROP INDEX temp_idx_samples_srr')
+
+        left = connection.read('SELECT COUNT(*) FROM asv_counts_legacy')[0][0]
+        if left == 0:
+            connection.write('DROP TABLE asv_counts_legacy')
+        else:
+            print(f'WARNING: {left} counts could not be matched to a sample and ASV. They are in asv_counts_legacy.')
+
+    connection.write("""
+        CREATE VIEW IF NOT EXISTS asv_counts AS
+        SELECT rs.sample, seq.asv, c.count, rs.project, c.sample_id, c.asv_id
+        FROM sample_asv_counts c
+        INNER JOIN result_samples rs ON c.sample_id=rs.sample_id
+        INNER JOIN asv_sequences seq ON c.asv_id=seq.asv_id
+    """)
+
+def _migrate_shared_sequences(connection):
+    """
+    Store each distinct ASV sequence only once, across all projects.
+
+    The asv_sequences table used to have one row per ASV per project, even
+    when the same sequence was found in many projects. Each distinct
+    sequence now gets one row in the "sequences" table, using the lowest
+    asv_id it had before, and project_asvs records what each project called
+    it. Read counts and taxonomic assignments that pointed at the other
+    copies are moved to the remaining one. A view called asv_sequences takes
+    the place of the old table.
+    """
+    # the views are rebuilt at the end, once the tables they read are in place
+    views = connection.read("SELECT name FROM sqlite_master WHERE type='view' AND name IN ('asv_counts', 'asv_sequences')")
+    for view in views:
+        connection.write(f'DROP VIEW {view[0]}')
+
+    old = connection.read("SELECT name FROM sqlite_master WHERE type='table' AND name='asv_sequences'")
+    if len(old) > 0:
+        connection.write('ALTER TABLE asv_sequences RENAME TO asv_sequences_legacy')
+
+        print('   Finding duplicate sequences...')
+        connection.write("""
+            INSERT INTO sequences (asv_id, seq_hash, seq)
+            SELECT MIN(asv_id), sequence_hash(seq), seq
+            FROM asv_sequences_legacy
+            WHERE seq IS NOT NULL
+            GROUP BY seq
+        """)
+        # there's nothing to match ASVs without a sequence to, so they stay separate
+        connection.write("""
+            INSERT INTO sequences (asv_id, seq_hash, seq)
+            SELECT asv_id, NULL, NULL
+            FROM asv_sequences_legacy
+            WHERE seq IS NULL
+        """)
+        connection.write('CREATE TEMP TABLE asv_remap (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)')
+        connection.write("""
+            INSERT INTO asv_remap (old_id, new_id)
+            SELECT l.asv_id, COALESCE(s.asv_id, l.asv_id)
+            FROM asv_sequences_legacy l
+            LEFT JOIN sequences s ON s.seq_hash=sequence_hash(l.seq)
+        """)
+        connection.write("""
+            INSERT OR IGNORE INTO project_asvs (project, asv, asv_id)
+            SELECT l.project, l.asv, m.new_id
+            FROM asv_sequences_legacy l
+            INNER JOIN asv_remap m ON l.asv_id=m.old_id
+        """)
+
+        print('   Moving read counts to the remaining copy of each sequence...')
+        connection.write("""
+            CREATE TABLE sample_asv_counts_new (
+                sample_id INTEGER NOT NULL,
+                asv_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (sample_id, asv_id)
+            ) WITHOUT ROWID
+        """)
+        # (a project that found the same sequence twice has its counts combined)
+        connection.write("""
+            INSERT INTO sample_asv_counts_new (sample_id, asv_id, count)
+            SELECT c.sample_id, COALESCE(m.new_id, c.asv_id), SUM(c.count)
+            FROM sample_asv_counts c
+            LEFT JOIN asv_remap m ON c.asv_id=m.old_id
+            GROUP BY 1, 2
+        """)
+        connection.write('DROP TABLE sample_asv_counts')
+        connection.write('ALTER TABLE sample_asv_counts_new RENAME TO sample_asv_counts')
+
+        # keep the assignment of the remaining copy, unless it didn't have one
+        connection.write("""
+            INSERT OR IGNORE INTO asv_assignments
+            SELECT m.new_id, a.tdatabase, a.kingdom, a.phylum, a.tclass, a.torder, a.family, a.genus
+            FROM asv_assignments a
+            INNER JOIN asv_remap m ON a.asv_id=m.old_id
+            WHERE m.old_id!=m.new_id
+        """)
+        connection.write("""
+            DELETE FROM asv_assignments
+            WHERE asv_id IN (SELECT old_id FROM asv_remap WHERE old_id!=new_id)
+        """)
+
+        connection.write('DROP TABLE asv_remap')
+        connection.write('DROP TABLE asv_sequences_legacy')
+
+    connection.write("""
+        CREATE VIEW asv_sequences AS
+        SELECT p.asv_id, p.project, p.asv, s.seq, s.seq_hash
+        FROM project_asvs p
+        INNER JOIN sequences s ON p.asv_id=s.asv_id
+    """)
+    # The same asv_id can now be in many projects, so counts are matched to
+    # ASV names through the project of the sample
+    connection.write("""
+        CREATE VIEW asv_counts AS
+        SELECT rs.sample, p.asv, c.count, rs.project, c.sample_id, c.asv_id
+        FROM sample_asv_counts c
+        INNER JOIN result_samples rs ON c.sample_id=rs.sample_id
+        INNER JOIN project_asvs p ON rs.project=p.project AND c.asv_id=p.asv_id
+    """)
+
+def _migrate_taxon_rollups(connection):
+    """
+    Fill the taxon_rollups table for projects that were already saved.
+
+    Totals are calculated the same way as they are for newly saved
+    projects; see update_rollups().
+    """
+    projects = connection.read('SELECT DISTINCT project FROM result_samples')
+    for done, project in enumerate(projects):
+        if done % 100 == 0:
+            print(f'   {done} of {len(projects)} projects summed.')
+        update_rollups(connection, project[0])
+
+def _migrate_project_stages(connection):
+    """
+    Record every pipeline check in project_state, not just whether projects are done.
+
+    Nothing in project_state is lost by starting it over: the table is
+    refilled the next time project directories are scanned.
+    """
+    connection.write('DROP TABLE IF EXISTS project_state')
+    connection.setup_tables()
+
+def _migrate_asv_counts_view(connection):
+    """
+    Show each read count once in the asv_counts view, even if two ASVs in a project share a sequence.
+
+    Save_results combines the counts of ASVs in the same project that have
+    the same sequence, so the view used to repeat the combined count under
+    each of their names. Now each count is listed under the first of the
+    names (alphabetically).
+    """
+    views = connection.read("SELECT name FROM sqlite_master WHERE type='view' AND name='asv_counts'")
+    if len(views) > 0:
+        connection.write('DROP VIEW asv_counts')
+    # (a subquery rather than a GROUP BY, so filters on the project or
+    # sample can still use the indexes)
+    connection.write("""
+        CREATE VIEW asv_counts AS
+        SELECT rs.sample,
+            (
+                SELECT MIN(p.asv) FROM project_asvs p
+                WHERE p.project=rs.project AND p.asv_id=c.asv_id
+            ) AS asv,
+            c.count, rs.project, c.sample_id, c.asv_id
+        FROM sample_asv_counts c
+        INNER JOIN result_samples rs ON c.sample_id=rs.sample_id
+    """)
+
+def _migrate_project_done_at(connection):
+    """
+    Record when each project finished, in project_state.
+
+    The time is filled in the next time a finished project is scanned, so
+    projects that finished before this change don't get one.
+    """
+    columns = [x[1] for x in connection.read('PRAGMA table_info(project_state)')]
+    if 'done_at' not in columns:
+        connection.write('ALTER TABLE project_state ADD COLUMN done_at REAL')
+
+# Changes to the schema (or data) of existing databases, applied in order by
+# Connection.migrate(). New migrations always go at the END of this list.
+MIGRATIONS = [
+    _migrate_compact_counts,
+    _migrate_shared_sequences,
+    _migrate_taxon_rollups,
+    _migrate_project_stages,
+    _migrate_asv_counts_view,
+    _migrate_project_done_at
+]
+
+def sequence_hash(seq):
+    """
+    Returns the key used to look up an ASV sequence in the "sequences"
+    table. (Also available in SQL queries as sequence_hash().)
+
+    Inputs:
+        - seq: string. The sequence.
+    Returns:
+        - A string: the SHA-1 hex digest of the sequence, or None if
+            there is no sequence.
+    """
+    if seq is None:
+        return None
+    return hashlib.sha1(seq.encode('ascii')).hexdigest()
+
+def _iter_biosamples(filename):
+    """
+    Generator that streams the "full text XML" export of BioSamples one
+    <BioSample> element at a time, rather than loading the whole document
+    into memory. Each element is cleared (and detached from the root) once
+    the caller is done with it, so memory use stays flat regardless of
+    file size.
+
+    Inputs:
+        - filename: The path to the XML file to be parsed.
+    Yields:
+        - A tuple: the <BioSample> element, and how many bytes of the
+            file have been consumed so far.
+    """
+    with open(filename, 'rb') as file:
+        root = None
+        for event, elem in ET.iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag != 'BioSample':
+                continue
+            yield elem, file.tell()
+            # drop the finished element AND the root's reference to it,
+            # otherwise the (empty) children pile up on the root
+            elem.clear()
+            root.clear()
+
+def load_xml(taxon, filename, save_samples=True, save_tags=False, batch_size=5000):
     """
     Loads the "full text XML" exported from a search of BioSamples and adds
-    them to the database.
+    them to the database. The file is parsed incrementally, so it doesn't
+    matter how large it is.
 
     Inputs:
         - taxon: The taxon ID from the NCBI taxonomy browser associated with the samples.
+        - filename: The path to the XML file to be parsed.
+        - batch_size: int. How many rows to queue before sending them
+            to the database.
     """
     connection = Connection()
     print(f'\n\n\n===================\nProcessing XML for taxon {taxon}\n==========\n\n')
 
-    # load the XML file
-    print('loading xml...')
-    tree = ET.parse(filename)
-    biosamples = tree.getroot()
-    print('processing samples!')
+    total_bytes = os.path.getsize(filename)
+    print(f'streaming {total_bytes} bytes of xml...')
     # iterate through each entry in the file
-    done = -1
+    done = 0
     skipped = 0
 
-    
-    # make a list of samples we've already recorded, so an XML file can be parsed in
-    # stages if necessary
-    recognized_samples = connection.read('SELECT srs FROM samples ORDER BY 1')
-    recognized_samples = [x[0] for x in recognized_samples] #unpack tuples of length 1
-
-    recognized_tags = connection.read('SELECT DISTINCT srs FROM tags ORDER BY 1')
-    recognized_tags = [x[0] for x in recognized_tags]
-
-    for sample in biosamples:
-        done += 1
-        if done % 10000 == 0:
-            print(f'   {done} out of {len(biosamples)} complete.')
-        # find SRA ID of sample
-        # example: <BioSample> <Ids> <Id db="SRA">SRS5588834</Id> </Ids> </BioSample>
-        sra = None
-        for entry in sample.iter('Id'):
-            if 'db' in entry.attrib.keys() and entry.attrib['db'] == 'SRA':
-                sra = entry.text
-        if sra is None:
-            skipped += 1
-            if skipped % 1000 == 0:
-                print(f'Skipped {skipped} samples so far.')
-            continue # skip samples without an SRA sample
-
-        #  NOTE: we used to check for BioProject ID here,
-        #  but for some reason half the samples don't list a bioproject
-        #  even if they have one.
-
-        if save_samples and sra not in recognized_samples:
-            connection.write('INSERT INTO samples (srs, taxon) VALUES (?, ?);', (sra, taxon))
-
-        if save_tags and sra not in recognized_tags:
-            # go through all the attributes and tally them
-            all_tags = {}
-            for tag in sample.iter('Attribute'):
-                if tag is None or tag.text is None: # some tags don't have values
-                    continue
-                text = tag.text.lower()
-                if 'harmonized_name' in tag.attrib.keys():
-                    all_tags[tag.attrib['harmonized_name']] = text
-                elif 'attribute_name' in tag.attrib.keys():
-                    all_tags[tag.attrib['attribute_name']] = text
-            # add all the tags to the tag table
-            sql = 'INSERT INTO tags (srs, tag, value) VALUES (?,?,?);'
-            params = [(sra, tag, value) for (tag, value) in all_tags.items()]
-            connection.write(sql, params)
-
-    print(f'{len(biosamples)} total samples evaluated, {skipped} skipped')
+    # Samples we've already recorded are skipped by the primary key on
+    # samples.srs, so an XML file can be parsed in stages if necessary.
+    sample_sql = 'INSERT OR IGNORE INTO samples (srs, taxon) VALUES (?, ?);'
+    # The tags table has no such key, so keep a set of samples that
+    # already have tags, which also catches samples listed twice in one file
+    tag_sql = 'INSERT INTO tags (srs, tag, value) VALUES (?,?,?);'
+    recognized_tags = set()
+    if save_tags:
+        recognized_tags = {x[0] for x in connection.read('SELECT DISTINCT srs FROM tags')}
+
+    # Everything is written in a single transaction; rows are sent to the
+    # database in executemany batches of batch_size as they accumulate.
+    connection.batch_size = batch_size
+    with connection.transaction():
+        for sample, consumed in _iter_biosamples(filename):
+            if done % 10000 == 0:
+                print(f'   {done} samples complete ({consumed} of {total_bytes} bytes, {consumed / total_bytes:.1%}).')
+            done += 1
+            # find SRA ID of sample
+            # example: <BioSample> <Ids> <Id db="SRA">SRS5588834</Id> </Ids> </BioSample>
+            sra = None
+            for entry in sample.iter('Id'):
+                if 'db' in entry.attrib.keys() and entry.attrib['db'] == 'SRA':
+                    sra = entry.text
+            if sra is None:
+                skipped += 1
+                if skipped % 1000 == 0:
+                    print(f'Skipped {skipped} samples so far.')
+                continue # skip samples without an SRA sample
+
+            #  NOTE: we used to check for BioProject ID here,
+            #  but for some reason half the samples don't list a bioproject
+            #  even if they have one.
+
+            if save_samples:
+                connection.queue(sample_sql, (sra, taxon))
+
+            if save_tags and sra not in recognized_tags:
+                recognized_tags.add(sra)
+                # go through all the attributes and tally them
+                all_tags = {}
+                for tag in sample.iter('Attribute'):
+                    if tag is None or tag.text is None: # some tags don't have values
+                        continue
+                    text = tag.text.lower()
+                    if 'harmonized_name' in tag.attrib.keys():
+                        all_tags[tag.attrib['harmonized_name']] = text
+                    elif 'attribute_name' in tag.attrib.keys():
+                        all_tags[tag.attrib['attribute_name']] = text
+                # add all the tags to the tag table
+                for tag, value in all_tags.items():
+                    connection.queue(tag_sql, (sra, tag, value))
+
+    print(f'{done} total samples evaluated, {skipped} skipped')
     # TODO: check if we recorded tags for samples that we skipped
-    
 
-def find_runs(count, per_query=80, verbose=False):
+def find_runs(count, per_query=None, verbose=False, workers=None):
     """
     Queries the NCBI eUtils API to use sample IDs ("SRS" codes)
     to get information about runs ("SRR" codes) that can then
-    be downloaded as FASTQ files.
+    be downloaded as FASTQ files. Several batches are requested at
+    once, limited by how many requests per second NCBI allows.
 
     Inputs:
         - count: int. The upper limit for how many entries to search in total.
-        - per_query: int. The number of entries to request in each web request
+        - per_query: int. The number of samples to look up in each esearch
+            request. Defaults to config.eutils_batch_size.
+        - workers: int. How many batches to have in flight at once. Defaults
+            to config.eutils_workers.
     """
+    if per_query is None:
+        per_query = getattr(config, 'eutils_batch_size', 1000)
     connection = Connection()
 
     todo = connection.read("""
@@ -284,200 +862,278 @@ def find_runs(count, per_query=80, verbose=False):
 
     todo = [x[0] for x in todo] # each ID is nested inside a tuple of length 1
     print(f'Found {len(todo)} samples to process')
-    cursor = 0
+
     multiple_runs = 0
+    # If we've already downloaded responses covering some of these samples,
+    # re-use them rather than asking NCBI again
+    cache = ncbi.ResponseCache.from_config()
+    if cache is not None:
+        cache.evict()
+        covered = cache.index()
+        entries = {covered[srs] for srs in todo if srs in covered}
+        if len(entries) > 0:
+            print(f'Found cached responses for {len([x for x in todo if x in covered])} samples.')
+            multiple_runs += _replay_entries(entries, connection, verbose)
+            todo = [srs for srs in todo if srs not in covered]
+
+    batches = [todo[i:i+per_query] for i in range(0, len(todo), per_query)]
+
+    completed = 0
+    failed = 0
     since_update = 0
     lap1 = datetime.now()
 
-    error_previous = False # if we get two timeouts in a row, just stop
+    client = ncbi.Client(workers)
+    # Requests are sent from worker threads, but everything that touches the
+    # database happens here, since sqlite connections can't be shared
+    fetch = partial(_fetch_runs, verbose=verbose, cache=cache)
+    for batch, pages in client.map(fetch, batches):
+        completed += len(batch)
+        since_update += len(batch)
+        if pages is None:
+            # Batches that fail are retried a few times, but after that it's
+            # not an issue to skip them because the samples aren't being
+            # evaluated in a particular order. They'll be picked up in
+            # subsequent runs.
+            print(f'Batch of {len(batch)} samples failed repeatedly. Skipping.')
+            failed += len(batch)
+        else:
+            with connection.transaction():
+                for page in pages:
+                    multiple_runs += _record_data(page, connection, verbose)
 
-    while cursor < len(todo):
-        # If we send requests 70 or 80 samples at a time,
-        # we can't just use (cursor % 1000 == 0) to decide
-        # when to update, because the cursor will probably skip
-        # right over the round numbers
+        # Batches can be of uneven size, so we can't just use
+        # (completed % 1000 == 0) to decide when to update
         if since_update > 1000:
             lap2 = datetime.now()
-            print(f'COMPLETE: {cursor} ({(lap2-lap1).total_seconds()} seconds)')
+            print(f'COMPLETE: {completed} ({(lap2-lap1).total_seconds()} seconds)')
             since_update = 0
             lap1 = lap2
 
-        url = config.esearch_url
-        # Build up the URL project by project:
-        for _ in range(0, per_query):
-            url += f'{todo[cursor]}[accn] or '
-            cursor += 1
-            since_update += 1
-            if cursor == len(todo):
-                break # in case the total isn't a multiple of "per_query"
-        url = url[:-4] # trim off trailing " or "
-        if len(url) >1950:
-            print(url)
-            print('\n\n\nURL IS TOO LONG! Bailing to avoid cutting off request.')
-            exit(1)
+    if failed > 0:
+        print(f'\n{failed} samples were skipped because of errors.')
+    print(f"\n\nTOTAL SAMPLES WITH MULTIPLE RUNS: {multiple_runs}.\n\n")
 
-        if verbose:
-            print('Next request')
-        time.sleep(0.5)
+def update_rollups(connection, project):
+    """
+    Recalculates the taxon_rollups entries for every sample in one project:
+    the total reads from each taxon at each rank. ASVs without a taxonomic
+    assignment aren't counted, and ranks at which an ASV wasn't classified
+    are counted under "NA".
 
-        try:
-            req = requests.get(url, timeout=config.timeout)
-        except requests.exceptions.HTTPError:
-            print('ERROR: Error sending request for webenv data. Skipping.')
-            if error_previous:
-                print('Two errors in a row. Bailing.')
-                exit(1)
-            error_previous = True
-            continue
+    Inputs:
+        - connection: A Connection object.
+        - project: string. The BioProject ID of the project.
+    """
+    with connection.transaction():
+        connection.write("""
+            DELETE FROM taxon_rollups
+            WHERE sample_id IN (SELECT sample_id FROM result_samples WHERE project=?)
+        """, (project,))
+        for rank in RANKS:
+            connection.write(f"""
+                INSERT INTO taxon_rollups (sample_id, rank, taxon, count)
+                SELECT c.sample_id, ?, COALESCE(a.{rank}, 'NA'), SUM(c.count)
+                FROM sample_asv_counts c
+                INNER JOIN result_samples rs ON c.sample_id=rs.sample_id
+                INNER JOIN asv_assignments a ON c.asv_id=a.asv_id
+                WHERE rs.project=?
+                GROUP BY 1, 3
+            """, (rank, project))
+
+def rebuild_rollups():
+    """
+    Throws out the taxon_rollups table and recalculates it from the read
+    counts of every project. Each project is saved as it's finished.
+    """
+    connection = Connection()
+    connection.write('DELETE FROM taxon_rollups')
+    projects = connection.read('SELECT DISTINCT project FROM result_samples ORDER BY project')
+    print(f'Found {len(projects)} projects to sum')
+    for done, project in enumerate(projects):
+        if done % 100 == 0:
+            print(f'COMPLETE: {done}')
+        update_rollups(connection, project[0])
+
+def replay_cache(verbose=False):
+    """
+    Re-parses every response in the eUtils cache and saves the results to the
+    database without sending any web requests. Useful after the samples
+    table is rebuilt or its schema changes.
+    """
+    cache = ncbi.ResponseCache.from_config()
+    if cache is None:
+        print('No eUtils cache is configured (eutils_cache_path in config.py). Exiting.')
+        exit(1)
+    connection = Connection()
+    entries = list(cache.entries())
+    print(f'Replaying {len(entries)} cached batches')
+    multiple_runs = _replay_entries(entries, connection, verbose)
+    print(f"\n\nTOTAL SAMPLES WITH MULTIPLE RUNS: {multiple_runs}.\n\n")
 
-        try:
-            tree = ET.fromstring(req.text)
-        except ET.ParseError:
-            print(f'ERROR: Couldnt parse response retrieving webenv data: {req.text}')
-            print('Skipping.')
-            if error_previous:
-                print('Two errors in a row. Bailing.')
-                exit(1)
-            error_previous = True
-            continue
+def _replay_entries(entries, connection, verbose=False):
+    """
+    Saves the samples found in a list of cache entries (see
+    ncbi.ResponseCache) to the database.
 
-        webenv = tree.find('WebEnv')
-        if webenv is None:
-            print('\n---------\n')
-            print(req.text)
-            print("WARNING: Got response without a 'webenv' field. Skipping.")
-            if error_previous:
-                print('Two errors in a row. Bailing.')
-                exit(1)
-            error_previous = True
-            continue
-        
-        url = f'{config.efetch_url}&WebEnv={webenv.text}'
-        if len(url) >1950:
-            print(url)
-            print('\n\n\nURL IS TOO LONG! Bailing to avoid cutting off request.')
-            exit(1)
+    Returns:
+        - How many samples had more than one run.
+    """
+    multiple_runs = 0
+    for done, entry in enumerate(entries):
+        if done % 100 == 0:
+            print(f'   {done} of {len(entries)} cached batches replayed.')
+        with connection.transaction():
+            for chunks in ncbi.ResponseCache.read_pages(entry):
+                multiple_runs += _record_data(ncbi.parse_efetch(chunks), connection, verbose)
+    return multiple_runs
 
-        try:
-            req = requests.get(url, timeout=config.timeout)
-        except ReadTimeoutError as e:
-            # It's not an issue to skip arbitrary attempts because the samples aren't
-            # being evaluated in a particular order. If 80 samples are skipped, they'll
-            # be picked up in subsequent runs
-            print('Timeout sending request. Skipping.')
-            if error_previous:
-                print('Two errors in a row. Bailing.')
-                exit(1)
-            error_previous = True
-            continue
+def _fetch_runs(client, batch, verbose=False, cache=None):
+    """
+    Looks up run information for a single batch of samples. Runs in a
+    worker thread, so it doesn't touch the database.
+
+    The whole batch of accessions is sent to esearch in the body of a POST
+    request, which stores the matching records on NCBI's history server.
+    The records are then retrieved with efetch, one page of
+    config.efetch_page_size records at a time, so the number of samples in
+    a batch isn't limited by how long a URL can be.
+
+    If a cache is given, each page is also saved to it as it downloads,
+    and a batch that's already cached is read from disk instead.
 
+    Inputs:
+        - client: An instance of ncbi.Client
+        - batch: A list of SRS accessions
+        - cache: An instance of ncbi.ResponseCache, or None
+    Returns:
+        - A list with one entry for each page of efetch results, each a
+            list of ncbi.RunRecord. None if a response was unusable.
+    Raises:
+        - ncbi.RequestFailed, if a request still fails after retries.
+    """
+    if cache is not None:
+        entry = cache.lookup(batch)
+        if entry is not None:
+            return [list(ncbi.parse_efetch(chunks)) for chunks in cache.read_pages(entry)]
+
+    if verbose:
+        print('Next request')
+
+    term = ' or '.join([f'{srs}[accn]' for srs in batch])
+    req = client.eutils('esearch', db='sra', usehistory='y', retmax=0, term=term)
+    try:
+        tree = ET.fromstring(req.text)
+    except ET.ParseError:
+        print(f'ERROR: Couldnt parse response retrieving webenv data: {req.text}')
+        print('Skipping.')
+        return None
+
+    webenv = tree.find('WebEnv')
+    query_key = tree.find('QueryKey')
+    found = tree.find('Count')
+    if webenv is None or query_key is None or found is None:
+        print('\n---------\n')
+        print(req.text)
+        print("WARNING: Got response without a 'webenv' field. Skipping.")
+        return None
+
+    page_size = getattr(config, 'efetch_page_size', 500)
+    pages = []
+    for retstart in range(0, int(found.text), page_size):
+        req = client.eutils('efetch', stream=True, db='sra', WebEnv=webenv.text,
+            query_key=query_key.text, retstart=retstart, retmax=page_size)
+        # The response is parsed as it downloads; only the handful of
+        # fields we save from each package are kept
+        chunks = req.iter_content(chunk_size=65536)
+        if cache is not None:
+            chunks = cache.save_page(batch, retstart, chunks)
         try:
-            tree = ET.fromstring(req.text)
+            pages.append(list(ncbi.parse_efetch(chunks)))
         except ET.ParseError:
             print("WARNING: Misformed response from call to eFetch. Skipping.")
-            if error_previous:
-                print('Two errors in a row. Bailing.')
-                exit(1)
-            error_previous = True
-            continue
-        multiple_runs += _record_data(tree, verbose)
-        error_previous = False
-
-    print(f"\n\nTOTAL SAMPLES WITH MULTIPLE RUNS: {multiple_runs}.\n\n")
+            return None
+        except requests.exceptions.RequestException as ex:
+            print(f'WARNING: Connection problem while reading eFetch response: {ex}. Skipping.')
+            return None
+        finally:
+            req.close()
+    if cache is not None:
+        cache.finish(batch)
+    return pages
+
+# Applied once per efetch response to every sample found in it. Fields that
+# weren't in the response are passed as NULL, which leaves the current value
+# alone rather than overwriting it.
+RUN_UPSERT = """
+    UPDATE samples
+    SET srr=?,
+        project=COALESCE(?, project),
+        library_strategy=COALESCE(?, library_strategy),
+        library_source=COALESCE(?, library_source),
+        pubdate=COALESCE(?, pubdate),
+        total_bases=COALESCE(?, total_bases),
+        instrument=COALESCE(?, instrument)
+    WHERE srs=?
+"""
 
-def _record_data(data, verbose=False):
-    """Parses a response from the efetch endpoint that has info about
-    all the samples in the query."""
-    connection = Connection()
+def _record_data(records, connection, verbose=False):
+    """Saves the information about samples parsed out of a response from
+    the efetch endpoint with a single batched update.
 
+    Inputs:
+        - records: An iterable of ncbi.RunRecord, one per EXPERIMENT_PACKAGE
+        - connection: An instance of type db.Connection
+    Returns:
+        - How many samples had more than one run.
+    """
     multiple_runs = 0
+    staged = {} # sample -> parameters for RUN_UPSERT
 
-    for package in data.findall('EXPERIMENT_PACKAGE'):
-        sample = None
-        tosave = {'run': []}
-
-        for entry in package.iter('SAMPLE'):
-            if 'accession' in entry.attrib.keys():
-                sample = entry.attrib['accession']
-        for entry in package.iter('RUN'):
-            if 'accession' in entry.attrib.keys():
-                tosave['run'].append(entry.attrib['accession'])
-            if 'published' in entry.attrib.keys():
-                tosave['pubdate'] = entry.attrib['published']
-            if 'total_bases' in entry.attrib.keys():
-                tosave['total_bases'] = entry.attrib['total_bases']
-        for entry in package.iter('EXTERNAL_ID'):
-            if 'namespace' in entry.attrib.keys():
-                if entry.attrib['namespace'] == 'BioProject':
-                    tosave['project'] = entry.text
-                    break
-        for entry in package.iter('LIBRARY_STRATEGY'):
-            tosave['library_strategy'] = entry.text
-        for entry in package.iter('LIBRARY_SOURCE'):
-            tosave['library_source'] = entry.text
-        for entry in package.iter('INSTRUMENT_MODEL'):
-            tosave['instrument'] = entry.text
-
-        # If we found multiple runs, combine them into a single string
-        if len(tosave['run']) == 0:
-            tosave['run'] = None
-        elif len(tosave['run']) == 1:
-            tosave['run'] = tosave['run'][0]
-        else:
-            if verbose:
-                print(f"MULTIPLE RUNS! {len(tosave['run'])}")
-            multiple_runs += 1
-            delim = ';'
-            tosave['run'] = delim.join(tosave['run'])
-
+    for record in records:
         # If there is no SRA run identified, SKIP this entry.
         # Sometimes a sample will have multiple entries, one with
         # a run (and lots of metadata) and another without any info
         # but DIFFERENT metadata. We only want ones that have a run.
-        if tosave.get('run') is None:
+        if len(record.runs) == 0:
             continue
-
-        towrite = """
-            UPDATE samples
-            SET srr=?, """
-        toparam = [tosave.get('run')]
-
-        if tosave.get('project') is not None:
-            towrite += 'project=?, '
-            toparam.append(tosave.get('project'))
-        if tosave.get('library_strategy') is not None:
-            towrite += 'library_strategy=?, '
-            toparam.append(tosave.get('library_strategy'))
-        if tosave.get('library_source') is not None:
-            towrite += 'library_source=?, '
-            toparam.append(tosave.get('library_source'))
-        if tosave.get('pubdate') is not None:
-            towrite += 'pubdate=?, '
-            toparam.append(tosave.get('pubdate'))
-        if tosave.get('total_bases') is not None:
-            towrite += 'total_bases=?, '
-            toparam.append(tosave.get('total_bases'))
-        if tosave.get('instrument') is not None:
-            towrite += 'instrument=?, '
-            toparam.append(tosave.get('instrument'))
-
-        towrite = towrite[:-2] # chop off final comma and space
-        towrite += """
-            WHERE srs=?"""
-        toparam.append(sample)
-        toparam = tuple(toparam)
-
-        connection.write(towrite, toparam)
+        # If we found multiple runs, combine them into a single string
+        if len(record.runs) > 1:
+            if verbose:
+                print(f"MULTIPLE RUNS! {len(record.runs)}")
+            multiple_runs += 1
+        fields = (
+            ';'.join(record.runs), record.project,
+            record.library_strategy, record.library_source,
+            record.pubdate, record.total_bases,
+            record.instrument, record.sample
+        )
+        # A sample in more than one package ends up with the same values as
+        # if each package were saved in turn: a later package's fields win,
+        # except where they're missing.
+        if record.sample in staged:
+            fields = tuple(new if new is not None else old
+                for new, old in zip(fields, staged[record.sample]))
+        staged[record.sample] = fields
+
+    if len(staged) > 0:
+        connection.write(RUN_UPSERT, list(staged.values()))
     return multiple_runs
 
-def find_asv_data(count=25):
+def find_asv_data(count=25, workers=None):
     """
     Runs a heuristic process for inferring which hypervariable regions were
-    targeted in an amplicon sequencing project
+    targeted in an amplicon sequencing project. Projects are evaluated in
+    parallel by a pool of worker processes; this process does all of the
+    reading from and writing to the database.
 
     Inputs:
         - count: int. The upper limit for how many projects to evaluate in total.
+        - workers: int. How many projects to evaluate at once. Defaults to
+            config.asv_workers.
     """
+    if workers is None:
+        workers = getattr(config, 'asv_workers', 1)
     connection = Connection()
 
     todo = connection.read("""
@@ -491,26 +1147,111 @@ def find_asv_data(count=25):
     )
 
     todo = [x[0] for x in todo] # each ID is nested inside a tuple of length 1
-    print(f'Found {len(todo)} projects to evaluate')
-    cursor = 0
-    while cursor < len(todo):
-        if cursor % 50 == 0:
-            print(f'COMPLETE: {cursor}')
-
-        proj = todo[cursor]
+    print(f'Found {len(todo)} projects to evaluate using {workers} workers')
 
+    def load(proj):
         data = connection.read("""
             SELECT seq
             FROM asv_sequences
             WHERE project=?
         """, (proj,))
-
         asvs = [x[0] for x in data]
         print(f'{proj}: Found {len(asvs)} ASVs to classify.')
-        results = amplicon.process_project(asvs)
-        print(f'  {results[0]}, {results[1]}')
-        connection.write(
-            'INSERT INTO asv_inference (project, region, length) VALUES (?,?,?)',
+        return asvs
+
+    done = 0
+    for proj, results in _infer_regions(todo, load, workers):
+        if done % 50 == 0:
+            print(f'COMPLETE: {done}')
+        done += 1
+        if results is None:
+            continue
+        print(f'  {proj}: {results[0]}, {results[1]}')
+        connection.queue(
+            'INSERT OR REPLACE INTO asv_inference (project, region, length) VALUES (?,?,?)',
             (proj, results[0], results[1])
         )
-        cursor += 1
+        # save every so often, so a crash doesn't lose everything
+        if done % 50 == 0:
+            connection.flush()
+    connection.flush()
+
+def benchmark_alignment(count=1000):
+    """
+    Compares the two ways of placing ASVs on the 16S gene (see
+    amplicon.benchmark) using a random selection of ASVs from the database,
+    and prints how often they agree and how long each took.
+
+    Inputs:
+        - count: int. How many ASVs to use.
+    """
+    connection = Connection()
+    asvs = connection.read("""
+        SELECT seq FROM sequences
+        WHERE seq IS NOT NULL
+        ORDER BY RANDOM()
+        LIMIT ?""", (count,)
+    )
+    asvs = [x[0] for x in asvs]
+    if len(asvs) == 0:
+        print('No ASVs found in the database.')
+        return
+    print(f'Placing {len(asvs)} ASVs...')
+    results = amplicon.benchmark(asvs)
+    print(f'Placed by k-mers alone: {results["placed"]:.1%}')
+    print(f'Regions in agreement with Smith-Waterman: {results["agreement"]:.1%}')
+    print(f'Smith-Waterman: {results["ssw_seconds"]:.2f} seconds')
+    print(f'With k-mer prefilter: {results["prefilter_seconds"]:.2f} seconds')
+    if results['speedup'] is not None:
+        print(f'Speedup: {results["speedup"]:.1f}x')
+
+def _infer_regions(todo, load, workers):
+    """
+    Runs amplicon.process_project on a list of projects, either here (one
+    worker) or in a pool of processes. A few more projects than there are
+    workers are kept waiting, so only those projects' ASVs are in memory.
+
+    Inputs:
+        - todo: list. The IDs of the projects to evaluate.
+        - load: function. Given a project ID, returns a list of its ASVs.
+        - workers: int. How many processes to use.
+    Yields:
+        - A tuple: a project ID and what process_project returned for it, or
+            None if it failed. Projects aren't necessarily returned in the
+            order they were given.
+    """
+    if workers <= 1:
+        for proj in todo:
+            yield proj, _infer_region(proj, load(proj))
+        return
+
+    remaining = iter(todo)
+    pending = {}
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            while len(pending) < workers * 2:
+                proj = next(remaining, None)
+                if proj is None:
+                    break
+                pending[pool.submit(_infer_region, proj, load(proj))] = proj
+            if len(pending) == 0:
+                return
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                proj = pending.pop(future)
+                try:
+                    yield proj, future.result()
+                except Exception as e: # the worker process itself died
+                    print(f'{proj}: Evaluation failed: {e}')
+                    yield proj, None
+
+def _infer_region(proj, asvs):
+    """
+    Evaluates one project, in a worker process. Errors are reported
+    here, so one bad project doesn't stop the others.
+    """
+    try:
+        return amplicon.process_project(asvs)
+    except Exception as e:
+        print(f'{proj}: Evaluation failed: {e}')
+        return None
@@ -0,0 +1,203 @@
+"""
+This module writes the compendium's results out of the database in formats
+better suited to analyzing all of it at once: Parquet files (one table per
+directory) and a sparse sample-by-ASV count matrix in an HDF5 file. Both are
+written one project at a time, so the full matrix is never held in memory.
+"""
+import os
+
+import h5py
+import numpy
+import pandas
+import pyarrow
+import pyarrow.parquet
+
+import config
+
+FORMATS = ['parquet', 'hdf5']
+
+def export(connection, path, formats=None):
+    """
+    Writes the results in the database to files in a directory.
+
+    Inputs:
+        - connection: A db.Connection object.
+        - path: string. The directory to write to. Created if it doesn't exist.
+        - formats: list of strings. Which of FORMATS to write. Defaults to all.
+    """
+    if formats is None:
+        formats = FORMATS
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise Exception(f'Unrecognized export format "{fmt}". Options are: {", ".join(FORMATS)}')
+    os.makedirs(path, exist_ok=True)
+
+    if 'parquet' in formats:
+        export_parquet(connection, f'{path}/parquet')
+    if 'hdf5' in formats:
+        export_hdf5(connection, f'{path}/counts.h5')
+
+def _projects(connection):
+    """Returns the IDs of all projects with results in the database."""
+    projects = connection.read('SELECT DISTINCT project FROM result_samples ORDER BY project')
+    return [x[0] for x in projects] # each ID is nested inside a tuple of length 1
+
+def export_parquet(connection, path, chunksize=None):
+    """
+    Writes the counts, sequences, taxonomic assignments and sample metadata
+    to directories of Parquet files. Counts and sequences are partitioned by
+    project ("asv_counts/project=PRJNA123/part-0.parquet"); the other tables
+    are split into files of chunksize rows. Any of these directories can be
+    read as one table by pyarrow, pandas, Spark, etc.
+
+    Inputs:
+        - connection: A db.Connection object.
+        - path: string. The directory to write to.
+        - chunksize: int. How many rows of the unpartitioned tables to put
+            in each file. Defaults to config.export_chunk_size.
+    """
+    if chunksize is None:
+        chunksize = getattr(config, 'export_chunk_size', 500000)
+
+    projects = _projects(connection)
+    print(f'Exporting counts and sequences for {len(projects)} projects.')
+    for i, project in enumerate(projects):
+        if i % 100 == 0:
+            print(f'COMPLETE: {i}')
+        counts = pandas.read_sql("""
+            SELECT sample, asv, asv_id, count
+            FROM asv_counts
+            WHERE project=?
+        """, connection.db, params=(project,))
+        _write_part(counts, f'{path}/asv_counts/project={project}', 0,
+            _schema(connection, 'asv_counts', counts.columns))
+
+        seqs = pandas.read_sql("""
+            SELECT asv_id, asv, seq
+            FROM asv_sequences
+            WHERE project=?
+        """, connection.db, params=(project,))
+        _write_part(seqs, f'{path}/asv_sequences/project={project}', 0,
+            _schema(connection, 'asv_sequences', seqs.columns))
+
+    for table in ['asv_assignments', 'samples']:
+        print(f'Exporting {table}.')
+        schema = _schema(connection, table)
+        reader = pandas.read_sql(f'SELECT * FROM {table}', connection.db, chunksize=chunksize)
+        for part, chunk in enumerate(reader):
+            _write_part(chunk, f'{path}/{table}', part, schema)
+
+def _schema(connection, table, columns=None):
+    """
+    Builds the Parquet schema for a table or view from the column types
+    declared in the database. Every file written from the same table uses
+    it, so they can be read together, even if a column is entirely empty
+    (or has some empty cells) in one file but not another.
+
+    Inputs:
+        - connection: A db.Connection object.
+        - table: string. The name of the table or view.
+        - columns: list of strings. Which columns to include, in order.
+            Defaults to all of them.
+    Returns:
+        - A pyarrow.Schema
+    """
+    declared = {x[1]: x[2].upper() for x in connection.read(f'PRAGMA table_info({table})')}
+    if columns is None:
+        columns = list(declared.keys())
+    fields = []
+    for column in columns:
+        # same rules SQLite uses to decide a column's type affinity. Columns
+        # without a declared type (calculated ones in views) are text.
+        kind = declared[column]
+        if 'INT' in kind:
+            fields.append((column, pyarrow.int64()))
+        elif 'REAL' in kind or 'FLOA' in kind or 'DOUB' in kind:
+            fields.append((column, pyarrow.float64()))
+        else:
+            fields.append((column, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+def _write_part(frame, path, part, schema):
+    """Writes one Parquet file into a (possibly new) directory."""
+    os.makedirs(path, exist_ok=True)
+    table = pyarrow.Table.from_pandas(frame, schema=schema, preserve_index=False)
+    pyarrow.parquet.write_table(table, f'{path}/part-{part}.parquet')
+
+def export_hdf5(connection, path):
+    """
+    Writes the read counts to an HDF5 file as one sparse matrix, with a row
+    for each sample and a column for each ASV sequence, stored in compressed
+    sparse row (CSR) form:
+        - counts/data: the nonzero counts
+        - counts/indices: the column of each count
+        - counts/indptr: where each row starts in data and indices
+        - samples, projects: the name and project of each row
+        - asv_ids: the asv_id (in the sequences table) of each column
+    The shape of the matrix is stored in the "shape" attribute of "counts".
+    Rows are appended one project at a time.
+
+    Inputs:
+        - connection: A db.Connection object.
+        - path: string. The file to write. Overwritten if it already exists.
+    """
+    asv_ids = connection.read('SELECT asv_id FROM sequences ORDER BY asv_id')
+    asv_ids = numpy.array([x[0] for x in asv_ids], dtype=numpy.int64)
+    projects = _projects(connection)
+    print(f'Exporting count matrix for {len(projects)} projects and {len(asv_ids)} ASVs.')
+
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('asv_ids', data=asv_ids)
+        counts = file.create_group('counts')
+        data = _appendable(counts, 'data', numpy.int64)
+        indices = _appendable(counts, 'indices', numpy.int64)
+        indptr = _appendable(counts, 'indptr', numpy.int64)
+        _append(indptr, numpy.zeros(1, dtype=numpy.int64))
+        total = 0 # entries written so far
+        samples = _appendable(file, 'samples', h5py.string_dtype())
+        sample_projects = _appendable(file, 'projects', h5py.string_dtype())
+
+        for i, project in enumerate(projects):
+            if i % 100 == 0:
+                print(f'COMPLETE: {i}')
+            rows = connection.read("""
+                SELECT sample_id, sample FROM result_samples
+                WHERE project=?
+                ORDER BY sample_id
+            """, (project,))
+            sample_ids = numpy.array([x[0] for x in rows], dtype=numpy.int64)
+            entries = connection.read("""
+                SELECT c.sample_id, c.asv_id, c.count
+                FROM sample_asv_counts c
+                INNER JOIN result_samples rs ON c.sample_id=rs.sample_id
+                WHERE rs.project=?
+                ORDER BY c.sample_id, c.asv_id
+            """, (project,))
+            entries = numpy.array(entries, dtype=numpy.int64).reshape(-1, 3)
+
+            # how many entries are in each row, turned into where each row ends
+            row_sizes = numpy.bincount(
+                numpy.searchsorted(sample_ids, entries[:, 0]),
+                minlength=len(sample_ids)
+            )
+            _append(indptr, total + numpy.cumsum(row_sizes))
+            total += len(entries)
+            _append(indices, numpy.searchsorted(asv_ids, entries[:, 1]))
+            _append(data, entries[:, 2])
+            _append(samples, [x[1] for x in rows])
+            _append(sample_projects, [project] * len(rows))
+
+        counts.attrs['shape'] = (len(samples), len(asv_ids))
+
+def _appendable(group, name, dtype):
+    """Creates an empty, one-dimensional HDF5 dataset that can grow."""
+    return group.create_dataset(name, shape=(0,), maxshape=(None,),
+        dtype=dtype, chunks=True, compression='gzip')
+
+def _append(dataset, values):
+    """Adds values to the end of a dataset made by _appendable()."""
+    if len(values) == 0:
+        return
+    start = dataset.shape[0]
+    dataset.resize((start + len(values),))
+    dataset[start:] = values
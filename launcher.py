@@ -0,0 +1,325 @@
+"""
+This module decides which projects to start next. Rather than keeping a
+fixed number of projects in progress, it budgets by how much work they
+are: the number of bases sequenced across each project's samples (the
+total_bases recorded for each sample). That way many small projects can
+run at once, but a handful of large ones can't take over the cluster.
+
+The order in which waiting projects are started is set by
+config.launch_policy:
+    - shortest: the least work first, so small projects aren't stuck
+        waiting behind large ones
+    - fair: taxa (see samples.taxon) take turns. The next project comes
+        from whichever taxon has had the least work started so far, and
+        the least work first within each taxon.
+    - age: the earliest published first
+    - random: no particular order
+"""
+import heapq
+import random
+import time
+
+import config
+
+POLICIES = ['shortest', 'fair', 'age', 'random']
+
+# How many bases to assume for a sample without a total_bases, if none of
+# the other samples have one either
+DEFAULT_SAMPLE_BASES = 25000000
+
+class Candidate:
+    """
+    A project and an estimate of how much work it is to process.
+    """
+    def __init__(self, pid, taxon, samples, bases, pubdate):
+        self.id = pid
+        self.taxon = taxon
+        self.samples = samples
+        self.bases = bases # estimated; see _project_work()
+        self.pubdate = pubdate
+
+    def __repr__(self):
+        return f'{self.id} ({self.samples} samples, {self.bases/1e9:.1f} Gb)'
+
+def _project_work(connection, where='', params=(), having='', sample_bases=None, values=None):
+    """
+    Estimates how much work each of a set of projects is. Samples without
+    a total_bases are assumed to be the same size as the project's other
+    samples, or, if none of them have one, sample_bases.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - where: string. Conditions on the samples to count, added to the
+            ones find_todo has always used to pick out amplicon samples.
+        - params: The parameters for the where and having clauses.
+        - having: string. Conditions on the projects.
+        - sample_bases: int. See above. Defaults to the average across all
+            samples (see _bases_per_sample()).
+        - values: list. If the where clause matches against a list of
+            values ("IN ({values})"), the values; see db.Connection.read_in().
+    Returns:
+        - A list of Candidate objects.
+    """
+    if sample_bases is None:
+        sample_bases = _bases_per_sample(connection)
+    query = f"""
+        SELECT project, MIN(taxon), COUNT(srr), SUM(total_bases),
+            COUNT(total_bases), MIN(pubdate)
+        FROM samples
+        WHERE srr IS NOT NULL
+            AND library_source IN ('GENOMIC','METAGENOMIC')
+            AND library_strategy='AMPLICON'
+            {where}
+        GROUP BY project
+        {having}
+    """
+    if values is not None:
+        rows = connection.read_in(query, values, params)
+    else:
+        rows = connection.read(query, params)
+    found = []
+    for pid, taxon, samples, bases, known, pubdate in rows:
+        per_sample = bases / known if known > 0 else sample_bases
+        estimate = (bases if bases is not None else 0) + (samples - known) * per_sample
+        found.append(Candidate(pid, taxon, samples, int(estimate), pubdate))
+    return found
+
+def _bases_per_sample(connection):
+    """Returns the average total_bases of the samples that have one."""
+    average = connection.read('SELECT AVG(total_bases) FROM samples WHERE total_bases IS NOT NULL')
+    if len(average) == 0 or average[0][0] is None:
+        return DEFAULT_SAMPLE_BASES
+    return average[0][0]
+
+def find_candidates(connection, min_samples=None, max_samples=None, sample_bases=None):
+    """
+    Finds the projects that haven't been started yet.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - min_samples, max_samples: int. How many samples a project must
+            have to be considered. Default to config.launch_min_samples
+            and config.launch_max_samples.
+        - sample_bases: int. See _project_work().
+    Returns:
+        - A list of Candidate objects, in no particular order.
+    """
+    if min_samples is None:
+        min_samples = getattr(config, 'launch_min_samples', 50)
+    if max_samples is None:
+        max_samples = getattr(config, 'launch_max_samples', 1000)
+    return _project_work(connection,
+        where='AND project NOT IN (SELECT project FROM status)',
+        having='HAVING COUNT(srr) >= ? AND COUNT(srr) <= ?',
+        params=(min_samples, max_samples), sample_bases=sample_bases)
+
+def work_of(connection, pids, sample_bases=None):
+    """
+    Estimates how much work each of a list of projects is.
+
+    Returns:
+        - A dict with the estimated number of bases for each project ID.
+            Projects without any samples are left out.
+    """
+    found = _project_work(connection, 'AND project IN ({values})',
+        sample_bases=sample_bases, values=pids)
+    return {x.id: x.bases for x in found}
+
+def taxon_usage(connection, sample_bases=None):
+    """
+    Adds up the work of every project that's ever been started (that is,
+    every project in the status table), by taxon.
+
+    Returns:
+        - A dict with the estimated number of bases for each taxon.
+    """
+    usage = {}
+    for found in _project_work(connection, 'AND project IN (SELECT project FROM status)',
+            sample_bases=sample_bases):
+        usage[found.taxon] = usage.get(found.taxon, 0) + found.bases
+    return usage
+
+def order(candidates, policy, usage=None, seed=None):
+    """
+    Puts the projects waiting to be started in the order they should be
+    started.
+
+    Inputs:
+        - candidates: list of Candidate objects.
+        - policy: string. One of POLICIES; see the top of this module.
+        - usage: dict. For the "fair" policy, how much work has already
+            been started for each taxon; see taxon_usage().
+        - seed: For the "random" policy, the seed for the random order.
+    Returns:
+        - A new list of the Candidate objects.
+    """
+    if policy not in POLICIES:
+        raise Exception(f'Unrecognized launch_policy "{policy}". Options are: {", ".join(POLICIES)}')
+    if policy == 'shortest':
+        return sorted(candidates, key=lambda x: (x.bases, x.id))
+    if policy == 'age':
+        # projects without a publication date go last
+        return sorted(candidates, key=lambda x: (x.pubdate is None, x.pubdate or '', x.bases, x.id))
+    if policy == 'random':
+        shuffled = sorted(candidates, key=lambda x: x.id)
+        random.Random(seed).shuffle(shuffled)
+        return shuffled
+
+    # fair: each taxon's projects, smallest first, taken from whichever
+    # taxon has had the least work started so far
+    if usage is None:
+        usage = {}
+    by_taxon = {}
+    for candidate in sorted(candidates, key=lambda x: (x.bases, x.id), reverse=True):
+        by_taxon.setdefault(candidate.taxon, []).append(candidate) # popped from the end
+    # taxa are compared as strings so a missing taxon doesn't break the tie
+    heap = [(usage.get(taxon, 0), str(taxon), taxon) for taxon in by_taxon]
+    heapq.heapify(heap)
+    ordered = []
+    while len(heap) > 0:
+        used, key, taxon = heapq.heappop(heap)
+        candidate = by_taxon[taxon].pop()
+        ordered.append(candidate)
+        if len(by_taxon[taxon]) > 0:
+            heapq.heappush(heap, (used + candidate.bases, key, taxon))
+    return ordered
+
+def plan(queue, active_work, budget, slots):
+    """
+    Picks projects to start from the front of the queue, skipping any
+    that would put the work in progress over the budget. A project that's
+    bigger than the whole budget is only started when nothing else is in
+    progress, so it doesn't wait forever.
+
+    Inputs:
+        - queue: list of Candidate objects, in order (see order()).
+        - active_work: int. The estimated bases of the projects already in
+            progress.
+        - budget: int. How many bases can be in progress at once.
+        - slots: int. The most projects that can be started.
+    Returns:
+        - A list of the Candidate objects to start.
+    """
+    started = []
+    for candidate in queue:
+        if len(started) >= slots:
+            break
+        if active_work + candidate.bases <= budget or active_work == 0:
+            started.append(candidate)
+            active_work += candidate.bases
+    return started
+
+def measure_throughput(connection, days=None, sample_bases=None):
+    """
+    Estimates how quickly projects are processed, from how many finished
+    recently: the work of the projects that finished after the first one
+    in the window, divided by the time between the first and last. When
+    a project finished is taken from project_state.done_at, which is set
+    by management.scan_projects.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - days: float. How far back to look. Defaults to
+            config.launch_throughput_days.
+        - sample_bases: int. See _project_work().
+    Returns:
+        - The estimated bases processed per hour, or None if fewer than
+            3 projects have finished in the window.
+    """
+    if days is None:
+        days = getattr(config, 'launch_throughput_days', 7)
+    since = time.time() - days * 86400
+    finished = connection.read("""
+        SELECT project, done_at FROM project_state
+        WHERE done_at >= ?
+        ORDER BY done_at
+    """, (since,))
+    if len(finished) < 3:
+        return None
+    hours = (finished[-1][1] - finished[0][1]) / 3600
+    if hours <= 0:
+        return None
+    work = work_of(connection, [x[0] for x in finished[1:]], sample_bases)
+    return sum(work.values()) / hours
+
+def next_projects(connection, active, policy=None, budget=None, slots=None, report=True):
+    """
+    Decides which projects to start, given the ones already in progress,
+    and prints how long it should take to get through all the projects
+    waiting to be started.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - active: list of strings. The IDs of the projects in progress.
+        - policy: string. One of POLICIES. Defaults to config.launch_policy.
+        - budget: float. How many gigabases of work can be in progress at
+            once. Defaults to config.launch_budget_gbases.
+        - slots: int. The most projects that can be in progress at once.
+            Defaults to config.max_projects.
+        - report: bool. Whether to print the expected drain time.
+    Returns:
+        - A list of the IDs of the projects to start.
+    """
+    if policy is None:
+        policy = getattr(config, 'launch_policy', 'shortest')
+    if budget is None:
+        budget = getattr(config, 'launch_budget_gbases', 100)
+    if slots is None:
+        slots = config.max_projects
+
+    sample_bases = _bases_per_sample(connection)
+    active_work = sum(work_of(connection, active, sample_bases).values())
+    queue = _queue(connection, policy, sample_bases)
+    chosen = plan(queue, active_work, budget * 1e9, slots - len(active))
+
+    if report:
+        print_drain_estimate(connection, len(active), active_work, queue, sample_bases)
+    return [x.id for x in chosen]
+
+def print_queue(connection, active, policy=None, count=20):
+    """
+    Prints the projects that would be started next, in order, and how long
+    it should take to get through all of them.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - active: list of strings. The IDs of the projects in progress.
+        - policy: string. One of POLICIES. Defaults to config.launch_policy.
+        - count: int. How many projects to list.
+    """
+    if policy is None:
+        policy = getattr(config, 'launch_policy', 'shortest')
+    sample_bases = _bases_per_sample(connection)
+    active_work = sum(work_of(connection, active, sample_bases).values())
+    queue = _queue(connection, policy, sample_bases)
+    print(f'Next {min(count, len(queue))} projects to start ({policy}):')
+    for candidate in queue[:count]:
+        print(f'   {candidate}')
+    print_drain_estimate(connection, len(active), active_work, queue, sample_bases)
+
+def _queue(connection, policy, sample_bases):
+    """Returns the projects waiting to be started, in order."""
+    candidates = find_candidates(connection, sample_bases=sample_bases)
+    usage = taxon_usage(connection, sample_bases) if policy == 'fair' else None
+    return order(candidates, policy, usage)
+
+def print_drain_estimate(connection, active_count, active_work, queue, sample_bases=None):
+    """
+    Prints how much work is in progress and waiting, and how long it
+    should take to finish at the rate projects have been finishing
+    recently (see measure_throughput()), or at config.launch_throughput_gbases
+    if there isn't enough history.
+    """
+    queued_work = sum([x.bases for x in queue])
+    print(f'In progress: {active_count} projects, {active_work/1e9:.1f} Gb. Waiting: {len(queue)} projects, {queued_work/1e9:.1f} Gb.')
+
+    rate = measure_throughput(connection, sample_bases=sample_bases)
+    source = f'over the last {getattr(config, "launch_throughput_days", 7)} days'
+    if rate is None:
+        rate = getattr(config, 'launch_throughput_gbases', 10) * 1e9
+        source = 'from launch_throughput_gbases in config.py'
+    if rate <= 0:
+        print('Not enough is known about throughput to estimate when the queue will be done.')
+        return
+    hours = (active_work + queued_work) / rate
+    print(f'At {rate/1e9:.1f} Gb per hour ({source}), everything should be done in about {hours/24:.1f} days ({hours:.0f} hours).')
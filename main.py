@@ -4,13 +4,14 @@ database containing microbial ecology data from human microbiome
 samples.
 """
 
-from datetime import datetime
 import sys # for the command-line params
 
-import config
 import db
+import export
+import launcher
 import projects
 import management
+import watcher
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -19,9 +20,13 @@ if __name__ == "__main__":
     # only command-line param is how many to do in this session
     if sys.argv[1] == 'runs':
         TODO = 2000 if len(sys.argv) < 3 else sys.argv[2]
-        db.find_runs(TODO, per_query=80)
+        db.find_runs(TODO)
+    elif sys.argv[1] == 'replay':
+        db.replay_cache()
     elif sys.argv[1] == 'asvs':
-        db.find_asv_data(100)
+        TODO = 100 if len(sys.argv) < 3 else int(sys.argv[2])
+        WORKERS = None if len(sys.argv) < 4 else int(sys.argv[3])
+        db.find_asv_data(TODO, WORKERS)
     elif sys.argv[1] == 'xml':
         if len(sys.argv) < 4:
             print('The "xml" command requires two parameters: a taxon ID (e.g. txid408170) and the name of the file.')
@@ -76,7 +81,9 @@ if __name__ == "__main__":
             exit(1)
         PID = sys.argv[2]
 
-        proj = projects.Project(PID)
+        connection = db.Connection()
+        management.scan_projects(connection, [PID])
+        proj = management.load_projects(connection, [PID])[0]
         if proj.check_if_done(): # true if it's complete
             proj.Load_results_summary()
             proj.print_errors()
@@ -98,6 +105,18 @@ if __name__ == "__main__":
 
         connection = db.Connection()
         proj.REACT(connection)
+    elif sys.argv[1] == 'export':
+        if len(sys.argv) < 3:
+            print('The "export" command requires a directory to write to.')
+            exit(1)
+        FORMATS = None if len(sys.argv) < 4 else sys.argv[3].split(',')
+        connection = db.Connection()
+        export.export(connection, sys.argv[2], FORMATS)
+    elif sys.argv[1] == 'benchmark':
+        TODO = 1000 if len(sys.argv) < 3 else int(sys.argv[2])
+        db.benchmark_alignment(TODO)
+    elif sys.argv[1] == 'rollups':
+        db.rebuild_rollups()
     elif sys.argv[1] == 'compendium':
         connection = db.Connection()
         management.print_compendium_summary(connection)
@@ -119,16 +138,12 @@ if __name__ == "__main__":
 
         # Trigger new jobs automatically
         done, running, not_done = current # just unpacking
-        TOSTART = config.max_projects-len(running+not_done)
-
-        todo = []
-        if TOSTART > 0:
-            todo = management.find_todo(connection, needed=TOSTART, max_samples=1000)
-
-        now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        print(f'{now}: {len(running+not_done)} projects running. Starting {len(todo)} additional projects: {todo}')
-        for pid in todo:
-            print(f'Launching {pid}')
-            proj = projects.Project(pid)
-            proj.initialize_pipeline(connection)
-            proj.RUN(connection)
+        management.launch_projects(connection, running + not_done)
+    elif sys.argv[1] == 'queue':
+        connection = db.Connection()
+        done, running, not_done = management.determine_projects(connection)
+        policy = None if len(sys.argv) < 3 else sys.argv[2]
+        launcher.print_queue(connection, [x.id for x in running + not_done], policy)
+    elif sys.argv[1] == 'watch':
+        connection = db.Connection()
+        watcher.run(connection)
@@ -3,15 +3,39 @@ This module deals with automation of project-level operations that
 didn't fit with the "projects" module. Selecting which projects to process,
 for example.
 """
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import time
+import traceback
+
+import config
+import launcher
 import projects
+import scheduler
 
-def determine_projects(connection):
+def determine_projects(connection, rescan=True, jobs=None):
     """
     Fetches a list of projects without a terminal status and determines
     their current state. Returns 3 arrays of projects:
     1) done
     2) running
     3) not_done (neither done nor running)
+
+    A project is running if the scheduler says its job is still queued or
+    running. If the scheduler has no record of the job, the project is
+    running if its pipeline left a "running.txt" file. (The file is left
+    behind if the job is killed, so it's ignored if the scheduler says the
+    job is over.) A project isn't done until it has all its result files
+    AND it's no longer running.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - rescan: bool. Whether to check the projects' directories for
+            changes first (see scan_projects), rather than relying on
+            what's already in the project_state table.
+        - jobs: Where to look up the projects' jobs; see
+            scheduler.from_config(), which is the default.
     """
 
     todo = connection.read("""
@@ -23,21 +47,150 @@ def determine_projects(connection):
         exit(0)
 
     todo = [x[0] for x in todo]
+    if rescan:
+        scan_projects(connection, todo)
+    if jobs is None:
+        jobs = scheduler.from_config()
+    job_states = jobs.job_states(todo) if jobs is not None else {}
 
     done = []
     running = []
     not_done = [] # jobs that aren't done AND aren't running
-    for pid in todo:
-        proj = projects.Project(pid)
-        if proj.check_if_done():
+    for proj in load_projects(connection, todo):
+        proj.job_state = job_states.get(proj.id)
+        still_running = proj.job_state == 'running' or (proj.job_state is None and proj.running)
+        # (the result files may still be being written if the job is running)
+        if proj.checks & projects.DONE_MASK == projects.DONE_MASK and not still_running:
             done.append(proj)
+        elif still_running:
+            running.append(proj)
         else:
-            if proj.check_if_running():
-                running.append(proj)
-            else:
-                not_done.append(proj)
+            not_done.append(proj)
     return(done, running, not_done)
 
+def load_projects(connection, pids):
+    """
+    Creates a Project for each project ID, with its pipeline progress
+    loaded from the project_state table. Projects that have never been
+    scanned (see scan_projects) have their directories checked instead.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - pids: list of strings. The IDs of the projects.
+    Returns:
+        - A list of Project objects, in the same order as pids.
+    """
+    rows = connection.read_in("""
+        SELECT project, checks, running, stage_changed_at
+        FROM project_state
+        WHERE project IN ({values})
+    """, pids)
+    known = {x[0]: x[1:] for x in rows}
+
+    loaded = []
+    for pid in pids:
+        proj = projects.Project(pid)
+        if pid in known:
+            proj.checks, running, proj.stage_changed = known[pid]
+            proj.running = bool(running)
+        else:
+            proj.read_progress()
+        loaded.append(proj)
+    return loaded
+
+def scan_projects(connection, pids, workers=None):
+    """
+    Checks the directories of many projects at once for everything in
+    projects.PROGRESS_CHECKS, and saves the results in the project_state
+    table. Each directory involved is listed once (rather than checking
+    for each file), and several projects are checked at a time. Along with
+    the results, the modification time of each directory is saved; a project
+    whose directories haven't been modified since they were last listed
+    isn't listed again.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - pids: list of strings. The IDs of the projects to check.
+        - workers: int. How many projects to check at once. Defaults
+            to config.scan_workers.
+    Returns:
+        - A dict: for each project ID, a tuple of which checks passed (as a
+            bitmask, see projects.evaluate_progress) and whether it's running.
+    """
+    if workers is None:
+        workers = getattr(config, 'scan_workers', 16)
+    known = connection.read('SELECT project, mtimes, scanned_at, checks, running, stage, stage_changed_at, done_at FROM project_state')
+    known = {x[0]: x[1:] for x in known}
+
+    scanned_at = time.time()
+    with ThreadPoolExecutor(workers) as pool:
+        found = pool.map(lambda pid: _scan_directory(pid, known.get(pid)), pids)
+        found = dict(zip(pids, found))
+
+    states = {}
+    with connection.transaction():
+        for pid, state in found.items():
+            if state is None: # nothing has changed
+                states[pid] = (known[pid][2], bool(known[pid][3]))
+                continue
+            mtimes, checks, running = state
+            states[pid] = (checks, running)
+
+            stage = projects.progress_stage(checks)
+            stage_changed_at = scanned_at
+            if pid in known and known[pid][4] == stage:
+                stage_changed_at = known[pid][5]
+            # when the project was first seen with all its results and no
+            # longer running (cleared if that stops being true, e.g. if it's
+            # re-run)
+            done_at = None
+            if checks & projects.DONE_MASK == projects.DONE_MASK and not running:
+                done_at = scanned_at
+                if pid in known and known[pid][6] is not None:
+                    done_at = known[pid][6]
+            connection.queue("""
+                INSERT OR REPLACE INTO project_state
+                    (project, mtimes, scanned_at, checks, running, stage, stage_changed_at, done_at)
+                VALUES (?,?,?,?,?,?,?,?)
+            """, (pid, mtimes, scanned_at, checks, running, stage, stage_changed_at, done_at))
+    return states
+
+# The directories, within a project's directory, that are listed to check
+# its progress
+SCANNED_DIRECTORIES = sorted({check[2] for check in projects.PROGRESS_CHECKS if check[2] is not None})
+
+def _scan_directory(pid, known=None):
+    """
+    Checks one project's directories for everything in PROGRESS_CHECKS.
+    (Runs in a worker thread.)
+
+    Inputs:
+        - pid: string. The project ID, which is also its directory.
+        - known: tuple. What was recorded the last time the project was
+            scanned: the modification times of its directories, when it was
+            scanned (in seconds) and what was found.
+    Returns:
+        - None if nothing has changed; otherwise a tuple: the modification
+            times of the project's directories (in nanoseconds, separated by
+            colons), a bitmask of which checks passed and whether the project
+            is running.
+    """
+    mtimes = []
+    for directory in SCANNED_DIRECTORIES:
+        try:
+            mtimes.append(os.stat(f'{pid}/{directory}').st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            mtimes.append(None)
+    signature = ':'.join(str(x) for x in mtimes)
+    # Files added in the same instant as the last listing wouldn't change
+    # the modification time, so recent listings aren't trusted
+    newest = max([x for x in mtimes if x is not None], default=0)
+    if known is not None and known[0] == signature and newest / 1e9 < known[1] - 2:
+        return None
+
+    checks, running = projects.evaluate_progress(projects.list_progress(pid))
+    return (signature, checks, running)
+
 def print_projects_summary(done, running, not_done):
     """
     Helper function that prints out lists of BioProject IDs according
@@ -50,7 +203,7 @@ def print_projects_summary(done, running, not_done):
     [print(f'   {x}') for x in running]
 
     print('\n===INCOMPLETE:')
-    [print(f'   {x}') for x in not_done]
+    [print(f"   {x}{f' (job {x.job_state})' if x.job_state is not None else ''}") for x in not_done]
     print('\n===\n===\n')
 
 def advance_projects(done, running, not_done, connection, auto=False):
@@ -59,11 +212,21 @@ def advance_projects(done, running, not_done, connection, auto=False):
     and prompts the user to approve the actions. Projects that are still
     running, or that failed for unknown reasons, simply have their status
     printed.
+
+    If auto is set, a project that can't be evaluated (e.g. its results are
+    missing a file) has the error printed and is skipped, so the rest still
+    get processed; it's tried again the next time around.
     """
     for proj in done:
-        proj.Load_results_summary()
-        proj.print_errors()
-        proj.REACT(connection)
+        try:
+            proj.Load_results_summary()
+            proj.print_errors()
+            proj.REACT(connection)
+        except Exception:
+            if not auto:
+                raise
+            print(f'ERROR: Could not evaluate {proj}; skipping it for now.')
+            traceback.print_exc()
 
     # If this is part of an automated process, don't bother printing progress reports:
     if auto:
@@ -87,6 +250,31 @@ def advance_projects(done, running, not_done, connection, auto=False):
             exit(0)
         proj.Report_progress()
 
+def launch_projects(connection, active):
+    """
+    Starts new projects, in the order set by config.launch_policy, until
+    the projects in progress add up to config.launch_budget_gbases of
+    sequencing data or there are config.max_projects of them. See the
+    launcher module.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - active: list. The projects that are running or otherwise not
+            finished, which count toward the limits.
+    Returns:
+        - A list of the IDs of the projects that were started.
+    """
+    todo = launcher.next_projects(connection, [x.id for x in active])
+
+    now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    print(f'{now}: {len(active)} projects running. Starting {len(todo)} additional projects: {todo}')
+    for pid in todo:
+        print(f'Launching {pid}')
+        proj = projects.Project(pid)
+        proj.initialize_pipeline(connection)
+        proj.RUN(connection)
+    return todo
+
 def find_todo(connection, needed=1, min_samples=50, max_samples=10000):
     """
     Reviews the database for projects that have not yet been processed and returns
@@ -131,7 +319,7 @@ def print_compendium_summary(connection):
     """
 
     counts = connection.read("""
-        SELECT COUNT(DISTINCT project), COUNT(DISTINCT sample) FROM samples
+        SELECT COUNT(DISTINCT project), COUNT(DISTINCT srs) FROM samples
     """)
     if counts is None:
         print('No samples found in samples table.')
@@ -140,11 +328,11 @@ def print_compendium_summary(connection):
 
 
     counts = connection.read("""
-        SELECT COUNT(DISTINCT project), COUNT(DISTINCT sample)
-        FROM asv_counts
+        SELECT COUNT(DISTINCT project), COUNT(sample_id)
+        FROM result_samples
     """)
     if counts is None:
-        print('No projects found in asv_counts table.')
+        print('No projects found in result_samples table.')
         return()
     print(f'Results table contains:\n{counts[0][1]} samples from\n{counts[0][0]} projects.\n')
 
@@ -0,0 +1,420 @@
+"""
+This module handles communication with the NCBI eUtils API: keeping
+requests within NCBI's rate limits, retrying requests that fail, running
+batches of requests concurrently and caching the responses on disk.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import gzip
+import hashlib
+import os
+import random
+import shutil
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+def requests_per_second():
+    """
+    NCBI allows 10 requests per second from users with an API key,
+    and 3 per second from everyone else.
+    """
+    return 10 if config.Key else 3
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+# Responses that mean "try again later" rather than "this request is wrong"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class RequestFailed(Exception):
+    """Raised when a request still fails after every retry is used up."""
+    pass
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads making requests. Tokens are added
+    at a steady rate, up to a maximum of "burst" tokens; each request
+    spends one, waiting for a new one if the bucket is empty.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        Inputs:
+            - rate: float. How many requests are allowed per second.
+            - burst: int. How many requests can be sent back-to-back after
+                a quiet period. The default of 1 spaces every request
+                evenly, which is the safest way to stay under quota.
+        """
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed to be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class Client:
+    """
+    Sends requests to eUtils through a shared, rate-limited pool of
+    keep-alive HTTP connections, retrying failed requests and working on
+    several batches of requests at once.
+    """
+    def __init__(self, workers=None, rate=None, retries=None, backoff=1.0, max_backoff=60.0):
+        """
+        Inputs:
+            - workers: int. How many batches can be in flight at once.
+                Defaults to config.eutils_workers.
+            - rate: float. Requests per second across all workers. Defaults
+                to the limit NCBI allows, based on whether there's an API key.
+            - retries: int. How many times a single request is retried after
+                a timeout, connection error, 429 or 5xx response. Defaults to
+                config.eutils_retries.
+            - backoff: float. Seconds to wait before the first retry. The wait
+                doubles with each attempt (with random jitter) up to max_backoff.
+        """
+        self.workers = workers if workers is not None else getattr(config, 'eutils_workers', 4)
+        self.retries = retries if retries is not None else getattr(config, 'eutils_retries', 5)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(rate if rate is not None else requests_per_second())
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _wait(self, attempt, response=None):
+        """
+        Sleeps before retrying a request. Uses "full jitter": a random wait
+        between zero and the exponential backoff for this attempt, so that
+        workers that failed together don't all retry together. If NCBI sent
+        a Retry-After header, we wait at least that long.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass # it can also be an HTTP date, which isn't worth parsing
+        time.sleep(delay)
+
+    def eutils(self, endpoint, stream=False, **params):
+        """
+        Sends a request to one of the eUtils endpoints as an HTTP POST, so
+        there's no limit on how long the parameters (lists of IDs, for
+        example) can be. The tool name, contact email and API key from
+        the config file are added to every request.
+
+        Inputs:
+            - endpoint: The name of the utility, e.g. "esearch" or "efetch"
+            - stream: bool. If True, the response body is downloaded as it's
+                read (through response.iter_content) rather than all at once.
+            - params: Parameters for the request, e.g. db='sra'
+        Returns:
+            - The requests.Response object.
+        """
+        data = {'tool': config.Tool, 'email': config.Email}
+        if config.Key:
+            data['api_key'] = config.Key
+        data.update(params)
+        return self.post(f'{getattr(config, "eutils_url", EUTILS_URL)}{endpoint}.fcgi', data, stream)
+
+    def get(self, url):
+        """Sends a GET request. See _send()."""
+        return self._send('GET', url)
+
+    def post(self, url, data, stream=False):
+        """Sends a POST request with a form-encoded body. See _send()."""
+        return self._send('POST', url, data, stream)
+
+    def _send(self, method, url, data=None, stream=False):
+        """
+        Sends a request once the rate limiter allows it, retrying
+        with exponential backoff if it fails in transit (times out, can't
+        connect, the body is cut off, etc.) or gets a response indicating
+        NCBI is overloaded. (For streamed responses, only the request and
+        headers are covered by the retries; errors while reading the body
+        are up to the caller. See map().)
+
+        Returns:
+            - The requests.Response object.
+        Raises:
+            - RequestFailed, if every attempt failed.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.request(method, url, data=data, stream=stream, timeout=config.timeout)
+            except requests.exceptions.RequestException as ex:
+                problem = str(ex)
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                problem = f'HTTP {response.status_code}'
+                response.close()
+            if attempt < self.retries:
+                print(f'Request failed ({problem}). Retrying.')
+                self._wait(attempt, response)
+        raise RequestFailed(f'Request failed after {self.retries + 1} attempts: {problem}')
+
+    def map(self, func, batches, requeue=None):
+        """
+        Runs func(self, batch) for every batch on a pool of worker threads.
+        Results are yielded as soon as each batch finishes, which isn't
+        necessarily the order in which they were submitted, so the caller
+        can handle them (write them to the database, for example) in the
+        main thread while other batches are still in flight.
+
+        A batch for which func returns None or raises RequestFailed (or any
+        other error from requests, e.g. while reading a streamed response)
+        is sent to the back of the queue and tried again, up to "requeue"
+        times.
+
+        Inputs:
+            - requeue: int. Defaults to config.eutils_requeues.
+        Yields:
+            - A tuple: the batch, and whatever func returned for it (None if
+                it failed every time).
+        """
+        if requeue is None:
+            requeue = getattr(config, 'eutils_requeues', 2)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(func, self, batch): (batch, 0) for batch in batches}
+            while len(pending) > 0:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch, attempts = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except (RequestFailed, requests.exceptions.RequestException) as ex:
+                        print(f'ERROR: {ex}')
+                        result = None
+                    if result is None and attempts < requeue:
+                        print(f'Requeueing batch of {len(batch)}.')
+                        pending[pool.submit(func, self, batch)] = (batch, attempts + 1)
+                        continue
+                    yield batch, result
+
+# The fields we keep from each EXPERIMENT_PACKAGE in an efetch response
+RunRecord = namedtuple('RunRecord', [
+    'sample', 'runs', 'project', 'library_strategy', 'library_source',
+    'pubdate', 'total_bases', 'instrument'
+])
+
+def parse_efetch(chunks):
+    """
+    Streaming parser for the EXPERIMENT_PACKAGE_SET documents returned by
+    efetch from the SRA database. The document is parsed incrementally as
+    chunks of it arrive, and each EXPERIMENT_PACKAGE is discarded as soon
+    as the fields we need have been pulled out of it, so neither the full
+    response body nor its full tree is ever held in memory.
+
+    Inputs:
+        - chunks: An iterable of bytes, e.g. response.iter_content()
+    Yields:
+        - A RunRecord for each EXPERIMENT_PACKAGE.
+    Raises:
+        - xml.etree.ElementTree.ParseError, if the document is malformed.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+            elif elem.tag == 'EXPERIMENT_PACKAGE':
+                yield _summarize_package(elem)
+                elem.clear()
+                root.clear()
+    parser.close()
+
+def _summarize_package(package):
+    """
+    Pulls the fields for a RunRecord out of a single EXPERIMENT_PACKAGE
+    element, in a single pass through its descendants. Where a field
+    appears more than once, the last one wins, except for the BioProject ID,
+    where the first one does.
+    """
+    sample = None
+    runs = []
+    fields = {}
+    for entry in package.iter():
+        if entry.tag == 'SAMPLE':
+            if 'accession' in entry.attrib:
+                sample = entry.attrib['accession']
+        elif entry.tag == 'RUN':
+            if 'accession' in entry.attrib:
+                runs.append(entry.attrib['accession'])
+            if 'published' in entry.attrib:
+                fields['pubdate'] = entry.attrib['published']
+            if 'total_bases' in entry.attrib:
+                fields['total_bases'] = entry.attrib['total_bases']
+        elif entry.tag == 'EXTERNAL_ID':
+            if entry.attrib.get('namespace') == 'BioProject' and 'project' not in fields:
+                fields['project'] = entry.text
+        elif entry.tag == 'LIBRARY_STRATEGY':
+            fields['library_strategy'] = entry.text
+        elif entry.tag == 'LIBRARY_SOURCE':
+            fields['library_source'] = entry.text
+        elif entry.tag == 'INSTRUMENT_MODEL':
+            fields['instrument'] = entry.text
+
+    return RunRecord(sample, tuple(runs), fields.get('project'),
+        fields.get('library_strategy'), fields.get('library_source'),
+        fields.get('pubdate'), fields.get('total_bases'), fields.get('instrument'))
+
+class ResponseCache:
+    """
+    On-disk cache of raw efetch responses. Each batch of accessions gets its
+    own entry, a directory named for a hash of the (sorted) accessions,
+    which holds one gzipped file per page of results, the list of
+    accessions, and a marker file written once every page has been saved.
+    Entries without the marker are incomplete and are never used.
+
+    Entries older than ttl_days are ignored and eventually deleted, as
+    are the oldest entries once the cache grows past max_mb.
+    """
+    def __init__(self, path, ttl_days=30, max_mb=5000):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls):
+        """Returns the cache configured in config.py, or None if there isn't one."""
+        path = getattr(config, 'eutils_cache_path', None)
+        if path is None:
+            return None
+        return cls(path, getattr(config, 'eutils_cache_ttl_days', 30),
+            getattr(config, 'eutils_cache_max_mb', 5000))
+
+    def key(self, batch):
+        """The entry name for a batch: a hash of its accessions, in any order."""
+        return hashlib.sha256('\n'.join(sorted(batch)).encode('UTF-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _is_fresh(self, entry):
+        try:
+            return time.time() - os.path.getmtime(os.path.join(entry, 'complete')) < self.ttl
+        except OSError:
+            return False
+
+    def entries(self):
+        """Yields the directory of every complete, unexpired entry."""
+        for prefix in sorted(os.listdir(self.path)):
+            prefix = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix):
+                continue
+            for key in sorted(os.listdir(prefix)):
+                entry = os.path.join(prefix, key)
+                if self._is_fresh(entry):
+                    yield entry
+
+    def index(self):
+        """
+        Maps every accession in the cache to the directory of the entry
+        that covers it.
+        """
+        covered = {}
+        for entry in self.entries():
+            with open(os.path.join(entry, 'accessions.txt'), 'r', encoding='UTF-8') as file:
+                for line in file:
+                    covered[line[:-1]] = entry
+        return covered
+
+    def lookup(self, batch):
+        """Returns the directory of the entry for a batch, or None if there isn't a usable one."""
+        entry = self._entry(self.key(batch))
+        return entry if self._is_fresh(entry) else None
+
+    def save_page(self, batch, retstart, chunks):
+        """
+        Passes chunks of a response through unchanged while also writing them
+        to the batch's entry, so a response can be cached while it's being
+        parsed. The page only lands in the cache if every chunk is read.
+        """
+        entry = self._entry(self.key(batch))
+        os.makedirs(entry, exist_ok=True)
+        filename = os.path.join(entry, f'page_{retstart:09d}.xml.gz')
+        with gzip.open(f'{filename}.tmp', 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+        os.replace(f'{filename}.tmp', filename)
+
+    def finish(self, batch):
+        """Marks the entry for a batch as complete, once every page is saved."""
+        entry = self._entry(self.key(batch))
+        os.makedirs(entry, exist_ok=True)
+        with open(os.path.join(entry, 'accessions.txt'), 'w', encoding='UTF-8') as file:
+            for srs in batch:
+                file.write(f'{srs}\n')
+        with open(os.path.join(entry, 'complete'), 'w', encoding='UTF-8') as file:
+            file.write(f'{len(batch)}\n')
+
+    @staticmethod
+    def read_pages(entry, chunk_size=65536):
+        """
+        Yields, for each page saved in an entry, an iterator over chunks of
+        the uncompressed response. These can be handed directly to parse_efetch.
+        """
+        for page in sorted(os.listdir(entry)):
+            if not page.endswith('.xml.gz'):
+                continue
+            with gzip.open(os.path.join(entry, page), 'rb') as file:
+                yield iter(lambda: file.read(chunk_size), b'')
+
+    def evict(self):
+        """
+        Deletes expired and incomplete entries, then the oldest complete
+        entries until the cache is under its size limit.
+        """
+        entries = [] # (age marker, size, directory)
+        total = 0
+        for prefix in os.listdir(self.path):
+            prefix = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix):
+                continue
+            for key in os.listdir(prefix):
+                entry = os.path.join(prefix, key)
+                if not self._is_fresh(entry):
+                    # incomplete entries still being written by a worker are
+                    # less than a few minutes old, so leave those alone
+                    if time.time() - os.path.getmtime(entry) > 3600:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                size = sum(x.stat().st_size for x in os.scandir(entry))
+                entries.append((os.path.getmtime(os.path.join(entry, 'complete')), size, entry))
+                total += size
+
+        entries.sort()
+        removed = 0
+        while total > self.max_bytes and len(entries) > 0:
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed > 0:
+            print(f'Removed {removed} entries from the eUtils cache to stay under the size limit.')
@@ -10,7 +10,11 @@ import tarfile
 
 import sqlite3
 
+import numpy
+import pandas
+
 import config
+import db
 
 def confirm_destruct(prompt):
     """
@@ -25,6 +29,80 @@ def confirm_destruct(prompt):
         print('User input was not "y"; skipping.')
         return False
 
+# Everything Report_progress checks for, in order. Each is a tuple of the
+# section it's reported in, a description, and the directory (within the
+# project's directory) and name to look for. Names ending in "/" have to be
+# directories; others can be either. The first check is for the project
+# directory itself.
+PROGRESS_CHECKS = [
+    ('Initialization', 'Directory created', None, None),
+    ('Initialization', 'Repository cloned', '', 'workflow/'),
+    ('Initialization', 'Accession list created', '', 'SraAccList.txt'),
+    ('Initialization', 'Virtual environment created', '', 'venv/'),
+    ('Pipeline', '1/6 Prefetch job started', '.snakemake/slurm_logs', 'rule_sra_prefetch'),
+    ('Pipeline', '2/6 SRA data extraction job started', '.snakemake/slurm_logs', 'rule_sra_to_fastq'),
+    ('Pipeline', '3/6 FASTQ filtering job started', '.snakemake/slurm_logs', 'rule_filter'),
+    ('Pipeline', '4/6 Error modeling job started', '.snakemake/slurm_logs', 'rule_errormodel'),
+    ('Pipeline', '5/6 ASV calculation job started', '.snakemake/slurm_logs', 'rule_make_asv_table'),
+    ('Pipeline', '6/6 Taxonomic assignment job started', '.snakemake/slurm_logs', 'rule_assign_taxonomy'),
+    ('Results', 'Result file: ASVs.fa', '', 'ASVs.fa'),
+    ('Results', 'Result file: ASVs_counts.tsv', '', 'ASVs_counts.tsv'),
+    ('Results', 'Result file: ASVs_taxonomy.tsv', '', 'ASVs_taxonomy.tsv')
+]
+# The checks that all pass once a project is done (see check_if_done),
+# as a bitmask: bit N is set if check N in PROGRESS_CHECKS passed
+DONE_MASK = sum(1 << i for i, check in enumerate(PROGRESS_CHECKS) if check[0] == 'Results')
+
+def list_progress(pid):
+    """
+    Lists the directories that PROGRESS_CHECKS look in, for one project.
+
+    Inputs:
+        - pid: string. The project ID, which is also its directory.
+    Returns:
+        - A dict: for each directory, a set of what's in it (with "/" at the
+            end of directory names). Directories that don't exist are left out.
+    """
+    listing = {}
+    for directory in {check[2] for check in PROGRESS_CHECKS if check[2] is not None}:
+        try:
+            with os.scandir(f'{pid}/{directory}') as entries:
+                listing[directory] = {f'{x.name}/' if x.is_dir() else x.name for x in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return listing
+
+def evaluate_progress(listing):
+    """
+    Runs PROGRESS_CHECKS against a listing from list_progress.
+
+    Returns:
+        - A tuple: a bitmask of which checks passed (bit N is check N), and
+            whether the pipeline is running (see check_if_running).
+    """
+    checks = 0
+    for i, (_, _, directory, name) in enumerate(PROGRESS_CHECKS):
+        entries = listing.get(directory, set())
+        if directory is None:
+            passed = '' in listing
+        else:
+            passed = name in entries or f'{name}/' in entries
+        if passed:
+            checks |= 1 << i
+    return checks, 'running.txt' in listing.get('', set())
+
+def progress_stage(checks):
+    """
+    Returns the description of the last check in a row that passed, before
+    the first one that failed, or None if none did.
+    """
+    stage = None
+    for i, check in enumerate(PROGRESS_CHECKS):
+        if not checks & (1 << i):
+            break
+        stage = check[1]
+    return stage
+
 class Project:
     """
     A Project instance represents a single BioProject and is the main unit
@@ -42,6 +120,12 @@ class Project:
         self.re_run = False # should the project be re-run?
         self.errors = [] # list of issues discovered in the pipeline results
 
+        # Pipeline progress, if it's been checked (see read_progress):
+        self.checks = None # bitmask of which PROGRESS_CHECKS passed
+        self.running = None
+        self.stage_changed = None # when the last check that passed first did
+        self.job_state = None # what the scheduler says about its job, if known
+
         self.sample_count = None
         self.chimeric_warn = 0
         self.chimeric_error = 0
@@ -86,24 +170,25 @@ class Project:
 
     def _set_status(self, connection, status, note1=None, note2=None):
         """Updates the project's information in the table that tracks project progress"""
-        connection.write("""
-            UPDATE status
-            SET status=?
-            WHERE project=?
-        """, (status, self.id))
-
-        if note1 is not None:
+        with connection.transaction():
             connection.write("""
                 UPDATE status
-                SET note1=?
+                SET status=?
                 WHERE project=?
-            """, (note1, self.id))
-        if note2 is not None:
-            connection.write("""
-                UPDATE status
-                SET note2=?
-                WHERE project=?
-            """, (note2, self.id))
+            """, (status, self.id))
+
+            if note1 is not None:
+                connection.write("""
+                    UPDATE status
+                    SET note1=?
+                    WHERE project=?
+                """, (note1, self.id))
+            if note2 is not None:
+                connection.write("""
+                    UPDATE status
+                    SET note2=?
+                    WHERE project=?
+                """, (note2, self.id))
 
     def initialize_pipeline(self, connection):
         """
@@ -153,47 +238,38 @@ class Project:
         """
         return(os.path.exists(f'{self.id}/running.txt'))
 
+    def read_progress(self):
+        """
+        Checks the project's directory for each of the PROGRESS_CHECKS.
+        (The results are usually loaded from the project_state table
+        instead; see management.load_projects.)
+        """
+        self.checks, self.running = evaluate_progress(list_progress(self.id))
+
     def Report_progress(self):
         print(self)
-        if self.check_if_done():
+        if self.checks is None:
+            self.read_progress()
+        if self.checks & DONE_MASK == DONE_MASK:
             print('DONE!')
             return(True)
 
-        if self.check_if_running():
+        if self.running:
             print('\n===============\nCURRENTLY RUNNING\n===============\n')
-
-        tests = [
-            ('Initialization',
-            {
-                'Directory created': os.path.isdir(self.id),
-                'Repository cloned': os.path.isdir(f'{self.id}/workflow'),
-                'Accession list created': os.path.exists(f'{self.id}/SraAccList.txt'),
-                'Virtual environment created': os.path.isdir(f'{self.id}/venv')
-            }),
-            ('Pipeline',
-            {
-                '1/6 Prefetch job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_sra_prefetch'),
-                '2/6 SRA data extraction job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_sra_to_fastq'),
-                '3/6 FASTQ filtering job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_filter'),
-                '4/6 Error modeling job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_errormodel'),
-                '5/6 ASV calculation job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_make_asv_table'),
-                '6/6 Taxonomic assignment job started': os.path.exists(f'{self.id}/.snakemake/slurm_logs/rule_assign_taxonomy')
-            }),
-            ('Results',
-            {
-                'Result file: ASVs.fa': os.path.exists(f'{self.id}/ASVs.fa'),
-                'Result file: ASVs_counts.tsv': os.path.exists(f'{self.id}/ASVs_counts.tsv'),
-                'Result file: ASVs_taxonomy.tsv': os.path.exists(f'{self.id}/ASVs_taxonomy.tsv'),
-            })
-        ]
+        if self.stage_changed is not None:
+            stage = progress_stage(self.checks)
+            print(f"Latest step: {stage} (as of {datetime.fromtimestamp(self.stage_changed).strftime('%d/%m/%Y %H:%M:%S')})")
 
         arrow = True # point at the earliest test that fails
-        for category in tests:
-            print(f'\n======{category[0]}======')
-            for string, test in category[1].items():
-                print(f"{'✓' if test else 'X'}   {string} {'  <<< XXXXXXX <<<' if arrow and not test else ''}")
-                if arrow and not test:
-                    arrow = False # only print one arrow
+        section = None
+        for i, (category, string, _, _) in enumerate(PROGRESS_CHECKS):
+            if category != section:
+                print(f'\n======{category}======')
+                section = category
+            test = self.checks & (1 << i)
+            print(f"{'✓' if test else 'X'}   {string} {'  <<< XXXXXXX <<<' if arrow and not test else ''}")
+            if arrow and not test:
+                arrow = False # only print one arrow
 
         return(False)
 
@@ -415,34 +491,52 @@ class Project:
         return(True)
 
     ########### helpers for saving results
-    def _load_counts(self):
+    def _load_sample_names(self):
+        """Returns the names of the samples in the count matrix, from
+        its header."""
+        with open(f'{self.id}/ASVs_counts.tsv', 'r') as file:
+            return file.readline().rstrip('\n').split('\t')[1:] # first entry is blank
+
+    def _load_counts(self, chunksize=2000, sample_ids=None, asv_ids=None):
         """Loads a tab-delimited file in which each column
         is a sample and each row is an ASV, with the cells
-        indicating read counts."""
+        indicating read counts.
 
-        to_write = []
+        The file is read chunksize ASVs at a time, and only the cells
+        with nonzero counts are kept: their coordinates are pulled out of
+        each chunk's matrix in one step (a sparse, COO-style list of
+        row, column and value) rather than cell by cell.
 
-        with open(f'{self.id}/ASVs_counts.tsv', 'r') as file:
-            samples = file.readline().split('\t')[1:] # first entry is blank
-            samples[-1] = samples[-1][:-1] # strip newline
-            for line in file:
-                line = line.split('\t')
-                line[-1] = line[-1][:-1]
-                asv = [line[0]] * len(samples)
-                entries = list(zip(samples, asv, line[1:]))
-                # convert counts to ints
-                entries = [
-                    (x[0], x[1], int(x[2]))
-                    for x in entries
-                ]
-                to_write += [x for x in entries if x[2] != 0]
-        # example entry: ('SRR123', 'ASV_7', 23)
-        return(to_write)
+        Inputs:
+            - sample_ids: dict. If provided, sample names are swapped for the
+                values they map to (e.g. their sample_id in the database).
+            - asv_ids: dict. The same, but for the names of ASVs.
+        Yields:
+            - A list of (sample, ASV, count) tuples for each chunk.
+        """
+        reader = pandas.read_csv(f'{self.id}/ASVs_counts.tsv', sep='\t',
+            index_col=0, chunksize=chunksize)
+        for chunk in reader:
+            values = chunk.to_numpy()
+            rows, cols = numpy.nonzero(values)
+            samples = chunk.columns.to_numpy()
+            if sample_ids is not None:
+                samples = numpy.array([sample_ids[x] for x in samples])
+            asvs = chunk.index.to_numpy()
+            if asv_ids is not None:
+                asvs = numpy.array([asv_ids[x] for x in asvs])
+            # example entry: ('SRR123', 'ASV_7', 23)
+            yield list(zip(samples[cols].tolist(), asvs[rows].tolist(), values[rows, cols].tolist()))
 
     def _load_asv_data(self):
         """Loads a tab-delimited file in which each row is
         a numbered ASV, associated with its inferred taxonomic
-        source."""
+        source.
+
+        Yields:
+            - A tuple for each ASV: its project-level name, its exact
+                sequence and a list of its taxonomic assignments.
+        """
 
         seqs = {}
         # Get exact sequences
@@ -458,25 +552,17 @@ class Project:
                     seq = seq[0:-1] # strip trailing newline
                 seqs[asv]=seq
 
-        taxa = {}
-        # The get taxonomic assignments
+        # Then get taxonomic assignments, one ASV at a time
         with open(f'{self.id}/ASVs_taxonomy.tsv', 'r') as file:
             file.readline() # skip header
             for line in file:
                 line = line.split('\t')
                 line[-1] = line[-1][:-1]
-                taxa[line[0]] = line[1:]
-
-        # example entry: (
-        #       ,
-        #       ('PRJNA1234', 'ASV_1','CCTACGGG')
-        # )
-
-        # ('ASV_1','Bacteria','Bacteroidota','Bacteroidia','Bacteroidales','Bacteroidaceae','Bacteroides')
-        assignments = [tuple([asv]+values) for asv, values in taxa.items()]
-        seqs = [(self.id, asv, seqs[asv]) for asv in taxa.keys()]
-
-        return(assignments, seqs)
+                # example entry: (
+                #       'ASV_1', 'CCTACGGG',
+                #       ['Bacteria','Bacteroidota','Bacteroidia','Bacteroidales','Bacteroidaceae','Bacteroides']
+                # )
+                yield (line[0], seqs[line[0]], line[1:])
 
     def Save_results(self, connection):
         """
@@ -485,44 +571,76 @@ class Project:
         print('Saving results!')
         self._record_if_paired(connection)
 
-        counts = self._load_counts()
-        assignments, seqs = self._load_asv_data()
-
-        # save counts
-        connection.write('INSERT INTO asv_counts (sample, asv, count) VALUES (?,?,?)', counts)
-        # save sequences
-        connection.write("""
-            INSERT INTO asv_sequences(project, asv, seq)
-            VALUES(?,?,?)
-        """, seqs)
-
-        # figure out which ASV ID goes with which ASV we just recorded:
-        # (This would be much tidier to use a RETURNING clause in the previous
-        # query, but that doesn't work with `executemany()`)
-        asv_ids = connection.read("""
-            SELECT asv, asv_id
-            FROM asv_sequences
-            WHERE project=?
-        """, (self.id,))
-
-        ids = {}
-        for asv, asv_id in asv_ids:
-            ids[asv] = asv_id
-        # each assignment entry has a project-level ASV id (ASV_1, ASV_2, etc), but
-        # we want to swap that out for the unique ID assigned by SQLite when we saved the ASV's sequence:
-        # (You can try to rewrite this as a one-liner list comprehension, but last time it looked horrific
-        # so now we have a friendly little loop.)
-        to_write = []
-        for entry in assignments:
-            current = (ids[entry[0]], 'silva_nr99_v138_train_set', *entry[1:])
-            to_write.append(current)
-
-        asv_ids = connection.write("""
-            INSERT INTO asv_assignments
-            VALUES(?,?,?,?,?,?,?,?)
-        """, to_write)
-
-        self._set_status(connection, 'complete')
+        # Everything is saved in one transaction, so a failure partway
+        # through doesn't leave a project half-loaded. (It's an "immediate"
+        # one so nobody else can write while we're handing out ASV IDs.)
+        with connection.transaction(immediate=True):
+            # If the project was saved before (e.g. it wasn't archived the
+            # first time), its old results are replaced rather than added to
+            for table in ['sample_asv_counts', 'taxon_rollups']:
+                connection.write(f"""
+                    DELETE FROM {table}
+                    WHERE sample_id IN (SELECT sample_id FROM result_samples WHERE project=?)
+                """, (self.id,))
+            connection.write('DELETE FROM project_asvs WHERE project=?', (self.id,))
+
+            # Each distinct sequence gets one ID, shared by every project that
+            # found it. Sequences we've seen before are matched by their hash;
+            # new ones get IDs picked here, rather than letting SQLite do it
+            # and reading them back afterward.
+            asvs = list(self._load_asv_data())
+            hashes = [db.sequence_hash(seq) for _, seq, _ in asvs]
+            known = dict(connection.read_in("""
+                SELECT seq_hash, asv_id FROM sequences
+                WHERE seq_hash IN ({values})
+            """, hashes)) # sequence hash -> asv_id
+            print(f'{len(known)} of {len(asvs)} ASVs were found in earlier projects.')
+            next_id = connection.read('SELECT COALESCE(MAX(asv_id), 0) FROM sequences')[0][0] + 1
+            asv_ids = {} # project-level ASV name (ASV_1, ASV_2, etc) -> asv_id
+
+            # save sequences and taxonomic assignments
+            for (asv, seq, taxa), seq_hash in zip(asvs, hashes):
+                if seq_hash not in known:
+                    known[seq_hash] = next_id
+                    connection.queue("""
+                        INSERT INTO sequences(asv_id, seq_hash, seq)
+                        VALUES(?,?,?)
+                    """, (next_id, seq_hash, seq))
+                    next_id += 1
+                asv_ids[asv] = known[seq_hash]
+                connection.queue("""
+                    INSERT INTO project_asvs(project, asv, asv_id)
+                    VALUES(?,?,?)
+                """, (self.id, asv, asv_ids[asv]))
+                # sequences that already have an assignment keep it
+                connection.queue("""
+                    INSERT OR IGNORE INTO asv_assignments
+                    VALUES(?,?,?,?,?,?,?,?)
+                """, (asv_ids[asv], 'silva_nr99_v138_train_set', *taxa))
+
+            # each sample gets an ID too
+            sample_names = self._load_sample_names()
+            connection.write('INSERT OR IGNORE INTO result_samples (sample, project) VALUES (?,?)',
+                [(sample, self.id) for sample in sample_names])
+            sample_ids = connection.read('SELECT sample, sample_id FROM result_samples WHERE project=?', (self.id,))
+            sample_ids = {x[0]: x[1] for x in sample_ids}
+            # a sample that's already saved as part of another project isn't added again
+            for sample in sample_names:
+                if sample not in sample_ids:
+                    other = connection.read('SELECT project FROM result_samples WHERE sample=?', (sample,))
+                    raise Exception(f'Sample {sample} in project {self.id} was already saved as part of project {other[0][0]}.')
+
+            # save counts, one chunk of the count matrix at a time
+            # (if two ASVs in the project have the same sequence, their counts are combined)
+            for counts in self._load_counts(sample_ids=sample_ids, asv_ids=asv_ids):
+                connection.write("""
+                    INSERT INTO sample_asv_counts (sample_id, asv_id, count) VALUES (?,?,?)
+                    ON CONFLICT (sample_id, asv_id) DO UPDATE SET count=count+excluded.count
+                """, counts)
+
+            db.update_rollups(connection, self.id)
+
+            self._set_status(connection, 'complete')
 
         if not confirm_destruct('Results recorded. Archive results?'):
             return()
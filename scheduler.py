@@ -0,0 +1,165 @@
+"""
+This module asks the cluster's job scheduler what's happening to the jobs
+running each project's pipeline. The "running.txt" file in a project's
+directory is left behind if its job is killed, so the scheduler is a
+better source for whether a project is still running.
+
+Each project's job is named after the project (see Project.RUN), so jobs
+are matched to projects by name. All jobs are looked up at once, and the
+answer is kept for the life of the scheduler object, so each pass through
+the projects costs one call to squeue (and, for jobs that have left the
+queue, one call to sacct).
+"""
+import getpass
+import subprocess
+
+import config
+
+# Job states (from squeue or sacct) that mean the job will still do something
+ACTIVE_STATES = {
+    'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED',
+    'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED', 'RESIZING', 'SIGNALING',
+    'STAGE_OUT', 'RESV_DEL_HOLD'
+}
+
+def classify(state):
+    """
+    Sorts a SLURM job state into one of the categories used elsewhere:
+    "running" (pending counts), "done" (finished without errors) or "dead"
+    (failed, cancelled, timed out, preempted, etc.).
+    """
+    state = state.split(' ')[0].rstrip('+') # e.g. "CANCELLED by 1234"
+    if state in ACTIVE_STATES:
+        return 'running'
+    if state == 'COMPLETED':
+        return 'done'
+    return 'dead'
+
+class SlurmScheduler:
+    """
+    Looks up the current user's jobs with squeue and sacct.
+    """
+    def __init__(self, user=None, lookback_days=None, timeout=None):
+        """
+        Inputs:
+            - user: string. Whose jobs to look up. Defaults to the current user.
+            - lookback_days: int. How far back sacct should look for jobs that
+                have finished. Defaults to config.slurm_lookback_days.
+            - timeout: int. How many seconds to give each command. Defaults
+                to config.timeout.
+        """
+        self.user = user if user is not None else getpass.getuser()
+        if lookback_days is None:
+            lookback_days = getattr(config, 'slurm_lookback_days', 14)
+        self.lookback_days = lookback_days
+        self.timeout = timeout if timeout is not None else getattr(config, 'timeout', 25)
+        self._fetched = False # whether squeue has been checked
+        self._fetched_finished = False # ...and sacct
+        self._queued = None # job name -> state, from squeue
+        self._finished = None # job name -> state of the latest job, from sacct
+
+    def refresh(self):
+        """Forgets the job states, so they're looked up again next time."""
+        self._fetched = False
+        self._fetched_finished = False
+
+    def job_states(self, names):
+        """
+        Finds out what's happening to the job for each of a list of projects.
+
+        Inputs:
+            - names: list of strings. The job names (project IDs).
+        Returns:
+            - A dict: for each name, "running", "done", "dead", or None if
+                there's no record of the job (or the scheduler couldn't be
+                reached).
+        """
+        if not self._fetched:
+            self._queued = self._run_squeue()
+            self._fetched = True
+        if self._queued is None: # couldn't reach the scheduler at all
+            return {x: None for x in names}
+        # only jobs that have left the queue need to be looked up in sacct
+        if not self._fetched_finished and len([x for x in names if x not in self._queued]) > 0:
+            self._finished = self._run_sacct()
+            self._fetched_finished = True
+
+        states = {}
+        for name in names:
+            state = self._queued.get(name)
+            if state is None and self._finished is not None:
+                state = self._finished.get(name)
+            states[name] = classify(state) if state is not None else None
+        return states
+
+    def _run(self, command):
+        """Runs a command and returns its output lines, or None if it failed."""
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f'WARNING: could not run {command[0]}: {e}')
+            return None
+        if result.returncode != 0:
+            print(f'WARNING: {command[0]} returned exit code {result.returncode}: {result.stderr.strip()}')
+            return None
+        return [x for x in result.stdout.splitlines() if x.strip() != '']
+
+    def _run_squeue(self):
+        lines = self._run(['squeue', '--noheader', '--user', self.user, '--format=%j|%T'])
+        if lines is None:
+            return None
+        queued = {}
+        for line in lines:
+            name, state = line.split('|', 1)
+            # if there's more than one job with the same name, any that are
+            # still going are what count
+            if name not in queued or classify(state) == 'running':
+                queued[name] = state
+        return queued
+
+    def _run_sacct(self):
+        lines = self._run([
+            'sacct', '--noheader', '--parsable2', '--allocations',
+            '--user', self.user, f'--starttime=now-{self.lookback_days}days',
+            '--format=JobName,State'
+        ])
+        if lines is None:
+            return None
+        finished = {}
+        for line in lines:
+            name, state = line.split('|', 1)
+            finished[name] = state # jobs are listed oldest first
+        return finished
+
+class FakeScheduler:
+    """
+    Stands in for SlurmScheduler in tests, or on machines without a
+    scheduler. Job states are whatever it's given.
+    """
+    def __init__(self, states=None):
+        """
+        Inputs:
+            - states: dict. The SLURM state for each job name (e.g.
+                {'PRJNA123': 'RUNNING'}).
+        """
+        self.states = states if states is not None else {}
+        self.queries = 0 # how many times job_states has been called
+
+    def refresh(self):
+        pass
+
+    def job_states(self, names):
+        self.queries += 1
+        return {x: classify(self.states[x]) if x in self.states else None for x in names}
+
+def from_config():
+    """
+    Returns the scheduler named in config.scheduler ("slurm" by default),
+    or None if it's set to None.
+    """
+    name = getattr(config, 'scheduler', 'slurm')
+    if name is None:
+        return None
+    if name == 'slurm':
+        return SlurmScheduler()
+    raise Exception(f'Unrecognized scheduler "{name}" in config.py. Options are: slurm, None')
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import hashlib
+import os
+import sys
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import amplicon
+
+def v4_asvs(count):
+    """ASVs cut from the V4 region of the reference, with a few differences."""
+    asvs = []
+    for i in range(count):
+        seq = list(amplicon.whole16s[560:800].upper())
+        seq[20 + i % 200] = 'A' if seq[20 + i % 200] != 'A' else 'C'
+        seq[100 + (i * 7) % 100] = 'G' if seq[100 + (i * 7) % 100] != 'G' else 'T'
+        asvs.append(''.join(seq))
+    return asvs
+
+def test_find_region():
+    assert amplicon.find_region(50, 'f') == 'v1'
+    assert amplicon.find_region(560, 'f') == 'v4'
+    # more than half of V4 is covered, so it counts
+    assert amplicon.find_region(600, 'f') == 'v4'
+    assert amplicon.find_region(650, 'f') == 'v5'
+    assert amplicon.find_region(800, 'r') == 'v4'
+    with pytest.raises(ValueError):
+        amplicon.find_region(5, 'x')
+
+def test_align_memo(monkeypatch):
+    asv = v4_asvs(1)[0]
+    begin, end, good = amplicon.align(asv)
+    assert good
+    assert 555 <= begin <= 565 and 795 <= end <= 805
+    # the second time, the reference isn't consulted
+    monkeypatch.setattr(amplicon, '_aligner', lambda: pytest.fail('ASV was aligned twice'))
+    assert amplicon.align(asv) == (begin, end, good)
+
+def test_align_memo_limit(monkeypatch):
+    monkeypatch.setattr(amplicon, '_alignments', OrderedDict())
+    monkeypatch.setattr(amplicon.config, 'alignment_memo_size', 2, raising=False)
+    for asv in v4_asvs(3):
+        amplicon.align(asv)
+    assert len(amplicon._alignments) == 2
+    # the first one was dropped
+    assert amplicon._alignments.keys() == {
+        hashlib.sha1(asv.encode('ascii')).digest() for asv in v4_asvs(3)[1:]
+    }
+
+def test_wilson_lower():
+    assert amplicon._wilson_lower(0, 0, 1.96) == 0
+    assert amplicon._wilson_lower(50, 100, 1.96) == pytest.approx(0.4038, abs=1e-4)
+    assert amplicon._wilson_lower(30, 30, 3.29) > 0.5
+
+def test_process_project():
+    assert amplicon.process_project(v4_asvs(20)) == ('v4', 240)
+
+def test_process_project_stops_early(monkeypatch):
+    asvs = v4_asvs(500)
+    calls = []
+    original = amplicon.align
+    monkeypatch.setattr(amplicon, 'align', lambda asv: calls.append(asv) or original(asv))
+    monkeypatch.setattr(amplicon.config, 'region_confidence_z', 3.29, raising=False)
+    monkeypatch.setattr(amplicon.config, 'region_min_sample', 30, raising=False)
+    assert amplicon.process_project(asvs) == ('v4', 240)
+    # all agree, so far fewer than half are needed
+    assert len(calls) < 50
+
+def test_lookup_matches_scan():
+    for direction in ['f', 'r']:
+        for position in range(len(amplicon.whole16s) + 1):
+            assert amplicon.find_region(position, direction) == amplicon._scan_region(position, direction)
+        # positions that aren't whole numbers, or are off the end
+        for position in [-10.5, 600.5, 1294.25, len(amplicon.whole16s) + 50]:
+            assert amplicon.find_region(position, direction) == amplicon._scan_region(position, direction)
+
+def test_tally_regions():
+    positions = [10, 100, 560, 600, 1500]
+    assert amplicon.tally_regions(positions, 'f') == {
+        'v1': 1, 'v2': 1, 'v4': 2, None: 1
+    }
+    codes = amplicon.classify_positions(positions, 'r')
+    assert [amplicon.REGIONS[x] if x < len(amplicon.REGIONS) else None for x in codes] == [
+        amplicon.find_region(x, 'r') for x in positions
+    ]
+
+def test_first_settled():
+    counts = numpy.zeros(len(amplicon.REGIONS) + 1, dtype=numpy.int64)
+    v4 = amplicon.REGIONS.index('v4')
+    v5 = amplicon.REGIONS.index('v5')
+    # 3 of a project's 10 ASVs isn't enough to know
+    codes = numpy.array([v4, v5, v4, v4])
+    assert amplicon._first_settled(codes, counts, numpy.array([1, 2, 3, 5]), 10, 3.29, 30) is None
+    assert counts[v4] == 3 and counts[v5] == 1
+
+    # the fourth v4 ASV is more than half of a project's 7 ASVs
+    counts[:] = 0
+    codes = numpy.array([v4, v5, v4, v4, v4, v5])
+    assert amplicon._first_settled(codes, counts, numpy.array([1, 2, 3, 4, 5, 6]), 7, 3.29, 30) == 'v4'
+    # the tally stops at the ASV that settled it
+    assert counts[v4] == 4 and counts[v5] == 1
+
+def test_kmer_offsets():
+    asv = amplicon.whole16s[560:800].upper()
+    assert amplicon._kmer_offsets(asv) == (560, 799, True)
+    # a few differences and a missing base
+    changed = asv[:50] + 'T' + asv[51:120] + asv[121:]
+    assert amplicon._kmer_offsets(changed) == (560, 799, True)
+    # nothing in common with the reference
+    assert amplicon._kmer_offsets('ACGT' * 60) is None
+    # ends too close to the edge of a region to be sure: V4 starts at 576
+    assert amplicon._kmer_offsets(amplicon.whole16s[574:800].upper()) is None
+
+def test_align_falls_back(monkeypatch):
+    monkeypatch.setattr(amplicon, '_alignments', OrderedDict())
+    monkeypatch.setattr(amplicon, '_ssw_offsets', lambda asv: (1, 2, False))
+    assert amplicon.align(amplicon.whole16s[560:800].upper()) == (560, 799, True)
+    assert amplicon.align('ACGT' * 60) == (1, 2, False)
+
+def test_benchmark():
+    asvs = v4_asvs(10) + ['ACGT' * 60]
+    results = amplicon.benchmark(asvs)
+    assert results['placed'] == pytest.approx(10 / 11)
+    assert results['agreement'] == 1
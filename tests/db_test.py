@@ -0,0 +1,297 @@
+import os
+import sys
+
+import pytest
+
+from fixtures import Temp_db, Biosample_xml, Fake_eutils
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+
+def test_iter_biosamples(Biosample_xml):
+    seen = []
+    for sample, consumed in db._iter_biosamples(Biosample_xml):
+        seen.append(sample.attrib['id'])
+        assert consumed <= os.path.getsize(Biosample_xml)
+    assert seen == ['1', '2', '3']
+
+def test_load_xml_samples(Temp_db, Biosample_xml):
+    db.load_xml('txid408170', Biosample_xml, save_samples=True, save_tags=False)
+    connection = db.Connection()
+    samples = connection.read('SELECT srs, taxon FROM samples ORDER BY 1')
+    assert samples == [('SRS1', 'txid408170'), ('SRS3', 'txid408170')]
+
+    # loading the same file again shouldn't duplicate anything
+    db.load_xml('txid408170', Biosample_xml, save_samples=True, save_tags=False)
+    assert len(connection.read('SELECT srs FROM samples')) == 2
+
+def test_load_xml_tags(Temp_db, Biosample_xml):
+    db.load_xml('txid408170', Biosample_xml, save_samples=False, save_tags=True)
+    connection = db.Connection()
+    tags = connection.read('SELECT srs, tag, value FROM tags ORDER BY 2')
+    assert tags == [
+        ('SRS1', 'host', 'homo sapiens'),
+        ('SRS1', 'sample source', 'stool')
+    ]
+    assert len(connection.read('SELECT srs FROM samples')) == 0
+
+def test_load_xml_batches(Temp_db, Biosample_xml):
+    # a batch size smaller than the file forces several flushes
+    db.load_xml('txid408170', Biosample_xml, save_samples=True, save_tags=True, batch_size=1)
+    connection = db.Connection()
+    assert len(connection.read('SELECT srs FROM samples')) == 2
+    assert len(connection.read('SELECT srs FROM tags')) == 2
+
+def test_transaction_commits(Temp_db):
+    connection = db.Connection()
+    with connection.transaction():
+        connection.write('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA1', 'running'))
+        connection.queue('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA2', 'running'))
+        connection.queue('UPDATE samples SET srr=? WHERE srs=?', ('SRR1', 'SRS1'))
+        # nothing is visible from other connections until the block ends
+        other = db.Connection()
+        assert other.read('SELECT COUNT(*) FROM status') == [(0,)]
+    assert other.read('SELECT COUNT(*) FROM status') == [(2,)]
+
+def test_transaction_rolls_back(Temp_db):
+    connection = db.Connection()
+    with pytest.raises(ValueError):
+        with connection.transaction():
+            connection.write('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA1', 'running'))
+            connection.queue('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA2', 'running'))
+            raise ValueError('something went wrong')
+    assert connection.read('SELECT COUNT(*) FROM status') == [(0,)]
+    # the queue was dropped too, so the next write doesn't resurrect it
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA3', 'running'))
+    assert connection.read('SELECT project FROM status') == [('PRJNA3',)]
+
+def test_read_in_chunks(Temp_db, monkeypatch):
+    connection = db.Connection()
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)',
+        [(f'PRJNA{i}', 'running' if i % 2 == 0 else 'done') for i in range(7)])
+    monkeypatch.setattr(connection, 'IN_CHUNK_SIZE', 3)
+    found = connection.read_in(
+        'SELECT project FROM status WHERE status=? AND project IN ({values})',
+        [f'PRJNA{i}' for i in range(8)], params=('running',))
+    assert sorted(found) == [('PRJNA0',), ('PRJNA2',), ('PRJNA4',), ('PRJNA6',)]
+    assert connection.read_in('SELECT project FROM status WHERE project IN ({values})', []) == []
+
+def test_queue_flushes_at_batch_size(Temp_db):
+    connection = db.Connection()
+    connection.batch_size = 2
+    other = db.Connection()
+    connection.queue('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA1', 'running'))
+    assert other.read('SELECT COUNT(*) FROM status') == [(0,)]
+    connection.queue('INSERT INTO status (project, status) VALUES (?,?)', ('PRJNA2', 'running'))
+    # outside a transaction, a flush also commits
+    assert other.read('SELECT COUNT(*) FROM status') == [(2,)]
+
+def test_performance_profile(Temp_db, monkeypatch):
+    connection = db.Connection()
+    # WAL isn't safe on network filesystems, so it's only used if asked for
+    assert connection.read('PRAGMA journal_mode') == [('delete',)]
+    assert connection.read('PRAGMA mmap_size') == [(0,)]
+    del connection
+
+    import config
+    monkeypatch.setattr(config, 'db_pragmas', {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}, raising=False)
+    connection = db.Connection()
+    assert connection.read('PRAGMA journal_mode') == [('wal',)]
+    assert connection.read('PRAGMA synchronous') == [(1,)]
+
+    monkeypatch.setattr(config, 'db_pragmas', {'cache_size': '1; DROP TABLE samples'}, raising=False)
+    with pytest.raises(Exception):
+        db.Connection()
+
+def test_indexes_added_to_existing_db(Temp_db):
+    connection = db.Connection()
+    connection.write('DROP INDEX idx_samples_no_run')
+    # reconnecting should put it back
+    connection = db.Connection()
+    indexes = connection.read("SELECT name FROM sqlite_master WHERE type='index'")
+    for name in db.INDEXES.keys():
+        assert (name,) in indexes
+
+def test_indexes_left_alone(Temp_db):
+    connection = db.Connection()
+    connection.write('CREATE INDEX idx_samples_pubdate ON samples(pubdate)')
+    connection.write('CREATE TABLE old_sequences (project TEXT)')
+    connection.write('CREATE INDEX idx_asv_sequences_project ON old_sequences(project)')
+    connection = db.Connection()
+    indexes = connection.read("SELECT name FROM sqlite_master WHERE type='index'")
+    # an index added by hand is kept, but one we used to make is dropped
+    assert ('idx_samples_pubdate',) in indexes
+    assert ('idx_asv_sequences_project',) not in indexes
+
+def test_find_runs(Temp_db, Fake_eutils):
+    connection = db.Connection()
+    connection.write('INSERT INTO samples (srs) VALUES (?)', [('SRS1',), ('SRS3',)])
+    db.find_runs(10, per_query=1, workers=2)
+    assert len(Fake_eutils) == 4 # esearch and efetch for each batch
+    assert [x[1]['term'] for x in Fake_eutils if 'esearch' in x[0]] in [
+        ['SRS1[accn]', 'SRS3[accn]'], ['SRS3[accn]', 'SRS1[accn]']
+    ]
+
+    samples = connection.read("""
+        SELECT srs, srr, project, library_source, instrument, total_bases
+        FROM samples ORDER BY 1""")
+    assert samples == [
+        ('SRS1', 'SRR1', 'PRJNA1', 'METAGENOMIC', 'Illumina MiSeq', 1000),
+        ('SRS3', 'SRR3;SRR4', 'PRJNA1', 'GENOMIC', None, 700)
+    ]
+
+def test_find_runs_pages(Temp_db, Fake_eutils, monkeypatch):
+    import config
+    monkeypatch.setattr(config, 'efetch_page_size', 1, raising=False)
+    connection = db.Connection()
+    connection.write('INSERT INTO samples (srs) VALUES (?)', [('SRS1',), ('SRS3',)])
+    db.find_runs(10, per_query=100)
+    # one search for both samples, then one page per sample
+    assert len(Fake_eutils) == 3
+    assert Fake_eutils[0][1]['term'] in ['SRS1[accn] or SRS3[accn]', 'SRS3[accn] or SRS1[accn]']
+    assert [x[1]['retstart'] for x in Fake_eutils[1:]] == [0, 1]
+    assert connection.read('SELECT COUNT(*) FROM samples WHERE srr IS NOT NULL') == [(2,)]
+
+def test_record_data_keeps_missing_fields(Temp_db):
+    from fixtures import EFETCH_RESPONSE
+    connection = db.Connection()
+    connection.write('INSERT INTO samples (srs, instrument) VALUES (?,?)', [('SRS1', None), ('SRS3', 'NextSeq')])
+    records = db.ncbi.parse_efetch([EFETCH_RESPONSE.encode('UTF-8')])
+    multiple = db._record_data(records, connection)
+    assert multiple == 1
+    # the response has no instrument for SRS3, so the old value stays
+    assert connection.read('SELECT srs, instrument FROM samples ORDER BY 1') == [
+        ('SRS1', 'Illumina MiSeq'), ('SRS3', 'NextSeq')
+    ]
+
+def test_record_data_merges_packages(Temp_db):
+    connection = db.Connection()
+    connection.write("INSERT INTO samples (srs) VALUES ('SRS1')")
+    records = [
+        db.ncbi.RunRecord('SRS1', ['SRR1'], 'PRJNA1', 'AMPLICON', None, None, '100', None),
+        db.ncbi.RunRecord('SRS1', ['SRR2'], None, None, 'GENOMIC', None, None, 'Illumina MiSeq')
+    ]
+    db._record_data(records, connection)
+    # the second package has no project, so the first one's is kept
+    assert connection.read('SELECT srr, project, library_strategy, library_source, total_bases, instrument FROM samples') == [
+        ('SRR2', 'PRJNA1', 'AMPLICON', 'GENOMIC', 100, 'Illumina MiSeq')
+    ]
+
+def test_find_runs_cache(Temp_db, Fake_eutils, tmp_path, monkeypatch):
+    import config
+    monkeypatch.setattr(config, 'eutils_cache_path', str(tmp_path / 'cache'))
+    connection = db.Connection()
+    connection.write('INSERT INTO samples (srs) VALUES (?)', [('SRS1',), ('SRS3',)])
+    db.find_runs(10, per_query=100)
+    assert len(Fake_eutils) == 2
+
+    # forget what we found, then look again: the cached response should be used
+    connection.write('UPDATE samples SET srr=NULL, project=NULL')
+    db.find_runs(10, per_query=100)
+    assert len(Fake_eutils) == 2
+    assert connection.read('SELECT COUNT(*) FROM samples WHERE project IS NOT NULL') == [(2,)]
+
+    # replaying doesn't need the samples to be selected at all
+    connection.write('UPDATE samples SET project=NULL')
+    db.replay_cache()
+    assert len(Fake_eutils) == 2
+    assert connection.read('SELECT COUNT(*) FROM samples WHERE project IS NOT NULL') == [(2,)]
+
+def test_migrate_compact_counts(Temp_db):
+    import sqlite3
+    # a database from before the counts table was converted
+    legacy = sqlite3.connect(Temp_db)
+    legacy.executescript("""
+        CREATE TABLE samples(srs TEXT PRIMARY KEY, project TEXT, taxon TEXT, srr TEXT,
+            library_strategy TEXT, library_source TEXT, instrument TEXT, pubdate TEXT,
+            total_bases INTEGER, geo_loc_name TEXT);
+        CREATE TABLE asv_counts (entryid INTEGER PRIMARY KEY, sample TEXT NOT NULL,
+            asv TEXT NOT NULL, count INTEGER NOT NULL);
+        CREATE TABLE asv_sequences (asv_id INTEGER PRIMARY KEY, project TEXT NOT NULL,
+            asv TEXT NOT NULL, seq TEXT);
+        INSERT INTO samples (srs, project, srr) VALUES ('SRS1', 'PRJNA1', 'SRR1'), ('SRS2', 'PRJNA2', 'SRR2');
+        INSERT INTO asv_sequences VALUES (1, 'PRJNA1', 'ASV_1', 'AC'), (2, 'PRJNA2', 'ASV_1', 'GT');
+        INSERT INTO asv_counts (sample, asv, count) VALUES
+            ('SRR1', 'ASV_1', 5), ('SRR2', 'ASV_1', 6), ('SRR_UNKNOWN', 'ASV_1', 7);
+    """)
+    legacy.close()
+
+    connection = db.Connection()
+    assert connection.read('PRAGMA user_version') == [(len(db.MIGRATIONS),)]
+    assert connection.read('SELECT sample, asv, count, project, asv_id FROM asv_counts ORDER BY 1') == [
+        ('SRR1', 'ASV_1', 5, 'PRJNA1', 1),
+        ('SRR2', 'ASV_1', 6, 'PRJNA2', 2)
+    ]
+    # the row we couldn't place is kept
+    assert connection.read('SELECT sample FROM asv_counts_legacy') == [('SRR_UNKNOWN',)]
+
+def test_migrate_shared_sequences(Temp_db):
+    import sqlite3
+    # a database from before sequences were shared between projects
+    connection = db.Connection()
+    connection.write('PRAGMA user_version=1')
+    connection.db.executescript("""
+        DROP VIEW asv_counts;
+        DROP VIEW asv_sequences;
+        CREATE TABLE asv_sequences (asv_id INTEGER PRIMARY KEY, project TEXT NOT NULL,
+            asv TEXT NOT NULL, seq TEXT);
+        INSERT INTO asv_sequences VALUES (1, 'PRJNA1', 'ASV_1', 'AC'), (2, 'PRJNA1', 'ASV_2', 'GT'),
+            (3, 'PRJNA2', 'ASV_1', 'GT'), (4, 'PRJNA2', 'ASV_2', NULL);
+        INSERT INTO asv_assignments (asv_id, genus) VALUES (1, 'A'), (3, 'B'), (4, 'C');
+        INSERT INTO result_samples (sample_id, sample, project) VALUES (1, 'SRR1', 'PRJNA1'), (2, 'SRR2', 'PRJNA2');
+        INSERT INTO sample_asv_counts (sample_id, asv_id, count) VALUES (1, 1, 5), (1, 2, 6), (2, 3, 7), (2, 4, 8);
+    """)
+    del connection
+
+    connection = db.Connection()
+    assert connection.read('PRAGMA user_version') == [(len(db.MIGRATIONS),)]
+    assert connection.read('SELECT asv_id, seq_hash, seq FROM sequences ORDER BY 1') == [
+        (1, db.sequence_hash('AC'), 'AC'), (2, db.sequence_hash('GT'), 'GT'), (4, None, None)
+    ]
+    assert connection.read('SELECT project, asv, asv_id FROM asv_sequences ORDER BY 1, 2') == [
+        ('PRJNA1', 'ASV_1', 1), ('PRJNA1', 'ASV_2', 2), ('PRJNA2', 'ASV_1', 2), ('PRJNA2', 'ASV_2', 4)
+    ]
+    # the assignment for the removed copy moves to the one that's left
+    assert connection.read('SELECT asv_id, genus FROM asv_assignments ORDER BY 1') == [
+        (1, 'A'), (2, 'B'), (4, 'C')
+    ]
+    assert connection.read('SELECT sample, asv, count, asv_id FROM asv_counts ORDER BY 1, 2') == [
+        ('SRR1', 'ASV_1', 5, 1), ('SRR1', 'ASV_2', 6, 2), ('SRR2', 'ASV_1', 7, 2), ('SRR2', 'ASV_2', 8, 4)
+    ]
+
+def test_rebuild_rollups(Temp_db):
+    connection = db.Connection()
+    connection.db.executescript("""
+        INSERT INTO result_samples (sample_id, sample, project) VALUES (1, 'SRR1', 'PRJNA1'), (2, 'SRR2', 'PRJNA2');
+        INSERT INTO asv_assignments (asv_id, kingdom, genus) VALUES (1, 'Bacteria', 'Blautia'), (2, 'Bacteria', NULL);
+        INSERT INTO sample_asv_counts (sample_id, asv_id, count) VALUES (1, 1, 5), (1, 2, 6), (2, 1, 7), (2, 3, 8);
+        INSERT INTO taxon_rollups (sample_id, rank, taxon, count) VALUES (1, 'genus', 'Stale', 100);
+    """)
+    db.rebuild_rollups()
+    assert connection.read("SELECT sample_id, taxon, count FROM taxon_rollups WHERE rank='genus' ORDER BY 1, 2") == [
+        (1, 'Blautia', 5), (1, 'NA', 6), (2, 'Blautia', 7)
+    ]
+    # asv_id 3 has no assignment, so it isn't counted
+    assert connection.read("SELECT sample_id, taxon, count FROM taxon_rollups WHERE rank='kingdom' ORDER BY 1") == [
+        (1, 'Bacteria', 11), (2, 'Bacteria', 7)
+    ]
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_find_asv_data(Temp_db, workers):
+    import amplicon
+    v4 = amplicon.whole16s[560:800].upper()
+    v3v4 = amplicon.whole16s[400:800].upper()
+    connection = db.Connection()
+    for asv_id, (project, seq) in enumerate([
+        ('PRJNA1', v4), ('PRJNA1', v4[:-1]),
+        ('PRJNA2', v3v4), ('PRJNA3', v4[1:])
+    ], start=1):
+        connection.write('INSERT INTO sequences (asv_id, seq_hash, seq) VALUES (?,?,?)', (asv_id, db.sequence_hash(seq), seq))
+        connection.write('INSERT INTO project_asvs (project, asv, asv_id) VALUES (?,?,?)', (project, f'ASV_{asv_id}', asv_id))
+    # a project that's been evaluated already
+    connection.write("INSERT INTO asv_inference VALUES ('PRJNA3', 'v4', 239)")
+
+    db.find_asv_data(10, workers=workers)
+    assert connection.read('SELECT project, region, length FROM asv_inference ORDER BY 1') == [
+        ('PRJNA1', 'v4', 239.5), ('PRJNA2', 'v3-v4', 400), ('PRJNA3', 'v4', 239)
+    ]
@@ -0,0 +1,93 @@
+import os
+import sys
+
+import h5py
+import numpy
+import pandas
+import pyarrow.dataset
+import pytest
+
+from fixtures import Temp_db, Results_dir
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+import export
+import projects
+
+@pytest.fixture
+def Saved_results(Results_dir, Temp_db, monkeypatch):
+    """Database with two projects' results saved in it."""
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    # an earlier project with one sequence in common with PRJNA999
+    seq = 'TACGTAGGTGGCAAGCGTTGTCCGG'
+    connection.write("INSERT INTO sequences (asv_id, seq_hash, seq) VALUES (1, ?, ?)", (db.sequence_hash(seq), seq))
+    connection.write("INSERT INTO project_asvs (project, asv, asv_id) VALUES ('PRJNA1', 'ASV_1', 1)")
+    connection.write("INSERT INTO result_samples (sample_id, sample, project) VALUES (1, 'SRR0', 'PRJNA1')")
+    connection.write('INSERT INTO sample_asv_counts (sample_id, asv_id, count) VALUES (1, 1, 4)')
+    connection.write("INSERT INTO samples (srs, srr, project) VALUES ('SRS0', 'SRR0', 'PRJNA1')")
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+    projects.Project(Results_dir).Save_results(connection)
+    return connection
+
+def test_export_hdf5(Saved_results, tmp_path):
+    export.export_hdf5(Saved_results, tmp_path / 'counts.h5')
+    with h5py.File(tmp_path / 'counts.h5', 'r') as file:
+        assert list(file['asv_ids']) == [1, 2, 3]
+        assert [x.decode() for x in file['samples']] == ['SRR0', 'SRR1', 'SRR2', 'SRR3']
+        assert [x.decode() for x in file['projects']] == ['PRJNA1', 'PRJNA999', 'PRJNA999', 'PRJNA999']
+        shape = tuple(file['counts'].attrs['shape'])
+        indptr = file['counts/indptr'][:]
+        indices = file['counts/indices'][:]
+        data = file['counts/data'][:]
+
+    # rebuild the dense matrix
+    matrix = numpy.zeros(shape, dtype=int)
+    for row in range(shape[0]):
+        for i in range(indptr[row], indptr[row+1]):
+            matrix[row, indices[i]] = data[i]
+    # PRJNA999's ASV_2 is asv_id 1, then ASV_1 and ASV_3 get 2 and 3
+    assert matrix.tolist() == [
+        [4, 0, 0],
+        [0, 10, 1],
+        [0, 0, 2],
+        [7, 3, 0]
+    ]
+
+def test_export_parquet(Saved_results, tmp_path):
+    export.export_parquet(Saved_results, tmp_path, chunksize=1)
+    counts = pandas.read_parquet(tmp_path / 'asv_counts')
+    assert len(counts) == 6
+    assert counts['count'].sum() == 27
+    found = counts[(counts['project'] == 'PRJNA999') & (counts['sample'] == 'SRR3') & (counts['asv'] == 'ASV_2')]
+    assert found['count'].tolist() == [7]
+
+    seqs = pandas.read_parquet(tmp_path / 'asv_sequences')
+    assert len(seqs) == 4
+    # one file per row
+    assert len(os.listdir(tmp_path / 'asv_assignments')) == 3
+    assert len(pandas.read_parquet(tmp_path / 'samples')) == 1
+
+def test_export_parquet_missing_values(Temp_db, tmp_path):
+    connection = db.Connection()
+    # samples from load_xml have no run or project until find_runs fills
+    # them in; one of them has a size, the other doesn't
+    connection.write("INSERT INTO samples (srs, taxon) VALUES ('SRS1', '9606')")
+    connection.write("INSERT INTO samples (srs, taxon, total_bases) VALUES ('SRS2', '9606', 100)")
+    connection.write("""
+        INSERT INTO samples (srs, project, srr, total_bases, pubdate)
+        VALUES ('SRS3', 'PRJNA1', 'SRR3', 200, '2020-01-01')
+    """)
+    export.export_parquet(connection, tmp_path, chunksize=1)
+
+    dataset = pyarrow.dataset.dataset(tmp_path / 'samples')
+    assert dataset.schema.field('srr').type == pyarrow.string()
+    assert dataset.schema.field('total_bases').type == pyarrow.int64()
+    samples = pandas.read_parquet(tmp_path / 'samples').sort_values('srs')
+    assert samples['srr'].isna().tolist() == [True, True, False]
+    assert samples['total_bases'].isna().tolist() == [True, False, False]
+    assert samples['total_bases'].tolist()[1:] == [100, 200]
+
+def test_export_rejects_format(Temp_db, tmp_path):
+    with pytest.raises(Exception):
+        export.export(db.Connection(), tmp_path, ['csv'])
@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 import shutil
 import sys
+import time
 
 import pytest
 
@@ -44,3 +45,141 @@ def Dada_dir():
        shutil.rmtree(proj)
     except OSError as e:
         print(f'Error deleting dir tests/fastq: {e.strerror}')
+
+@pytest.fixture
+def Temp_db(tmp_path, monkeypatch):
+    """
+    Points the configured database path at an empty SQLite file that is
+    thrown away after the test. The eUtils cache is turned off, and so is
+    the job scheduler.
+    """
+    import config
+    monkeypatch.setattr(config, 'db_path', str(tmp_path / 'compendium.db'))
+    monkeypatch.setattr(config, 'eutils_cache_path', None, raising=False)
+    monkeypatch.setattr(config, 'scheduler', None, raising=False)
+    yield str(tmp_path / 'compendium.db')
+
+@pytest.fixture
+def Biosample_xml(tmp_path):
+    """
+    Writes a small "full text XML" BioSample export: one sample with tags,
+    one without an SRA ID and one without any usable tags.
+    """
+    path = tmp_path / 'biosamples.xml'
+    path.write_text("""<?xml version="1.0" ?>
+<BioSampleSet>
+<BioSample id="1"><Ids><Id db="BioSample">SAMN1</Id><Id db="SRA">SRS1</Id></Ids>
+    <Attributes>
+        <Attribute attribute_name="host" harmonized_name="host">Homo sapiens</Attribute>
+        <Attribute attribute_name="sample source">Stool</Attribute>
+    </Attributes>
+</BioSample>
+<BioSample id="2"><Ids><Id db="BioSample">SAMN2</Id></Ids></BioSample>
+<BioSample id="3"><Ids><Id db="SRA">SRS3</Id></Ids><Attributes><Attribute attribute_name="empty"/></Attributes></BioSample>
+</BioSampleSet>
+""")
+    yield str(path)
+
+EFETCH_RESPONSE = """<?xml version="1.0" encoding="UTF-8" ?>
+<EXPERIMENT_PACKAGE_SET>
+<EXPERIMENT_PACKAGE>
+    <EXPERIMENT accession="SRX1"><DESIGN><LIBRARY_DESCRIPTOR>
+        <LIBRARY_STRATEGY>AMPLICON</LIBRARY_STRATEGY>
+        <LIBRARY_SOURCE>METAGENOMIC</LIBRARY_SOURCE>
+    </LIBRARY_DESCRIPTOR></DESIGN>
+    <PLATFORM><ILLUMINA><INSTRUMENT_MODEL>Illumina MiSeq</INSTRUMENT_MODEL></ILLUMINA></PLATFORM></EXPERIMENT>
+    <STUDY><IDENTIFIERS><EXTERNAL_ID namespace="BioProject">PRJNA1</EXTERNAL_ID></IDENTIFIERS></STUDY>
+    <SAMPLE accession="SRS1"/>
+    <RUN_SET><RUN accession="SRR1" total_bases="1000" published="2020-01-01 00:00:00"/></RUN_SET>
+</EXPERIMENT_PACKAGE>
+<EXPERIMENT_PACKAGE>
+    <EXPERIMENT accession="SRX3"><DESIGN><LIBRARY_DESCRIPTOR>
+        <LIBRARY_STRATEGY>AMPLICON</LIBRARY_STRATEGY>
+        <LIBRARY_SOURCE>GENOMIC</LIBRARY_SOURCE>
+    </LIBRARY_DESCRIPTOR></DESIGN></EXPERIMENT>
+    <STUDY><IDENTIFIERS><EXTERNAL_ID namespace="BioProject">PRJNA1</EXTERNAL_ID></IDENTIFIERS></STUDY>
+    <SAMPLE accession="SRS3"/>
+    <RUN_SET>
+        <RUN accession="SRR3" total_bases="500" published="2021-01-01 00:00:00"/>
+        <RUN accession="SRR4" total_bases="700" published="2021-01-01 00:00:00"/>
+    </RUN_SET>
+</EXPERIMENT_PACKAGE>
+</EXPERIMENT_PACKAGE_SET>
+"""
+
+class Fake_response:
+    """Stands in for a requests.Response with a canned body."""
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.content = text.encode('UTF-8')
+        self.status_code = status_code
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+    def close(self):
+        pass
+
+@pytest.fixture
+def Fake_eutils(monkeypatch):
+    """
+    Replaces requests sent to eUtils with canned responses. Yields the
+    list of (url, data) pairs that were sent.
+    """
+    import ncbi
+    requested = []
+    def fake_post(self, url, data, stream=False):
+        requested.append((url, data))
+        if 'esearch' in url:
+            found = data['term'].count('[accn]')
+            return Fake_response(f"""<eSearchResult><Count>{found}</Count>
+                <QueryKey>1</QueryKey><WebEnv>MCID_1</WebEnv></eSearchResult>""")
+        return Fake_response(EFETCH_RESPONSE)
+    monkeypatch.setattr(ncbi.Client, 'post', fake_post)
+    yield requested
+
+@pytest.fixture
+def Results_dir(tmp_path, monkeypatch):
+    """
+    Generates the result files of a finished pipeline run for a small
+    project, in a temporary working directory. Yields the project ID.
+    """
+    proj = 'PRJNA999'
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(proj)
+    with open(f'{proj}/ASVs_counts.tsv', 'w') as f:
+        f.write('\tSRR1\tSRR2\tSRR3\n')
+        f.write('ASV_1\t10\t0\t3\n')
+        f.write('ASV_2\t0\t0\t7\n')
+        f.write('ASV_3\t1\t2\t0\n')
+    with open(f'{proj}/ASVs.fa', 'w') as f:
+        f.write('>ASV_1\nTACGGAGGATGCGAGCGTTATCCGG\n')
+        f.write('>ASV_2\nTACGTAGGTGGCAAGCGTTGTCCGG\n')
+        f.write('>ASV_3\nTACGGAGGGTGCAAGCGTTAATCGG\n')
+    with open(f'{proj}/ASVs_taxonomy.tsv', 'w') as f:
+        f.write('\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\n')
+        f.write('ASV_1\tBacteria\tBacteroidota\tBacteroidia\tBacteroidales\tBacteroidaceae\tBacteroides\n')
+        f.write('ASV_2\tBacteria\tFirmicutes\tClostridia\tLachnospirales\tLachnospiraceae\tBlautia\n')
+        f.write('ASV_3\tBacteria\tBacteroidota\tBacteroidia\tBacteroidales\tBacteroidaceae\tNA\n')
+    yield proj
+
+PROJECT_RESULT_FILES = ['ASVs.fa', 'ASVs_counts.tsv', 'ASVs_taxonomy.tsv']
+
+@pytest.fixture
+def Project_dirs(tmp_path, monkeypatch):
+    """
+    Directories for four projects: one with results, one running, one
+    that stopped partway through and one that was never created.
+    """
+    monkeypatch.chdir(tmp_path)
+    for pid in ['PRJNA1', 'PRJNA2', 'PRJNA3']:
+        os.makedirs(f'{pid}/workflow')
+        Path(f'{pid}/SraAccList.txt').touch()
+    for x in PROJECT_RESULT_FILES:
+        Path(f'PRJNA1/{x}').touch()
+    Path('PRJNA2/running.txt').touch()
+    os.makedirs('PRJNA2/.snakemake/slurm_logs/rule_sra_prefetch')
+    Path('PRJNA3/ASVs.fa').touch()
+    # pretend they were last changed a while ago
+    for directory in ['PRJNA1', 'PRJNA2', 'PRJNA3', 'PRJNA2/.snakemake/slurm_logs']:
+        os.utime(directory, (time.time() - 60, time.time() - 60))
+    yield ['PRJNA1', 'PRJNA2', 'PRJNA3', 'PRJNA4']
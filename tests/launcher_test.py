@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+
+import pytest
+
+from fixtures import Temp_db
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+import launcher
+import projects
+
+@pytest.fixture
+def Waiting_projects(Temp_db):
+    """
+    A database with samples from five projects that haven't been started,
+    and one that has. PRJNA3 is missing the size of half its samples.
+    """
+    connection = db.Connection()
+    layout = [ # project, taxon, samples, bases per sample, pubdate
+        ('PRJNA1', '9606', 60, 10000000, '2015-01-01'),
+        ('PRJNA2', '9606', 60, 1000000, '2020-01-01'),
+        ('PRJNA3', '10090', 60, 2000000, '2012-01-01'),
+        ('PRJNA4', '10090', 100, 5000000, None),
+        ('PRJNA5', '9606', 10, 1000000, '2010-01-01'), # too small to start
+        ('PRJNA6', '9606', 80, 50000000, '2011-01-01'), # already started
+    ]
+    for pid, taxon, samples, bases, pubdate in layout:
+        for i in range(samples):
+            if pid == 'PRJNA3' and i % 2 == 1:
+                size = None
+            else:
+                size = bases
+            connection.write("""
+                INSERT INTO samples (srs, project, taxon, srr, library_strategy,
+                    library_source, pubdate, total_bases)
+                VALUES (?,?,?,?,'AMPLICON','GENOMIC',?,?)
+            """, (f'{pid}_{i}', pid, taxon, f'SRR_{pid}_{i}', pubdate, size))
+    connection.write("INSERT INTO status (project, status) VALUES ('PRJNA6', 'running')")
+    yield connection
+
+def test_find_candidates(Waiting_projects):
+    candidates = {x.id: x for x in launcher.find_candidates(Waiting_projects)}
+    assert sorted(candidates.keys()) == ['PRJNA1', 'PRJNA2', 'PRJNA3', 'PRJNA4']
+    assert candidates['PRJNA1'].bases == 600000000
+    # the missing sizes are filled in from the project's other samples
+    assert candidates['PRJNA3'].bases == 120000000
+    assert launcher.work_of(Waiting_projects, ['PRJNA6', 'PRJNA7']) == {'PRJNA6': 4000000000}
+
+def test_order(Waiting_projects):
+    candidates = launcher.find_candidates(Waiting_projects)
+    ids = lambda queue: [x.id for x in queue]
+    assert ids(launcher.order(candidates, 'shortest')) == ['PRJNA2', 'PRJNA3', 'PRJNA4', 'PRJNA1']
+    assert ids(launcher.order(candidates, 'age')) == ['PRJNA3', 'PRJNA1', 'PRJNA2', 'PRJNA4']
+    assert sorted(ids(launcher.order(candidates, 'random', seed=1))) == ['PRJNA1', 'PRJNA2', 'PRJNA3', 'PRJNA4']
+    # human samples have had much more work started already (PRJNA6), so
+    # mouse projects go first until they catch up
+    usage = launcher.taxon_usage(Waiting_projects)
+    assert usage == {'9606': 4000000000}
+    assert ids(launcher.order(candidates, 'fair', usage)) == ['PRJNA3', 'PRJNA4', 'PRJNA2', 'PRJNA1']
+    # without any history, taxa are balanced by work: PRJNA2 is smaller
+    # than PRJNA3, so the human projects get another turn first
+    assert ids(launcher.order(candidates, 'fair')) == ['PRJNA3', 'PRJNA2', 'PRJNA1', 'PRJNA4']
+    with pytest.raises(Exception):
+        launcher.order(candidates, 'biggest')
+
+def test_plan():
+    queue = [launcher.Candidate(f'PRJNA{i}', None, 1, bases, None)
+        for i, bases in enumerate([50, 30, 10, 10])]
+    ids = lambda chosen: [x.id for x in chosen]
+    # PRJNA1 doesn't fit, but the smaller projects after it do
+    assert ids(launcher.plan(queue, 0, 75, 10)) == ['PRJNA0', 'PRJNA2', 'PRJNA3']
+    assert ids(launcher.plan(queue, 0, 75, 2)) == ['PRJNA0', 'PRJNA2']
+    assert ids(launcher.plan(queue, 60, 75, 10)) == ['PRJNA2']
+    # a project bigger than the budget still runs on its own
+    assert ids(launcher.plan(queue, 0, 20, 10)) == ['PRJNA0']
+    assert ids(launcher.plan(queue, 5, 20, 10)) == ['PRJNA2']
+
+def test_next_projects(Waiting_projects, capsys):
+    started = launcher.next_projects(Waiting_projects, ['PRJNA6'], policy='shortest',
+        budget=4.5, slots=3)
+    assert started == ['PRJNA2', 'PRJNA3']
+    assert 'Waiting: 4 projects, 1.3 Gb' in capsys.readouterr().out
+
+def test_measure_throughput(Waiting_projects):
+    assert launcher.measure_throughput(Waiting_projects) is None
+    now = time.time()
+    for pid, hours_ago in [('PRJNA1', 10), ('PRJNA2', 5), ('PRJNA3', 0)]:
+        Waiting_projects.write("""
+            INSERT INTO project_state (project, checks, running, stage_changed_at, done_at)
+            VALUES (?,?,0,?,?)
+        """, (pid, projects.DONE_MASK, now - 100 * 3600, now - hours_ago * 3600))
+    # a project whose stage changed recently, but isn't done
+    Waiting_projects.write("""
+        INSERT INTO project_state (project, checks, running, stage_changed_at)
+        VALUES ('PRJNA4', ?, 1, ?)
+    """, (projects.DONE_MASK, now))
+    # PRJNA2 and PRJNA3 finished in the 10 hours after PRJNA1 did
+    assert launcher.measure_throughput(Waiting_projects) == pytest.approx(18000000)
@@ -0,0 +1,124 @@
+import os
+from pathlib import Path
+import sys
+import time
+
+from fixtures import Temp_db, Project_dirs
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+import management
+import projects
+
+def test_evaluate_progress(Project_dirs):
+    checks, running = projects.evaluate_progress(projects.list_progress('PRJNA2'))
+    assert running
+    # directory, repository, accession list, then no venv; prefetch started
+    assert checks == 0b10111
+    assert projects.progress_stage(checks) == 'Accession list created'
+    assert projects.evaluate_progress(projects.list_progress('PRJNA4')) == (0, False)
+    checks, running = projects.evaluate_progress(projects.list_progress('PRJNA1'))
+    assert checks & projects.DONE_MASK == projects.DONE_MASK
+
+def test_determine_projects(Temp_db, Project_dirs):
+    connection = db.Connection()
+    for pid in Project_dirs:
+        connection.write('INSERT INTO status (project, status) VALUES (?,?)', (pid, 'running'))
+    connection.write("INSERT INTO status (project, status) VALUES ('PRJNA5', 'done')")
+
+    done, running, not_done = management.determine_projects(connection)
+    assert [x.id for x in done] == ['PRJNA1']
+    assert [x.id for x in running] == ['PRJNA2']
+    assert [x.id for x in not_done] == ['PRJNA3', 'PRJNA4']
+
+    # the same answer comes from the index alone
+    os.remove('PRJNA2/running.txt')
+    done, running, not_done = management.determine_projects(connection, rescan=False)
+    assert [x.id for x in running] == ['PRJNA2']
+
+    # PRJNA1 has its results, but isn't done until its pipeline stops
+    Path('PRJNA1/running.txt').touch()
+    done, running, not_done = management.determine_projects(connection)
+    assert [x.id for x in done] == []
+    assert [x.id for x in running] == ['PRJNA1']
+
+def test_scan_projects_done_at(Temp_db, Project_dirs):
+    connection = db.Connection()
+    management.scan_projects(connection, Project_dirs)
+    first = dict(connection.read('SELECT project, done_at FROM project_state'))
+    assert first['PRJNA1'] is not None
+    assert first['PRJNA2'] is None
+
+    # the time it was first seen done doesn't change with later scans
+    Path('PRJNA1/other.txt').touch()
+    os.utime('PRJNA1', (time.time() + 10, time.time() + 10))
+    management.scan_projects(connection, Project_dirs)
+    assert connection.read("SELECT done_at FROM project_state WHERE project='PRJNA1'") == [(first['PRJNA1'],)]
+
+    # ...unless it stops being done (e.g. it's running again)
+    Path('PRJNA1/running.txt').touch()
+    os.utime('PRJNA1', (time.time() + 20, time.time() + 20))
+    management.scan_projects(connection, Project_dirs)
+    assert connection.read("SELECT done_at FROM project_state WHERE project='PRJNA1'") == [(None,)]
+
+def test_scan_projects_cached(Temp_db, Project_dirs, monkeypatch):
+    connection = db.Connection()
+    states = management.scan_projects(connection, Project_dirs, workers=2)
+    assert {pid: state[1] for pid, state in states.items()} == {
+        'PRJNA1': False, 'PRJNA2': True, 'PRJNA3': False, 'PRJNA4': False
+    }
+    assert connection.read("SELECT stage FROM project_state WHERE project='PRJNA4'") == [(None,)]
+
+    # nothing has changed, so nothing should be listed again
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    assert management.scan_projects(connection, Project_dirs) == states
+    assert listed == []
+
+    # the pipeline moves along: a change in a subdirectory is noticed too
+    os.makedirs('PRJNA2/.snakemake/slurm_logs/rule_sra_to_fastq')
+    checks, running = management.scan_projects(connection, Project_dirs)['PRJNA2']
+    assert checks & (1 << 5)
+    assert len(listed) > 0 and all(x.startswith('PRJNA2/') for x in listed)
+
+def test_scan_stage_changes(Temp_db, Project_dirs):
+    connection = db.Connection()
+    management.scan_projects(connection, ['PRJNA2'])
+    before = connection.read("SELECT stage, stage_changed_at FROM project_state WHERE project='PRJNA2'")
+    assert before[0][0] == 'Accession list created'
+
+    # a change that doesn't move the stage along keeps its timestamp
+    Path('PRJNA2/other.txt').touch()
+    connection.write('UPDATE project_state SET mtimes=NULL')
+    management.scan_projects(connection, ['PRJNA2'])
+    assert connection.read("SELECT stage, stage_changed_at FROM project_state WHERE project='PRJNA2'") == before
+
+    os.mkdir('PRJNA2/venv')
+    connection.write('UPDATE project_state SET mtimes=NULL')
+    management.scan_projects(connection, ['PRJNA2'])
+    after = connection.read("SELECT stage, stage_changed_at FROM project_state WHERE project='PRJNA2'")
+    assert after[0][0] == '1/6 Prefetch job started'
+    assert after[0][1] >= before[0][1]
+
+def test_scan_recent_changes(Temp_db, Project_dirs, monkeypatch):
+    connection = db.Connection()
+    os.utime('PRJNA3') # modified just now
+    management.scan_projects(connection, Project_dirs)
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    # a listing from the same moment as a change can't be trusted
+    management.scan_projects(connection, Project_dirs)
+    assert len(listed) > 0 and all(x.startswith('PRJNA3/') for x in listed)
+
+def test_report_progress(Temp_db, Project_dirs, capsys):
+    connection = db.Connection()
+    management.scan_projects(connection, ['PRJNA2'])
+    proj = management.load_projects(connection, ['PRJNA2'])[0]
+    assert proj.Report_progress() is False
+    out = capsys.readouterr().out
+    assert 'CURRENTLY RUNNING' in out
+    assert 'Latest step: Accession list created' in out
+    assert 'X   Virtual environment created   <<< XXXXXXX <<<' in out
+    assert '✓   1/6 Prefetch job started' in out
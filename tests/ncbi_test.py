@@ -0,0 +1,141 @@
+import io
+import os
+import sys
+import time
+
+import pytest
+
+from fixtures import EFETCH_RESPONSE
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import ncbi
+
+def test_rate_limiter_spacing():
+    limiter = ncbi.RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    # the first request goes right away, the other 10 are 1/50th of a second apart
+    assert time.monotonic() - start >= 0.19
+
+def test_rate_limiter_threads():
+    client = ncbi.Client(workers=4, rate=50)
+    def work(client, batch):
+        client.limiter.acquire()
+        return time.monotonic()
+    times = sorted(x[1] for x in client.map(work, list(range(11))))
+    assert times[-1] - times[0] >= 0.19
+
+def test_client_map_returns_every_batch():
+    client = ncbi.Client(workers=3, rate=1000)
+    results = dict(client.map(lambda c, batch: sum(batch), [(1, 2), (3, 4), (5,)]))
+    assert results == {(1, 2): 3, (3, 4): 7, (5,): 5}
+
+class Flaky_session:
+    """Fails with the given status codes before eventually succeeding."""
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+    def request(self, method, url, data=None, stream=False, timeout=None):
+        self.calls += 1
+        status = self.statuses.pop(0) if len(self.statuses) > 0 else 200
+        if status == 'timeout':
+            raise ncbi.requests.exceptions.ReadTimeout('too slow')
+        if status == 'cut off':
+            raise ncbi.requests.exceptions.ChunkedEncodingError('connection broken')
+        response = ncbi.requests.Response()
+        response.status_code = status
+        response.raw = io.BytesIO()
+        return response
+
+def test_client_retries():
+    client = ncbi.Client(rate=1000, retries=3, backoff=0.001)
+    client.session = Flaky_session([503, 'timeout', 429])
+    assert client.get('https://example.org').status_code == 200
+    assert client.session.calls == 4
+
+def test_client_retries_broken_responses():
+    client = ncbi.Client(rate=1000, retries=3, backoff=0.001)
+    client.session = Flaky_session(['cut off'])
+    assert client.post('https://example.org', {'db': 'sra'}).status_code == 200
+    assert client.session.calls == 2
+
+def test_client_gives_up():
+    client = ncbi.Client(rate=1000, retries=2, backoff=0.001)
+    client.session = Flaky_session([500, 500, 500, 500])
+    with pytest.raises(ncbi.RequestFailed):
+        client.get('https://example.org')
+    assert client.session.calls == 3
+
+def test_client_doesnt_retry_bad_requests():
+    client = ncbi.Client(rate=1000, retries=2, backoff=0.001)
+    client.session = Flaky_session([400])
+    assert client.get('https://example.org').status_code == 400
+
+def test_client_map_requeues():
+    client = ncbi.Client(workers=2, rate=1000)
+    attempts = {}
+    def work(client, batch):
+        attempts[batch] = attempts.get(batch, 0) + 1
+        if batch == 'flaky' and attempts[batch] < 2:
+            return None
+        if batch == 'broken':
+            raise ncbi.RequestFailed('nope')
+        # e.g. a streamed response that's cut off partway through
+        if batch == 'cut off' and attempts[batch] < 2:
+            raise ncbi.requests.exceptions.ChunkedEncodingError('connection broken')
+        return batch
+    results = dict(client.map(work, ['fine', 'flaky', 'broken', 'cut off'], requeue=2))
+    assert results == {'fine': 'fine', 'flaky': 'flaky', 'broken': None, 'cut off': 'cut off'}
+    assert attempts == {'fine': 1, 'flaky': 2, 'broken': 3, 'cut off': 2}
+
+def test_parse_efetch():
+    body = EFETCH_RESPONSE.encode('UTF-8')
+    # feed it a few bytes at a time, like a slow network connection would
+    chunks = [body[i:i+7] for i in range(0, len(body), 7)]
+    records = list(ncbi.parse_efetch(chunks))
+    assert records == [
+        ncbi.RunRecord('SRS1', ('SRR1',), 'PRJNA1', 'AMPLICON', 'METAGENOMIC',
+            '2020-01-01 00:00:00', '1000', 'Illumina MiSeq'),
+        ncbi.RunRecord('SRS3', ('SRR3', 'SRR4'), 'PRJNA1', 'AMPLICON', 'GENOMIC',
+            '2021-01-01 00:00:00', '700', None)
+    ]
+
+def test_parse_efetch_malformed():
+    with pytest.raises(ncbi.ET.ParseError):
+        list(ncbi.parse_efetch([b'<EXPERIMENT_PACKAGE_SET><EXPERIMENT_PACKAGE>']))
+
+def test_response_cache(tmp_path):
+    cache = ncbi.ResponseCache(str(tmp_path), ttl_days=1, max_mb=1)
+    batch = ['SRS2', 'SRS1']
+    body = EFETCH_RESPONSE.encode('UTF-8')
+    # nothing is usable until every page is saved
+    assert list(cache.save_page(batch, 0, [body[:10], body[10:]])) == [body[:10], body[10:]]
+    assert cache.lookup(batch) is None
+    cache.finish(batch)
+
+    # the order of the accessions doesn't matter
+    entry = cache.lookup(['SRS1', 'SRS2'])
+    assert entry is not None
+    assert cache.index() == {'SRS1': entry, 'SRS2': entry}
+    pages = [b''.join(chunks) for chunks in cache.read_pages(entry)]
+    assert pages == [body]
+
+def test_response_cache_eviction(tmp_path):
+    cache = ncbi.ResponseCache(str(tmp_path), ttl_days=1, max_mb=1)
+    for i in range(3):
+        batch = [f'SRS{i}']
+        # random bytes don't compress, so each entry is about 400 KB
+        list(cache.save_page(batch, 0, [os.urandom(400000)]))
+        cache.finish(batch)
+        marker = os.path.join(cache.lookup(batch), 'complete')
+        os.utime(marker, (time.time() - 100 + i, time.time() - 100 + i))
+    cache.evict()
+    # the oldest entry goes first
+    assert cache.lookup(['SRS0']) is None
+    assert cache.lookup(['SRS1']) is not None
+    assert cache.lookup(['SRS2']) is not None
+
+    # expired entries are ignored
+    cache.ttl = 10
+    assert list(cache.entries()) == []
@@ -3,9 +3,10 @@ import sys
 
 import pytest
 
-from fixtures import Dada_dir
+from fixtures import Dada_dir, Results_dir, Temp_db
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
 import projects
 
 def test_load_summary(Dada_dir):
@@ -51,3 +52,144 @@ def test_Project_remove_previous_dada(Dada_dir):
     # make sure the summary file has been renamed
     assert 'previous_summary.tsv' not in files
     assert 'previous_previous_summary.tsv' in files
+
+def test_load_counts(Results_dir):
+    proj = projects.Project(Results_dir)
+    counts = [x for chunk in proj._load_counts() for x in chunk]
+    # zeroes are left out, and the order is row by row
+    assert counts == [
+        ('SRR1', 'ASV_1', 10), ('SRR3', 'ASV_1', 3),
+        ('SRR3', 'ASV_2', 7),
+        ('SRR1', 'ASV_3', 1), ('SRR2', 'ASV_3', 2)
+    ]
+
+def test_load_counts_chunks(Results_dir):
+    proj = projects.Project(Results_dir)
+    chunks = list(proj._load_counts(chunksize=2))
+    assert len(chunks) == 2
+    assert sum(len(x) for x in chunks) == 5
+
+def test_save_results(Results_dir, Temp_db, monkeypatch):
+    # stop before archiving and deleting anything
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    # an earlier project, so the new IDs don't start at 1
+    connection.write("INSERT INTO sequences (asv_id, seq_hash, seq) VALUES (41, ?, 'ACGT')", (db.sequence_hash('ACGT'),))
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+
+    proj = projects.Project(Results_dir)
+    proj.Save_results(connection)
+
+    assert connection.read('SELECT asv_id, asv FROM asv_sequences WHERE project=? ORDER BY 1', (Results_dir,)) == [
+        (42, 'ASV_1'), (43, 'ASV_2'), (44, 'ASV_3')
+    ]
+    assert connection.read('SELECT asv_id, genus FROM asv_assignments ORDER BY 1') == [
+        (42, 'Bacteroides'), (43, 'Blautia'), (44, 'NA')
+    ]
+    assert connection.read('SELECT sample_id, sample FROM result_samples ORDER BY 1') == [
+        (1, 'SRR1'), (2, 'SRR2'), (3, 'SRR3')
+    ]
+    assert connection.read('SELECT sample_id, asv_id, count FROM sample_asv_counts ORDER BY 1, 2') == [
+        (1, 42, 10), (1, 44, 1), (2, 44, 2), (3, 42, 3), (3, 43, 7)
+    ]
+    # the compatibility view still has names
+    assert connection.read("SELECT count FROM asv_counts WHERE sample='SRR3' AND asv='ASV_2'") == [(7,)]
+    assert connection.read("SELECT sample_id, taxon, count FROM taxon_rollups WHERE rank='genus' ORDER BY 1, 2") == [
+        (1, 'Bacteroides', 10), (1, 'NA', 1), (2, 'NA', 2), (3, 'Bacteroides', 3), (3, 'Blautia', 7)
+    ]
+    assert connection.read("SELECT sample_id, taxon, count FROM taxon_rollups WHERE rank='phylum' ORDER BY 1, 2") == [
+        (1, 'Bacteroidota', 11), (2, 'Bacteroidota', 2), (3, 'Bacteroidota', 3), (3, 'Firmicutes', 7)
+    ]
+    assert connection.read('SELECT status FROM status') == [('complete',)]
+
+def test_save_results_twice(Results_dir, Temp_db, monkeypatch):
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+
+    # e.g. the results weren't archived, so the project is saved again later
+    projects.Project(Results_dir).Save_results(connection)
+    projects.Project(Results_dir).Save_results(connection)
+
+    assert connection.read('SELECT COUNT(*) FROM project_asvs') == [(3,)]
+    assert connection.read('SELECT COUNT(*) FROM result_samples') == [(3,)]
+    assert connection.read('SELECT sample_id, asv_id, count FROM sample_asv_counts ORDER BY 1, 2') == [
+        (1, 1, 10), (1, 3, 1), (2, 3, 2), (3, 1, 3), (3, 2, 7)
+    ]
+    assert connection.read("SELECT sample_id, count FROM taxon_rollups WHERE rank='kingdom' ORDER BY 1") == [
+        (1, 11), (2, 2), (3, 10)
+    ]
+
+def test_save_results_duplicate_asvs(Results_dir, Temp_db, monkeypatch):
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+    # ASV_3 has the same sequence as ASV_1
+    with open(f'{Results_dir}/ASVs.fa', 'w') as f:
+        f.write('>ASV_1\nTACGGAGGATGCGAGCGTTATCCGG\n')
+        f.write('>ASV_2\nTACGTAGGTGGCAAGCGTTGTCCGG\n')
+        f.write('>ASV_3\nTACGGAGGATGCGAGCGTTATCCGG\n')
+
+    projects.Project(Results_dir).Save_results(connection)
+
+    assert connection.read('SELECT asv, asv_id FROM project_asvs ORDER BY 1') == [
+        ('ASV_1', 1), ('ASV_2', 2), ('ASV_3', 1)
+    ]
+    # the counts of the two are combined, and listed once
+    assert connection.read('SELECT sample, asv, count FROM asv_counts ORDER BY 1, 2') == [
+        ('SRR1', 'ASV_1', 11), ('SRR2', 'ASV_1', 2), ('SRR3', 'ASV_1', 3), ('SRR3', 'ASV_2', 7)
+    ]
+
+def test_save_results_rolls_back(Results_dir, Temp_db, monkeypatch):
+    connection = db.Connection()
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+    # an ASV in the taxonomy file that's missing from the sequences
+    with open(f'{Results_dir}/ASVs_taxonomy.tsv', 'a') as f:
+        f.write('ASV_4\tBacteria\tNA\tNA\tNA\tNA\tNA\n')
+
+    proj = projects.Project(Results_dir)
+    with pytest.raises(KeyError):
+        proj.Save_results(connection)
+    assert connection.read('SELECT COUNT(*) FROM asv_sequences') == [(0,)]
+    assert connection.read('SELECT COUNT(*) FROM sample_asv_counts') == [(0,)]
+    assert connection.read('SELECT status FROM status') == [('running',)]
+
+def test_save_results_shared_sequences(Results_dir, Temp_db, monkeypatch):
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    # an earlier project that found the same sequence as ASV_2
+    seq = 'TACGTAGGTGGCAAGCGTTGTCCGG'
+    connection.write("INSERT INTO sequences (asv_id, seq_hash, seq) VALUES (7, ?, ?)", (db.sequence_hash(seq), seq))
+    connection.write("INSERT INTO project_asvs (project, asv, asv_id) VALUES ('PRJNA1', 'ASV_9', 7)")
+    connection.write("INSERT INTO asv_assignments (asv_id, tdatabase, genus) VALUES (7, 'silva', 'Blautia')")
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+
+    proj = projects.Project(Results_dir)
+    proj.Save_results(connection)
+
+    assert connection.read('SELECT asv_id, asv FROM asv_sequences WHERE project=? ORDER BY 2', (Results_dir,)) == [
+        (8, 'ASV_1'), (7, 'ASV_2'), (9, 'ASV_3')
+    ]
+    assert connection.read('SELECT COUNT(*) FROM sequences') == [(3,)]
+    # the existing assignment is kept
+    assert connection.read('SELECT tdatabase FROM asv_assignments WHERE asv_id=7') == [('silva',)]
+    assert connection.read('SELECT project, asv, count FROM asv_counts WHERE asv_id=7') == [(Results_dir, 'ASV_2', 7)]
+
+def test_save_results_sample_in_other_project(Results_dir, Temp_db, monkeypatch):
+    monkeypatch.setattr(projects, 'confirm_destruct', lambda prompt: False)
+    connection = db.Connection()
+    connection.write("INSERT INTO result_samples (sample, project) VALUES ('SRR2', 'PRJNA1')")
+    connection.write('INSERT INTO status (project, status) VALUES (?,?)', (Results_dir, 'running'))
+
+    with pytest.raises(Exception, match='Sample SRR2 in project PRJNA999 was already saved as part of project PRJNA1'):
+        projects.Project(Results_dir).Save_results(connection)
+    assert connection.read('SELECT COUNT(*) FROM result_samples') == [(1,)]
+    assert connection.read('SELECT status FROM status') == [('running',)]
+
+def test_load_counts_with_ids(Results_dir):
+    proj = projects.Project(Results_dir)
+    counts = [x for chunk in proj._load_counts(
+        sample_ids={'SRR1': 1, 'SRR2': 2, 'SRR3': 3},
+        asv_ids={'ASV_1': 11, 'ASV_2': 12, 'ASV_3': 13}
+    ) for x in chunk]
+    assert counts == [(1, 11, 10), (3, 11, 3), (3, 12, 7), (1, 13, 1), (2, 13, 2)]
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+
+from fixtures import Temp_db, Project_dirs
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+import management
+import scheduler
+
+class Fake_completed:
+    def __init__(self, stdout, returncode=0):
+        self.stdout = stdout
+        self.stderr = ''
+        self.returncode = returncode
+
+def test_classify():
+    assert scheduler.classify('PENDING') == 'running'
+    assert scheduler.classify('RUNNING') == 'running'
+    assert scheduler.classify('COMPLETED') == 'done'
+    assert scheduler.classify('CANCELLED by 1234') == 'dead'
+    assert scheduler.classify('TIMEOUT') == 'dead'
+    assert scheduler.classify('OUT_OF_MEMORY') == 'dead'
+
+def test_slurm_job_states(monkeypatch):
+    calls = []
+    def fake_run(command, **kwargs):
+        calls.append(command[0])
+        if command[0] == 'squeue':
+            return Fake_completed('PRJNA1|RUNNING\nPRJNA2|PENDING\n')
+        # an old attempt at PRJNA3 failed, but the latest one finished
+        return Fake_completed('PRJNA3|FAILED\nPRJNA4|CANCELLED by 500\nPRJNA3|COMPLETED\n')
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+
+    jobs = scheduler.SlurmScheduler(user='someone')
+    assert jobs.job_states(['PRJNA1', 'PRJNA2']) == {'PRJNA1': 'running', 'PRJNA2': 'running'}
+    assert calls == ['squeue'] # nothing has left the queue, so no need for sacct
+    assert jobs.job_states(['PRJNA1', 'PRJNA3', 'PRJNA4', 'PRJNA5']) == {
+        'PRJNA1': 'running', 'PRJNA3': 'done', 'PRJNA4': 'dead', 'PRJNA5': None
+    }
+    assert calls == ['squeue', 'sacct']
+    # answers are kept until they're refreshed
+    jobs.job_states(['PRJNA1', 'PRJNA3', 'PRJNA5'])
+    assert calls == ['squeue', 'sacct']
+    jobs.refresh()
+    jobs.job_states(['PRJNA5'])
+    assert calls == ['squeue', 'sacct', 'squeue', 'sacct']
+
+def test_slurm_unavailable(monkeypatch):
+    def fake_run(command, **kwargs):
+        raise FileNotFoundError(command[0])
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    jobs = scheduler.SlurmScheduler(user='someone')
+    assert jobs.job_states(['PRJNA1']) == {'PRJNA1': None}
+
+def test_determine_projects_with_jobs(Temp_db, Project_dirs):
+    connection = db.Connection()
+    for pid in Project_dirs:
+        connection.write('INSERT INTO status (project, status) VALUES (?,?)', (pid, 'running'))
+
+    # PRJNA2 left running.txt behind when its job was killed; PRJNA3 is
+    # waiting in the queue to be tried again
+    jobs = scheduler.FakeScheduler({'PRJNA2': 'CANCELLED', 'PRJNA3': 'PENDING'})
+    done, running, not_done = management.determine_projects(connection, jobs=jobs)
+    assert jobs.queries == 1
+    assert [x.id for x in done] == ['PRJNA1']
+    assert [x.id for x in running] == ['PRJNA3']
+    assert [x.id for x in not_done] == ['PRJNA2', 'PRJNA4']
+    assert not_done[0].job_state == 'dead'
+    assert not_done[1].job_state is None
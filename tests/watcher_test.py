@@ -0,0 +1,132 @@
+import os
+from pathlib import Path
+import sys
+import time
+
+import pytest
+
+from fixtures import Temp_db
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import db
+import management
+import projects
+import watcher
+
+RESULT_FILES = ['ASVs.fa', 'ASVs_counts.tsv', 'ASVs_taxonomy.tsv']
+
+@pytest.fixture
+def Watched_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('PRJNA1')
+    os.mkdir('PRJNA2')
+    yield tmp_path
+
+def inotify_watcher():
+    try:
+        return watcher.InotifyWatcher()
+    except OSError:
+        pytest.skip('inotify is not available')
+
+def test_inotify(Watched_dir):
+    w = inotify_watcher()
+    w.watch('PRJNA1')
+    w.watch('PRJNA2')
+    Path('PRJNA1/ASVs.fa').touch()
+    Path('PRJNA2/something_else.txt').touch()
+    assert w.wait(1) == {'PRJNA1'}
+    # nothing more has happened
+    assert w.wait(0.05) == set()
+
+    w.unwatch('PRJNA1')
+    Path('PRJNA1/running.txt').touch()
+    os.remove('PRJNA1/running.txt')
+    assert w.wait(0.05) == set()
+    w.close()
+
+def test_inotify_waits_for_close(Watched_dir):
+    w = inotify_watcher()
+    w.watch('PRJNA1')
+    Path('PRJNA1/running.txt').touch()
+    assert w.wait(0.05) == set()
+    # a result file that's still being written doesn't count yet
+    with open('PRJNA1/ASVs_counts.tsv', 'w') as f:
+        f.write('\tSRR1\n')
+        f.flush()
+        assert w.wait(0.05) == set()
+    assert w.wait(1) == {'PRJNA1'}
+    # running.txt being removed does
+    os.remove('PRJNA1/running.txt')
+    assert w.wait(1) == {'PRJNA1'}
+    w.close()
+
+def test_polling(Watched_dir):
+    w = watcher.PollingWatcher(interval=0.01)
+    w.watch('PRJNA1')
+    assert w.wait(0.001) == set()
+    assert w.wait(1) == {'PRJNA1'}
+    w.unwatch('PRJNA1')
+    assert w.wait(1) == set()
+
+def test_make_watcher(monkeypatch):
+    assert isinstance(watcher.make_watcher('poll'), watcher.PollingWatcher)
+    with pytest.raises(Exception):
+        watcher.make_watcher('carrier pigeon')
+
+def test_wait_for_finish(Temp_db, Watched_dir):
+    connection = db.Connection()
+    w = watcher.PollingWatcher(interval=0.01)
+    w.watch('PRJNA1')
+    w.watch('PRJNA2')
+    # not finished yet, so it gives up at the deadline
+    Path('PRJNA1/ASVs.fa').touch()
+    assert watcher._wait_for_finish(connection, w, time.time() + 0.1) == []
+
+    # all the results are there, but the pipeline hasn't finished
+    Path('PRJNA2/running.txt').touch()
+    for x in RESULT_FILES:
+        Path(f'PRJNA2/{x}').touch()
+    assert watcher._wait_for_finish(connection, w, time.time() + 0.1) == []
+
+    os.remove('PRJNA2/running.txt')
+    assert watcher._wait_for_finish(connection, w, time.time() + 5) == ['PRJNA2']
+
+def test_run(Temp_db, Watched_dir, monkeypatch):
+    connection = db.Connection()
+    connection.write("INSERT INTO status (project, status) VALUES ('PRJNA1', 'running')")
+    launched = []
+    monkeypatch.setattr(management, 'launch_projects', lambda connection, active: launched.append(len(active)) or ['PRJNA2'])
+    w = watcher.PollingWatcher(interval=0.01)
+    watcher.run(connection, w, cycles=1)
+    assert launched == [1]
+    assert w.watched == {'PRJNA1', 'PRJNA2'}
+
+def test_run_skips_broken_projects(Temp_db, Watched_dir, monkeypatch):
+    connection = db.Connection()
+    # both are done, but PRJNA1 has no summary.tsv, so it can't be evaluated
+    for pid in ['PRJNA1', 'PRJNA2']:
+        connection.write('INSERT INTO status (project, status) VALUES (?,?)', (pid, 'running'))
+        for x in RESULT_FILES:
+            Path(f'{pid}/{x}').touch()
+    evaluated = []
+    def fake_load(self):
+        if self.id == 'PRJNA1':
+            raise FileNotFoundError(f'{self.id}/summary.tsv')
+        evaluated.append(self.id)
+    monkeypatch.setattr(projects.Project, 'Load_results_summary', fake_load)
+    monkeypatch.setattr(projects.Project, 'print_errors', lambda self: None)
+    monkeypatch.setattr(projects.Project, 'REACT', lambda self, connection: None)
+    monkeypatch.setattr(management, 'launch_projects', lambda connection, active: [])
+
+    watcher.run(connection, watcher.PollingWatcher(interval=0.01), cycles=1)
+    assert evaluated == ['PRJNA2']
+
+    # the same goes for anything else that goes wrong during a cycle
+    def broken(connection, active):
+        raise Exception('database is locked')
+    monkeypatch.setattr(management, 'launch_projects', broken)
+    import config
+    monkeypatch.setattr(config, 'watch_full_interval', 0.05, raising=False)
+    evaluated.clear()
+    watcher.run(connection, watcher.PollingWatcher(interval=0.01), cycles=2)
+    assert evaluated == ['PRJNA2', 'PRJNA2']
@@ -0,0 +1,219 @@
+"""
+This module keeps the pipeline moving without waiting for the next scheduled
+"autoforward": it watches the directories of running projects and, as soon
+as one of them finishes, evaluates its results and starts new projects in
+its place.
+
+Changes are picked up with inotify where it's available. Otherwise (or if
+config.watch_method is "poll"), the directories are re-checked every few
+seconds, which is cheap because unchanged directories aren't listed again
+(see management.scan_projects). Note that inotify only sees changes made by
+the machine it's running on, so on a shared filesystem where pipelines run
+on other nodes, polling is the option that works.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import traceback
+
+import config
+import management
+import projects
+
+# Files whose appearance could mean a project finished...
+RESULT_FILES = {check[3] for check in projects.PROGRESS_CHECKS if check[0] == 'Results'}
+# ...or whose removal could mean it stopped running
+WATCHED_FILES = RESULT_FILES | {'running.txt'}
+
+class InotifyWatcher:
+    """
+    Watches project directories using the Linux inotify API, called
+    through ctypes.
+    """
+    # from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    # A result file only counts once it's been written and closed (or moved
+    # into place), not when it's created: until then it may be incomplete.
+    RESULT_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+    RUNNING_MASK = IN_DELETE | IN_MOVED_FROM # running.txt going away
+    MASK = RESULT_MASK | RUNNING_MASK
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len; followed by the name
+
+    def __init__(self):
+        """Raises OSError if inotify isn't available."""
+        name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {} # watch descriptor -> project ID
+
+    def watch(self, pid):
+        """Starts watching a project's directory."""
+        if pid in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, pid.encode(), self.MASK)
+        if wd < 0: # most likely, the directory doesn't exist yet
+            return
+        self.watches[wd] = pid
+
+    def unwatch(self, pid):
+        """Stops watching a project's directory."""
+        for wd, watched in list(self.watches.items()):
+            if watched == pid:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def wait(self, timeout):
+        """
+        Waits for a watched file to change in any project directory.
+
+        Inputs:
+            - timeout: float. The longest to wait, in seconds.
+        Returns:
+            - A set of the IDs of the projects that changed. Empty if
+                the timeout passed without any changes.
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if wd not in self.watches:
+                continue
+            if (name in RESULT_FILES and mask & self.RESULT_MASK) or \
+                    (name == 'running.txt' and mask & self.RUNNING_MASK):
+                changed.add(self.watches[wd])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Stands in for InotifyWatcher where inotify can't be used: every
+    project being watched is reported as possibly changed at a regular
+    interval, and management.scan_projects figures out which ones did.
+    """
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = getattr(config, 'watch_poll_interval', 30)
+        self.interval = interval
+        self.watched = set()
+
+    def watch(self, pid):
+        self.watched.add(pid)
+
+    def unwatch(self, pid):
+        self.watched.discard(pid)
+
+    def wait(self, timeout):
+        time.sleep(max(min(timeout, self.interval), 0))
+        if timeout < self.interval:
+            return set()
+        return set(self.watched)
+
+    def close(self):
+        pass
+
+def make_watcher(method=None):
+    """
+    Returns a watcher using the method in config.watch_method: "inotify",
+    "poll", or "auto" (inotify if it's available, otherwise polling).
+    """
+    if method is None:
+        method = getattr(config, 'watch_method', 'auto')
+    if method not in ['auto', 'inotify', 'poll']:
+        raise Exception(f'Unrecognized watch_method "{method}". Options are: auto, inotify, poll')
+    if method != 'poll':
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError, TypeError) as e:
+            if method == 'inotify':
+                raise
+            print(f'inotify is not available ({e}); checking for changes every few seconds instead.')
+    return PollingWatcher()
+
+def run(connection, watcher=None, cycles=None):
+    """
+    Does what "autoforward" does, then watches the running projects and
+    does it again as soon as any of them finish. Everything is also
+    re-checked every config.watch_full_interval seconds, to catch anything
+    the watcher misses.
+
+    Inputs:
+        - connection: An instance of type db.Connection
+        - watcher: Where changes come from; see make_watcher().
+        - cycles: int. How many times to run through autoforward before
+            stopping. By default, runs until it's stopped.
+    """
+    if watcher is None:
+        watcher = make_watcher()
+    full_interval = getattr(config, 'watch_full_interval', 600)
+    watched = set()
+    cycle = 0
+    try:
+        while cycles is None or cycle < cycles:
+            cycle += 1
+            try:
+                done, running, not_done = management.determine_projects(connection)
+                management.print_projects_summary(done, running, not_done)
+                # (problems with individual projects are handled in here)
+                management.advance_projects(done, running, not_done, connection, auto=True)
+                started = management.launch_projects(connection, running + not_done)
+            except Exception:
+                # anything else (e.g. the database is locked) is retried after
+                # the next change, rather than stopping the watch
+                print('ERROR: Could not finish checking on projects; trying again later.')
+                traceback.print_exc()
+            else:
+                # watch the projects still in progress, and stop watching the rest
+                active = {x.id for x in running + not_done} | set(started)
+                for pid in watched - active:
+                    watcher.unwatch(pid)
+                for pid in active:
+                    watcher.watch(pid)
+                watched = active
+
+            if cycles is not None and cycle >= cycles:
+                break
+            _wait_for_finish(connection, watcher, time.time() + full_interval)
+    finally:
+        watcher.close()
+
+def _wait_for_finish(connection, watcher, deadline):
+    """
+    Waits until a watched project finishes, or until the deadline passes.
+
+    Returns:
+        - A list of the IDs of the projects that finished.
+    """
+    while time.time() < deadline:
+        changed = watcher.wait(deadline - time.time())
+        if len(changed) == 0:
+            continue
+        states = management.scan_projects(connection, sorted(changed))
+        # a project isn't done until its pipeline has cleaned up running.txt
+        finished = [pid for pid, (checks, running) in states.items()
+            if checks & projects.DONE_MASK == projects.DONE_MASK and not running]
+        if len(finished) > 0:
+            print(f'Finished: {", ".join(finished)}')
+            return finished
+    return []